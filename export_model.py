@@ -0,0 +1,51 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import argparse
+
+from torchreid import models
+from torchreid.export import build_feature_extractor, export_feature_extractor, benchmark
+
+parser = argparse.ArgumentParser(description='Export the feature extractor of a trained model to TorchScript/ONNX')
+parser.add_argument('-a', '--arch', type=str, default='resnet50', choices=models.get_names())
+parser.add_argument('--load-weights', type=str, default='',
+                    help="checkpoint saved by the training scripts (default: initial weights)")
+parser.add_argument('--num-classes', type=int, default=None,
+                    help="number of training identities (default: read from the checkpoint)")
+parser.add_argument('--height', type=int, default=256,
+                    help="height of an image (default: 256)")
+parser.add_argument('--width', type=int, default=128,
+                    help="width of an image (default: 128)")
+parser.add_argument('--save-dir', type=str, default='log/export')
+parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'],
+                    choices=['torchscript', 'onnx'], help="formats to export (default: torchscript onnx)")
+parser.add_argument('--no-fold-bn', action='store_true',
+                    help="keep the BatchNorm layers instead of folding them into the convs (default: False)")
+parser.add_argument('--benchmark', action='store_true',
+                    help="compare the CPU throughput of the exported and the eager model (default: False)")
+parser.add_argument('--bench-batch', type=int, default=32,
+                    help="batch size of the benchmark (default: 32)")
+parser.add_argument('--bench-iters', type=int, default=10,
+                    help="iterations of the benchmark (default: 10)")
+
+
+def main(args):
+    args = parser.parse_args(args)
+    print("Initializing model: {}".format(args.arch))
+    extractor = build_feature_extractor(args.arch, fpath=args.load_weights, num_classes=args.num_classes, fold=not args.no_fold_bn)
+    eager = extractor
+    if not args.no_fold_bn:
+        # unfolded model, to check the folding and to benchmark against
+        eager = build_feature_extractor(args.arch, fpath=args.load_weights, num_classes=args.num_classes, fold=False)
+    traced = export_feature_extractor(extractor, args.save_dir, height=args.height, width=args.width,
+                                      formats=args.formats, reference=eager if eager is not extractor else None)
+    if args.benchmark:
+        for name, model in [('eager', eager), ('eager + folded BN', extractor), ('traced', traced)]:
+            speed = benchmark(model, height=args.height, width=args.width,
+                              batch_size=args.bench_batch, num_iters=args.bench_iters)
+            print("{}: {:.1f} images/s".format(name, speed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,47 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import argparse
+import os.path as osp
+
+from torchreid import data_manager
+from torchreid.dataset_loader_shards import pack_dataset
+
+parser = argparse.ArgumentParser(description='Pack the images of a dataset into memory-mapped shards')
+# Datasets
+parser.add_argument('--root', type=str, default='data',
+                    help="root path to data directory")
+parser.add_argument('-d', '--dataset', type=str, default='market1501',
+                    choices=data_manager.get_names())
+parser.add_argument('--split-id', type=int, default=0,
+                    help="split index (0-based)")
+# CUHK03-specific setting
+parser.add_argument('--cuhk03-labeled', action='store_true',
+                    help="use labeled images, if false, detected images are used (default: False)")
+parser.add_argument('--cuhk03-classic-split', action='store_true',
+                    help="use classic split by Li et al. CVPR'14 (default: False)")
+# Shards
+parser.add_argument('--save-dir', type=str, default='',
+                    help="output directory (default: <root>/shards/<dataset>)")
+parser.add_argument('--splits', type=str, nargs='+', default=['train', 'query', 'gallery'],
+                    help="splits to pack (default: train query gallery)")
+parser.add_argument('--shard-size', type=int, default=1024,
+                    help="size of a shard file in MB (default: 1024)")
+
+
+def main(args):
+    args = parser.parse_args(args)
+    if args.dataset in ['mars', 'ilidsvid', 'prid2011', 'dukemtmcvidreid']:
+        dataset = data_manager.init_vidreid_dataset(root=args.root, name=args.dataset, split_id=args.split_id)
+    else:
+        dataset = data_manager.init_imgreid_dataset(
+            root=args.root, name=args.dataset, split_id=args.split_id,
+            cuhk03_labeled=args.cuhk03_labeled, cuhk03_classic_split=args.cuhk03_classic_split,
+        )
+    save_dir = args.save_dir or osp.join(args.root, 'shards', args.dataset)
+    pack_dataset(dataset, save_dir, splits=args.splits, shard_size=args.shard_size * 2**20)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import argparse
+import os.path as osp
+
+import torch
+from torch.utils.data import DataLoader
+
+from torchreid import data_manager
+from torchreid.dataset_loader import ImageDataset
+from torchreid import transforms as T
+from torchreid import models
+from torchreid.export import build_feature_extractor
+from torchreid.quantization import calibration_subset, quantize_feature_extractor, extract_features
+from torchreid.utils.iotools import mkdir_if_missing
+from torchreid.utils.distance import compute_distmat
+from torchreid.eval_metrics import evaluate
+
+parser = argparse.ArgumentParser(description='Post-training int8 quantization of the feature extractor of a trained model')
+# Datasets
+parser.add_argument('--root', type=str, default='data',
+                    help="root path to data directory")
+parser.add_argument('-d', '--dataset', type=str, default='market1501',
+                    choices=data_manager.get_names())
+parser.add_argument('-j', '--workers', default=4, type=int,
+                    help="number of data loading workers (default: 4)")
+parser.add_argument('--height', type=int, default=256,
+                    help="height of an image (default: 256)")
+parser.add_argument('--width', type=int, default=128,
+                    help="width of an image (default: 128)")
+parser.add_argument('--split-id', type=int, default=0,
+                    help="split index (0-based)")
+# CUHK03-specific setting
+parser.add_argument('--cuhk03-labeled', action='store_true',
+                    help="use labeled images, if false, detected images are used (default: False)")
+parser.add_argument('--cuhk03-classic-split', action='store_true',
+                    help="use classic split by Li et al. CVPR'14 (default: False)")
+parser.add_argument('--use-metric-cuhk03', action='store_true',
+                    help="use cuhk03-metric (default: False)")
+# Model
+parser.add_argument('-a', '--arch', type=str, default='resnet50', choices=models.get_names())
+parser.add_argument('--load-weights', type=str, default='',
+                    help="checkpoint saved by the training scripts")
+parser.add_argument('--num-classes', type=int, default=None,
+                    help="number of training identities (default: read from the checkpoint)")
+# Quantization
+parser.add_argument('--num-calib', type=int, default=300,
+                    help="number of training images used for calibration (default: 300)")
+parser.add_argument('--calib-batch', type=int, default=32,
+                    help="calibration batch size (default: 32)")
+parser.add_argument('--backend', type=str, default='x86', choices=torch.backends.quantized.supported_engines,
+                    help="quantized engine, x86/fbgemm for x86 cpus, qnnpack for ARM (default: x86)")
+parser.add_argument('--test-batch', default=100, type=int,
+                    help="test batch size")
+parser.add_argument('--seed', type=int, default=1,
+                    help="seed of the calibration image selection")
+parser.add_argument('--save-dir', type=str, default='log/quantize')
+
+
+def test(model, queryloader, galleryloader, args, ranks=[1, 5, 10, 20]):
+    qf, q_pids, q_camids, q_time = extract_features(model, queryloader)
+    gf, g_pids, g_camids, g_time = extract_features(model, galleryloader)
+    num_imgs = qf.size(0) + gf.size(0)
+    print("Extracted features for {} images, {:.1f} images/s".format(num_imgs, num_imgs / (q_time + g_time)))
+
+    distmat = compute_distmat(qf, gf).numpy()
+    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, use_metric_cuhk03=args.use_metric_cuhk03)
+    print("mAP: {:.1%}".format(mAP))
+    for r in ranks:
+        print("Rank-{:<3}: {:.1%}".format(r, cmc[r-1]))
+    return cmc, mAP
+
+
+def main(args):
+    args = parser.parse_args(args)
+    torch.manual_seed(args.seed)
+
+    print("Initializing dataset {}".format(args.dataset))
+    dataset = data_manager.init_imgreid_dataset(
+        root=args.root, name=args.dataset, split_id=args.split_id,
+        cuhk03_labeled=args.cuhk03_labeled, cuhk03_classic_split=args.cuhk03_classic_split,
+    )
+
+    transform_test = T.Compose([
+        T.Resize((args.height, args.width)),
+        T.ToTensor(),
+        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+
+    calibloader = DataLoader(
+        ImageDataset(calibration_subset(dataset.train, args.num_calib, seed=args.seed), transform=transform_test),
+        batch_size=args.calib_batch, shuffle=False, num_workers=args.workers, drop_last=False,
+    )
+
+    queryloader = DataLoader(
+        ImageDataset(dataset.query, transform=transform_test),
+        batch_size=args.test_batch, shuffle=False, num_workers=args.workers, drop_last=False,
+    )
+
+    galleryloader = DataLoader(
+        ImageDataset(dataset.gallery, transform=transform_test),
+        batch_size=args.test_batch, shuffle=False, num_workers=args.workers, drop_last=False,
+    )
+
+    print("Initializing model: {}".format(args.arch))
+    # conv, BatchNorm and ReLU are fused by the quantization, the float model keeps them apart
+    extractor = build_feature_extractor(args.arch, fpath=args.load_weights, num_classes=args.num_classes, fold=False)
+
+    print("==> Float model")
+    test(extractor, queryloader, galleryloader, args)
+
+    print("==> Quantizing ({} backend)".format(args.backend))
+    quantized = quantize_feature_extractor(extractor, calibloader, backend=args.backend)
+
+    print("==> Int8 model")
+    test(quantized, queryloader, galleryloader, args)
+
+    mkdir_if_missing(args.save_dir)
+    fpath = osp.join(args.save_dir, 'feature_extractor_int8.pt')
+    with torch.no_grad():
+        torch.jit.trace(quantized, torch.randn(2, 3, args.height, args.width)).save(fpath)
+    print("Int8 TorchScript feature extractor saved to '{}'".format(fpath))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
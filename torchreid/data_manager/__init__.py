@@ -21,6 +21,9 @@ from .dukemtmcvidreid import DukeMTMCVidReID
 from .cars196 import Cars196
 from .stanford_products import StanforOnlineProducts
 from .cub200_2011 import CUB200_2011
+
+from .table import DatasetTable, compact_dataset
+
 __imgreid_factory = {
     'market1501': Market1501,
     'cuhk03': CUHK03,
@@ -50,13 +53,21 @@ def get_names():
     return list(__imgreid_factory.keys()) + list(__vidreid_factory.keys())
 
 
-def init_imgreid_dataset(name, **kwargs):
+def init_imgreid_dataset(name, compact=False, **kwargs):
+    """compact=True returns the splits as DatasetTables instead of lists of tuples."""
     if name not in list(__imgreid_factory.keys()):
         raise KeyError("Invalid dataset, got '{}', but expected to be one of {}".format(name, list(__imgreid_factory.keys())))
-    return __imgreid_factory[name](**kwargs)
+    dataset = __imgreid_factory[name](**kwargs)
+    if compact:
+        compact_dataset(dataset)
+    return dataset
 
 
-def init_vidreid_dataset(name, **kwargs):
+def init_vidreid_dataset(name, compact=False, **kwargs):
+    """compact=True returns the splits as DatasetTables instead of lists of tuples."""
     if name not in list(__vidreid_factory.keys()):
         raise KeyError("Invalid dataset, got '{}', but expected to be one of {}".format(name, list(__vidreid_factory.keys())))
-    return __vidreid_factory[name](**kwargs)
+    dataset = __vidreid_factory[name](**kwargs)
+    if compact:
+        compact_dataset(dataset)
+    return dataset
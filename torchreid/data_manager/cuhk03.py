@@ -15,9 +15,58 @@ import numpy as np
 import h5py
 from scipy.misc import imsave
 
+from multiprocessing import Pool, cpu_count
+
 from torchreid.utils.iotools import mkdir_if_missing, write_json, read_json
 
 
+def _extract_camera_pair(task):
+    """Extracts the images of one camera pair of cuhk-03.mat and saves them as png.
+    Runs in a worker process. A marker listing the saved images is written once the
+    whole camera pair is done and a camera pair with a marker is skipped, so an
+    interrupted extraction resumes from the unfinished camera pairs.
+
+    Args:
+    - task: (raw_mat_path, name, campid, imgs_dir), name is 'detected' or 'labeled'.
+
+    Returns a list of (campid+1, pid+1, img_paths).
+    """
+    raw_mat_path, name, campid, imgs_dir = task
+    marker_path = osp.join(imgs_dir, '.camera_pair_{}.json'.format(campid+1))
+    if osp.exists(marker_path):
+        return [tuple(item) for item in read_json(marker_path)]
+
+    mat = h5py.File(raw_mat_path, 'r')
+    camp = mat[mat[name][0][campid]][:].T
+    num_pids = camp.shape[0]
+    meta_data = []
+    for pid in range(num_pids):
+        img_paths = [] # Note: some persons only have images for one view
+        for imgid, img_ref in enumerate(camp[pid,:]):
+            img = mat[img_ref][:].T
+            # skip empty cell
+            if img.size == 0 or img.ndim < 3: continue
+            # images are saved with the following format, index-1 (ensure uniqueness)
+            # campid: index of camera pair (1-5)
+            # pid: index of person in 'campid'-th camera pair
+            # viewid: index of view, {1, 2}
+            # imgid: index of image, (1-10)
+            viewid = 1 if imgid < 5 else 2
+            img_name = '{:01d}_{:03d}_{:01d}_{:02d}.png'.format(campid+1, pid+1, viewid, imgid+1)
+            img_path = osp.join(imgs_dir, img_name)
+            imsave(img_path, img)
+            img_paths.append(img_path)
+        assert len(img_paths) > 0, "campid{}-pid{} has no images".format(campid, pid)
+        meta_data.append((campid+1, pid+1, img_paths))
+    mat.close()
+
+    tmp_path = marker_path + '.tmp'
+    write_json(meta_data, tmp_path)
+    os.rename(tmp_path, marker_path)
+    print("done {} camera pair {} with {} identities".format(name, campid+1, num_pids))
+    return meta_data
+
+
 class CUHK03(object):
     """
     CUHK03
@@ -36,11 +85,14 @@ class CUHK03(object):
     Args:
         split_id (int): split index (default: 0)
         cuhk03_labeled (bool): whether to load labeled images; if false, detected images are loaded (default: False)
+        preprocess_workers (int): number of processes extracting the images from cuhk-03.mat on first use (default: number of cpus)
     """
     dataset_dir = 'cuhk03'
 
-    def __init__(self, root='data', split_id=0, cuhk03_labeled=False, cuhk03_classic_split=False, verbose=True, **kwargs):
+    def __init__(self, root='data', split_id=0, cuhk03_labeled=False, cuhk03_classic_split=False, verbose=True,
+                 preprocess_workers=None, **kwargs):
         super(CUHK03, self).__init__()
+        self.preprocess_workers = preprocess_workers or cpu_count()
         self.dataset_dir = osp.join(root, self.dataset_dir)
         self.data_dir = osp.join(self.dataset_dir, 'cuhk03_release')
         self.raw_mat_path = osp.join(self.data_dir, 'cuhk-03.mat')
@@ -141,52 +193,43 @@ class CUHK03(object):
 
         print("Extract image data from {} and save as png".format(self.raw_mat_path))
         mat = h5py.File(self.raw_mat_path, 'r')
+        num_camera_pairs = {name: len(mat[name][0]) for name in ['detected', 'labeled']}
+        mat.close() # workers open their own handle, h5py files can't be shared across fork
+
+        # one task per camera pair, finished camera pairs are skipped (see _extract_camera_pair)
+        tasks = []
+        for name in ['detected', 'labeled']:
+            imgs_dir = self.imgs_detected_dir if name == 'detected' else self.imgs_labeled_dir
+            for campid in range(num_camera_pairs[name]):
+                tasks.append((self.raw_mat_path, name, campid, imgs_dir))
+        num_workers = min(self.preprocess_workers, len(tasks))
+        if num_workers > 1:
+            pool = Pool(num_workers)
+            results = pool.map(_extract_camera_pair, tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = [_extract_camera_pair(task) for task in tasks]
+
+        meta_detected, meta_labeled = [], []
+        for task, meta_data in zip(tasks, results):
+            if task[1] == 'detected':
+                meta_detected.extend(meta_data)
+            else:
+                meta_labeled.extend(meta_data)
+
+        mat = h5py.File(self.raw_mat_path, 'r')
 
         def _deref(ref):
             return mat[ref][:].T
 
-        def _process_images(img_refs, campid, pid, save_dir):
-            img_paths = [] # Note: some persons only have images for one view
-            for imgid, img_ref in enumerate(img_refs):
-                img = _deref(img_ref)
-                # skip empty cell
-                if img.size == 0 or img.ndim < 3: continue
-                # images are saved with the following format, index-1 (ensure uniqueness)
-                # campid: index of camera pair (1-5)
-                # pid: index of person in 'campid'-th camera pair
-                # viewid: index of view, {1, 2}
-                # imgid: index of image, (1-10)
-                viewid = 1 if imgid < 5 else 2
-                img_name = '{:01d}_{:03d}_{:01d}_{:02d}.png'.format(campid+1, pid+1, viewid, imgid+1)
-                img_path = osp.join(save_dir, img_name)
-                imsave(img_path, img)
-                img_paths.append(img_path)
-            return img_paths
-
-        def _extract_img(name):
-            print("Processing {} images (extract and save) ...".format(name))
-            meta_data = []
-            imgs_dir = self.imgs_detected_dir if name == 'detected' else self.imgs_labeled_dir
-            for campid, camp_ref in enumerate(mat[name][0]):
-                camp = _deref(camp_ref)
-                num_pids = camp.shape[0]
-                for pid in range(num_pids):
-                    img_paths = _process_images(camp[pid,:], campid, pid, imgs_dir)
-                    assert len(img_paths) > 0, "campid{}-pid{} has no images".format(campid, pid)
-                    meta_data.append((campid+1, pid+1, img_paths))
-                print("done camera pair {} with {} identities".format(campid+1, num_pids))
-            return meta_data
-
-        meta_detected = _extract_img('detected')
-        meta_labeled = _extract_img('labeled')
-
         def _extract_classic_split(meta_data, test_split):
             train, test = [], []
             num_train_pids, num_test_pids = 0, 0
             num_train_imgs, num_test_imgs = 0, 0
             for i, (campid, pid, img_paths) in enumerate(meta_data):
                 
-                if [campid, pid] in test_split:
+                if (campid, pid) in test_split:
                     for img_path in img_paths:
                         camid = int(osp.basename(img_path).split('_')[2])
                         test.append((img_path, num_test_pids, camid))
@@ -203,7 +246,7 @@ class CUHK03(object):
         print("Creating classic splits (# = 20) ...")
         splits_classic_det, splits_classic_lab = [], []
         for split_ref in mat['testsets'][0]:
-            test_split = _deref(split_ref).tolist()
+            test_split = set(tuple(camp_pid) for camp_pid in _deref(split_ref).tolist())
 
             # create split for detected images
             train, num_train_pids, num_train_imgs, test, num_test_pids, num_test_imgs = \
@@ -225,6 +268,8 @@ class CUHK03(object):
                 'num_gallery_pids': num_test_pids, 'num_gallery_imgs': num_test_imgs,
             })
         
+        mat.close()
+
         write_json(splits_classic_det, self.split_classic_det_json_path)
         write_json(splits_classic_lab, self.split_classic_lab_json_path)
 
@@ -15,7 +15,7 @@ import numpy as np
 import h5py
 from scipy.misc import imsave
 
-from torchreid.utils.iotools import mkdir_if_missing
+from torchreid.utils.iotools import mkdir_if_missing, load_manifest
 
 
 class DukeMTMCreID(object):
@@ -102,22 +102,18 @@ class DukeMTMCreID(object):
             raise RuntimeError("'{}' is not available".format(self.gallery_dir))
 
     def _process_dir(self, dir_path, relabel=False):
-        img_paths = glob.glob(osp.join(dir_path, '*.jpg'))
         pattern = re.compile(r'([-\d]+)_c(\d)')
+        img_paths, pids, camids = load_manifest(dir_path, lambda img_path: tuple(map(int, pattern.search(img_path).groups())))
 
-        pid_container = set()
-        for img_path in img_paths:
-            pid, _ = map(int, pattern.search(img_path).groups())
-            pid_container.add(pid)
-        pid2label = {pid:label for label, pid in enumerate(pid_container)}
-
-        dataset = []
-        for img_path in img_paths:
-            pid, camid = map(int, pattern.search(img_path).groups())
-            assert 1 <= camid <= 8
-            camid -= 1 # index starts from 0
-            if relabel: pid = pid2label[pid]
-            dataset.append((img_path, pid, camid))
+        assert np.all((1 <= camids) & (camids <= 8))
+        camids = camids - 1 # index starts from 0
+
+        pids = pids.tolist()
+        pid_container = set(pids)
+        if relabel:
+            pid2label = {pid:label for label, pid in enumerate(pid_container)}
+            pids = [pid2label[pid] for pid in pids]
+        dataset = list(zip(img_paths, pids, camids.tolist()))
 
         num_pids = len(pid_container)
         num_imgs = len(dataset)
@@ -15,6 +15,8 @@ import numpy as np
 import h5py
 from scipy.misc import imsave
 
+from torchreid.utils.iotools import load_manifest
+
 
 class Market1501(object):
     """
@@ -79,25 +81,22 @@ class Market1501(object):
             raise RuntimeError("'{}' is not available".format(self.gallery_dir))
 
     def _process_dir(self, dir_path, relabel=False):
-        img_paths = glob.glob(osp.join(dir_path, '*.jpg'))
         pattern = re.compile(r'([-\d]+)_c(\d)')
-
-        pid_container = set()
-        for img_path in img_paths:
-            pid, _ = map(int, pattern.search(img_path).groups())
-            if pid == -1: continue  # junk images are just ignored
-            pid_container.add(pid)
-        pid2label = {pid:label for label, pid in enumerate(pid_container)}
-
-        dataset = []
-        for img_path in img_paths:
-            pid, camid = map(int, pattern.search(img_path).groups())
-            if pid == -1: continue  # junk images are just ignored
-            assert 0 <= pid <= 1501  # pid == 0 means background
-            assert 1 <= camid <= 6
-            camid -= 1 # index starts from 0
-            if relabel: pid = pid2label[pid]
-            dataset.append((img_path, pid, camid))
+        img_paths, pids, camids = load_manifest(dir_path, lambda img_path: tuple(map(int, pattern.search(img_path).groups())))
+
+        keep = pids != -1 # junk images are just ignored
+        img_paths = [img_path for img_path, k in zip(img_paths, keep.tolist()) if k]
+        pids, camids = pids[keep], camids[keep]
+        assert np.all((0 <= pids) & (pids <= 1501)) # pid == 0 means background
+        assert np.all((1 <= camids) & (camids <= 6))
+        camids = camids - 1 # index starts from 0
+
+        pids = pids.tolist()
+        pid_container = set(pids)
+        if relabel:
+            pid2label = {pid:label for label, pid in enumerate(pid_container)}
+            pids = [pid2label[pid] for pid in pids]
+        dataset = list(zip(img_paths, pids, camids.tolist()))
 
         num_pids = len(pid_container)
         num_imgs = len(dataset)
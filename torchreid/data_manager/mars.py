@@ -50,7 +50,7 @@ class Mars(object):
         query_IDX = loadmat(self.query_IDX_path)['query_IDX'].squeeze() # numpy.ndarray (1980,)
         query_IDX -= 1 # index from 0
         track_query = track_test[query_IDX,:]
-        gallery_IDX = [i for i in range(track_test.shape[0]) if i not in query_IDX]
+        gallery_IDX = np.setdiff1d(np.arange(track_test.shape[0]), query_IDX)
         track_gallery = track_test[gallery_IDX,:]
 
         train, num_train_tracklets, num_train_pids, num_train_imgs = \
@@ -16,6 +16,8 @@ import h5py
 from scipy.misc import imsave
 import copy
 
+from torchreid.utils.iotools import load_manifest
+
 
 class SenseReID(object):
     """
@@ -81,16 +83,10 @@ class SenseReID(object):
             raise RuntimeError("'{}' is not available".format(self.gallery_dir))
 
     def _process_dir(self, dir_path):
-        img_paths = glob.glob(osp.join(dir_path, '*.jpg'))
-        dataset = []
-        pid_container = set()
-
-        for img_path in img_paths:
-            img_name = osp.splitext(osp.basename(img_path))[0]
-            pid, camid = img_name.split('_')
-            pid, camid = int(pid), int(camid)
-            dataset.append((img_path, pid, camid))
-            pid_container.add(pid)
+        img_paths, pids, camids = load_manifest(dir_path, lambda img_path: tuple(map(int, osp.splitext(osp.basename(img_path))[0].split('_'))))
+        pids = pids.tolist()
+        dataset = list(zip(img_paths, pids, camids.tolist()))
+        pid_container = set(pids)
 
         num_pids = len(pid_container)
         num_imgs = len(dataset)
@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class DatasetTable(object):
+    """Read-only columnar version of the (img_path, pid, camid) lists built by the
+    dataset classes, and of the (img_paths, pid, camid) lists of video datasets.
+
+    All paths are utf-8 encoded into one uint8 blob addressed by offsets, pids and
+    camids are int32 arrays. DataLoader workers forked from the main process only
+    read these few arrays, instead of touching (and copying on write) the pages of
+    every tuple and string of a list. table[i] returns the same tuple as the list.
+
+    Args:
+    - blob: uint8 array holding all encoded paths.
+    - path_offsets: int64 array, path j is blob[path_offsets[j]:path_offsets[j+1]].
+    - pids, camids: int32 arrays, one entry per item.
+    - item_offsets: for video tables, int64 array, item i holds the paths
+      item_offsets[i] to item_offsets[i+1]. None for image tables.
+    """
+    def __init__(self, blob, path_offsets, pids, camids, item_offsets=None):
+        self.blob = blob
+        self.path_offsets = path_offsets
+        self.pids = pids
+        self.camids = camids
+        self.item_offsets = item_offsets
+
+    @classmethod
+    def from_list(cls, dataset):
+        """Builds a table from a list of (img_path, pid, camid) or (img_paths, pid, camid)."""
+        is_video = len(dataset) > 0 and isinstance(dataset[0][0], (tuple, list))
+        encoded = []
+        item_offsets = [0]
+        for item in dataset:
+            if is_video:
+                encoded.extend(img_path.encode('utf-8') for img_path in item[0])
+                item_offsets.append(len(encoded))
+            else:
+                encoded.append(item[0].encode('utf-8'))
+        path_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in encoded], out=path_offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        pids = np.asarray([item[1] for item in dataset], dtype=np.int32)
+        camids = np.asarray([item[2] for item in dataset], dtype=np.int32)
+        item_offsets = np.asarray(item_offsets, dtype=np.int64) if is_video else None
+        return cls(blob, path_offsets, pids, camids, item_offsets=item_offsets)
+
+    @property
+    def is_video(self):
+        return self.item_offsets is not None
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("DatasetTable index out of range")
+        if self.is_video:
+            start, end = self.item_offsets[index], self.item_offsets[index + 1]
+            img_path = tuple(self.path(j) for j in range(start, end))
+        else:
+            img_path = self.path(index)
+        return img_path, int(self.pids[index]), int(self.camids[index])
+
+    def path(self, j):
+        """Returns the j-th stored path."""
+        return self.blob[self.path_offsets[j]:self.path_offsets[j + 1]].tobytes().decode('utf-8')
+
+    def tolist(self):
+        return list(self)
+
+
+def compact_dataset(dataset, splits=('train', 'query', 'gallery')):
+    """Replaces the train/query/gallery lists of a dataset object by DatasetTables.
+    Splits which are not lists of (img_path(s), pid, camid), like the bounding box
+    lists of the retrieval datasets, are left as they are.
+    """
+    for split in splits:
+        items = getattr(dataset, split, None)
+        if not isinstance(items, list):
+            continue
+        if not all(len(item) == 3 for item in items):
+            continue
+        setattr(dataset, split, DatasetTable.from_list(items))
+    return dataset
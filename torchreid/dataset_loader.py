@@ -3,50 +3,146 @@ from __future__ import print_function
 from __future__ import division
 
 import os
+import time
+import errno
 from PIL import Image
 import numpy as np
 import os.path as osp
 import io
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 
 import pdb
 
-def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
-    if not osp.exists(img_path):
-        raise IOError("{} does not exist".format(img_path))
-    while not got_img:
+# images which could not be read, kept per process so they fail at once afterwards
+_quarantined = {}
+_quarantine_file = None
+
+
+def set_quarantine_file(fpath):
+    """Appends every quarantined image to fpath (one 'path<TAB>error' line), from all processes.
+    Call it before creating the DataLoaders so the workers inherit it."""
+    global _quarantine_file
+    _quarantine_file = fpath
+
+
+def quarantine_report():
+    """Returns {img_path: error} of the quarantined images. With set_quarantine_file, this
+    includes the images quarantined by the other processes (e.g. the DataLoader workers),
+    which are added to the quarantine of this process: workers created afterwards (the
+    next epochs) inherit it and skip them at once."""
+    if _quarantine_file is not None and osp.exists(_quarantine_file):
+        with open(_quarantine_file) as f:
+            for line in f:
+                img_path, _, error = line.rstrip('\n').partition('\t')
+                _quarantined.setdefault(img_path, error)
+    return dict(_quarantined)
+
+
+def read_image(img_path, max_retries=4, retry_delay=0.05, draft_size=None):
+    """Reads an image as RGB, retrying with exponential backoff on IOError.
+    This can avoid IOError incurred by heavy IO process. A file which still can't be
+    read (missing, truncated or corrupt) is quarantined: it is reported once, and reading
+    it again in the same process fails at once instead of retrying.
+
+    Args:
+    - img_path: image path.
+    - max_retries: number of retries after a failed read (not for missing files).
+    - retry_delay: seconds before the first retry, doubled for every retry.
+    - draft_size: optional (width, height), JPEGs are decoded at the smallest 1/2, 1/4
+      or 1/8 scale which is still at least this large (PIL draft mode), which is much
+      cheaper for large images. The transforms still resize to the final size.
+    """
+    if img_path in _quarantined:
+        raise IOError("{} is quarantined: {}".format(img_path, _quarantined[img_path]))
+    delay = retry_delay
+    for attempt in range(max_retries + 1):
         try:
-            img = Image.open(img_path).convert('RGB')
-            got_img = True
-        except IOError:
-            print("IOError incurred when reading '{}'. Will redo. Don't worry. Just chill.".format(img_path))
-            pass
-    return img
+            img = Image.open(img_path)
+            if draft_size is not None:
+                img.draft('RGB', draft_size)
+            return img.convert('RGB')
+        except IOError as e:
+            error = e
+            if e.errno == errno.ENOENT:
+                error = "{} does not exist".format(img_path)
+                break
+            if attempt < max_retries:
+                time.sleep(delay)
+                delay *= 2
+    _quarantine(img_path, str(error))
+    raise IOError("{} is quarantined: {}".format(img_path, error))
+
+
+def _quarantine(img_path, error):
+    _quarantined[img_path] = error
+    print("=> Warning: can't read '{}', quarantined ({})".format(img_path, error))
+    if _quarantine_file is not None:
+        with open(_quarantine_file, 'a') as f:
+            f.write("{}\t{}\n".format(img_path, error))
 
 
 class ImageDataset(Dataset):
-    """Image Person ReID Dataset"""
-    def __init__(self, dataset, transform=None):
+    """Image Person ReID Dataset
+
+    An image which can't be read (see read_image) raises IOError. With replace_unreadable,
+    it is replaced by another image of the same identity, or by another image of the
+    dataset if there is none, and the item is the (img, pid, camid) of the replacement.
+    This is only meant for training: query and gallery items must not change.
+
+    Args:
+    - draft_size: see read_image, (width, height) to decode large JPEGs at a reduced scale.
+    - replace_unreadable: replace the unreadable images instead of raising IOError.
+    """
+    def __init__(self, dataset, transform=None, draft_size=None, replace_unreadable=False):
         self.dataset = dataset
         self.transform = transform
+        self.draft_size = draft_size
+        self.replace_unreadable = replace_unreadable
+        self.pid_index = None
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, index):
-        img_path, pid, camid = self.dataset[index]
-        img = read_image(img_path)
+        candidates = None
+        while True:
+            img_path, pid, camid = self.dataset[index]
+            try:
+                img = read_image(img_path, draft_size=self.draft_size)
+                break
+            except IOError:
+                if not self.replace_unreadable:
+                    raise
+                if candidates is None:
+                    candidates = self.replacements(index, pid)
+                index = next(candidates, None)
+                if index is None:
+                    raise
 
         if self.transform is not None:
             img = self.transform(img)
 
         return img, pid, camid
 
+    def replacements(self, index, pid):
+        """Iterator over the replacements of the unreadable image index: the other images
+        of identity pid, then the other images of the dataset."""
+        if self.pid_index is None:
+            self.pid_index = {}
+            for i, (_, item_pid, _) in enumerate(self.dataset):
+                self.pid_index.setdefault(item_pid, []).append(i)
+        same_pid = self.pid_index.get(pid, [])
+        for i in same_pid:
+            if i != index:
+                yield i
+        same_pid = set(same_pid)
+        for offset in range(1, len(self.dataset)):
+            i = (index + offset) % len(self.dataset)
+            if i not in same_pid:
+                yield i
+
 
 class VideoDataset(Dataset):
     """Video Person ReID Dataset.
@@ -65,8 +161,22 @@ class VideoDataset(Dataset):
 
     def __getitem__(self, index):
         img_paths, pid, camid = self.dataset[index]
-        num = len(img_paths)
+        indices = self.sample_indices(len(img_paths))
+
+        imgs = []
+        for index in indices:
+            img_path = img_paths[int(index)]
+            img = self.read_image(img_path)
+            if self.transform is not None:
+                img = self.transform(img)
+            img = img.unsqueeze(0)
+            imgs.append(img)
+        imgs = torch.cat(imgs, dim=0)
 
+        return imgs, pid, camid
+
+    def sample_indices(self, num):
+        """Indices of the frames to load from a tracklet of num frames."""
         if self.sample == 'random':
             """
             Randomly sample seq_len items from num items,
@@ -99,15 +209,23 @@ class VideoDataset(Dataset):
             indices = np.arange(num)
         else:
             raise KeyError("Unknown sample method: {}. Expected one of {}".format(self.sample, self.sample_methods))
+        return indices
 
-        imgs = []
-        for index in indices:
-            img_path = img_paths[int(index)]
-            img = read_image(img_path)
-            if self.transform is not None:
-                img = self.transform(img)
-            img = img.unsqueeze(0)
-            imgs.append(img)
-        imgs = torch.cat(imgs, dim=0)
+    def read_image(self, img_path):
+        return read_image(img_path)
 
-        return imgs, pid, camid
+
+def eval_loaders(dataset, image_dataset, batch_size, num_workers=4, pin_memory=False):
+    """Returns the (queryloader, galleryloader) of the test() functions.
+
+    Args:
+    - dataset: data_manager dataset.
+    - image_dataset: function building the Dataset of a list of (img_path, pid, camid),
+      e.g. partial(ImageDataset, transform=transform_test).
+    - batch_size: test batch size.
+    """
+    return tuple(DataLoader(
+        image_dataset(getattr(dataset, split)),
+        batch_size=batch_size, shuffle=False, num_workers=num_workers,
+        pin_memory=pin_memory, drop_last=False,
+    ) for split in ('query', 'gallery'))
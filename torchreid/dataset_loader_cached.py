@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import os.path as osp
+import hashlib
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+from torchvision.transforms import Resize
+
+from .dataset_loader import read_image
+from .utils.iotools import mkdir_if_missing, read_json, write_json
+
+
+def build_decoded_cache(dataset, cache_path, height, width, read_fn=read_image):
+    """Decodes and resizes every image of dataset once into a uint8 (N, height, width, 3)
+    .npy file, resized the same way as transform_test (Resize((height, width))).
+
+    Args:
+    - dataset: list of (img_path, pid, camid).
+    - cache_path: output .npy path, a .json next to it records which images it holds.
+    - read_fn: function loading an RGB PIL image from a path.
+    """
+    mkdir_if_missing(osp.dirname(cache_path))
+    resize = Resize((height, width))
+    tmp_path = cache_path + '.tmp.npy'
+    imgs = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(dataset), height, width, 3))
+    for i, item in enumerate(dataset):
+        imgs[i] = np.asarray(resize(read_fn(item[0])), dtype=np.uint8)
+    imgs.flush()
+    del imgs
+    os.rename(tmp_path, cache_path)
+    write_json({'num_imgs': len(dataset), 'paths_sha1': _paths_sha1(dataset)}, osp.splitext(cache_path)[0] + '.json')
+
+
+def _paths_sha1(dataset):
+    sha1 = hashlib.sha1()
+    for item in dataset:
+        sha1.update(item[0].encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class CachedImageDataset(Dataset):
+    """Evaluation dataset reading pre-decoded, pre-resized uint8 images from a memmap.
+    The cache is built on first use and keyed by (name, split, height, width), so only the
+    first evaluation decodes JPEGs. Samples are HxWx3 uint8 arrays, pass collate_fn=dataset.collate
+    to the DataLoader to get normalized (batch, 3, height, width) float tensors like transform_test.
+
+    Args:
+    - dataset: list of (img_path, pid, camid).
+    - cache_dir: directory holding the caches.
+    - name: dataset name.
+    - split: split name, e.g. 'query' or 'gallery'.
+    - height, width: image size after resizing.
+    - mean, std: normalization applied in collate.
+    - return_path: also return the image path.
+    - read_fn: function loading an RGB PIL image from a path (default: read_image).
+    """
+    def __init__(self, dataset, cache_dir, name, split, height, width,
+                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], return_path=False, read_fn=read_image):
+        self.dataset = dataset
+        self.return_path = return_path
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+
+        cache_path = osp.join(cache_dir, '{}_{}_{}x{}.npy'.format(name, split, height, width))
+        meta_path = osp.splitext(cache_path)[0] + '.json'
+        valid = osp.isfile(cache_path) and osp.isfile(meta_path)
+        if valid:
+            meta = read_json(meta_path)
+            valid = meta['num_imgs'] == len(dataset) and meta['paths_sha1'] == _paths_sha1(dataset)
+        if not valid:
+            print("Decoding {} {} images into '{}'".format(len(dataset), split, cache_path))
+            build_decoded_cache(dataset, cache_path, height, width, read_fn=read_fn)
+        self.imgs = np.load(cache_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img_path, pid, camid = self.dataset[index]
+        img = self.imgs[index]
+        if self.return_path:
+            return img, pid, camid, img_path
+        return img, pid, camid
+
+    def collate(self, batch):
+        """Stacks a batch and applies ToTensor + Normalize to the whole batch at once."""
+        fields = list(zip(*batch))
+        imgs = torch.from_numpy(np.stack(fields[0]))
+        imgs = imgs.permute(0, 3, 1, 2).float().div_(255)
+        imgs = imgs.sub_(self.mean).div_(self.std)
+        out = [imgs, torch.tensor(fields[1]), torch.tensor(fields[2])]
+        if self.return_path:
+            out.append(list(fields[3]))
+        return out
+
+
+def cached_eval_loaders(dataset, cache_dir, name, height, width, batch_size, return_path, pin_memory=False):
+    """Returns the (queryloader, galleryloader) of the test() functions over the
+    CachedImageDataset of dataset.query and dataset.gallery.
+
+    Args:
+    - dataset: data_manager dataset.
+    - cache_dir, name, height, width: see CachedImageDataset.
+    - batch_size: test batch size.
+    - return_path: the batches also hold the image paths, as test() expects when it
+      draws t-SNE plots (pass args.draw_tsne).
+    - pin_memory: see DataLoader.
+    """
+    loaders = []
+    for split in ('query', 'gallery'):
+        split_set = CachedImageDataset(getattr(dataset, split), cache_dir, name, split, height, width,
+                                       return_path=return_path)
+        loaders.append(DataLoader(
+            split_set, collate_fn=split_set.collate,
+            batch_size=batch_size, shuffle=False, num_workers=0,
+            pin_memory=pin_memory, drop_last=False,
+        ))
+    return tuple(loaders)
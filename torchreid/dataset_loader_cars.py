@@ -11,22 +11,9 @@ import io
 import torch
 from torch.utils.data import Dataset
 
-import pdb
+from .dataset_loader import read_image
 
-def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
-    if not osp.exists(img_path):
-        raise IOError("{} does not exist".format(img_path))
-    while not got_img:
-        try:
-            img = Image.open(img_path).convert('RGB')
-            got_img = True
-        except IOError:
-            print("IOError incurred when reading '{}'. Will redo. Don't worry. Just chill.".format(img_path))
-            pass
-    return img
+import pdb
 
 
 class ImageDataset(Dataset):
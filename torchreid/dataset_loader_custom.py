@@ -12,40 +12,32 @@ import torch
 from torch.utils.data import Dataset
 
 from .transforms import RandomHorizontalFlip_rot
+from .dataset_loader import read_image
 
 import pdb
 from collections import defaultdict
 import copy
 
-def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
-    if not osp.exists(img_path):
-        raise IOError("{} does not exist".format(img_path))
-    while not got_img:
-        try:
-            img = Image.open(img_path).convert('RGB')
-            got_img = True
-        except IOError:
-            print("IOError incurred when reading '{}'. Will redo. Don't worry. Just chill.".format(img_path))
-            pass
-    return img
-
 
 class ImageDataset(Dataset):
-    """Image Person ReID Dataset"""
-    def __init__(self, dataset, transform=None, return_path = False):
+    """Image Person ReID Dataset
+
+    Args:
+    - read_fn: function loading an RGB PIL image from a path (default: read_image), e.g.
+      ImageShards(shard_dir).read_path to read packed shards.
+    """
+    def __init__(self, dataset, transform=None, return_path = False, read_fn=read_image):
         self.dataset = dataset
         self.transform = transform
         self.return_path = return_path
+        self.read_fn = read_fn
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, index):
         img_path, pid, camid = self.dataset[index]
-        img = read_image(img_path)
+        img = self.read_fn(img_path)
         flipped = False
         if self.transform is not None:
             for t in self.transform.transforms:
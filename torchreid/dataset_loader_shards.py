@@ -0,0 +1,186 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+from PIL import Image
+import numpy as np
+import os.path as osp
+import io
+
+from torch.utils.data import Dataset
+
+from .dataset_loader import VideoDataset
+from .utils.iotools import mkdir_if_missing
+
+
+def pack_images(img_paths, save_dir, shard_size=2**30):
+    """Packs image files into a few large shard files, so training reads them from
+    memory-mapped shards instead of opening one file per sample.
+    The encoded bytes are copied as they are, images are not decoded or re-encoded.
+
+    Writes save_dir/shard-xxxxx.bin and save_dir/index.npz holding the path, shard,
+    offset and length of every image. Paths already in save_dir are skipped, so the
+    splits of a dataset can be packed one after the other.
+
+    Args:
+    - img_paths: list of image paths.
+    - save_dir: output directory.
+    - shard_size: a new shard is started once a shard holds this many bytes.
+    """
+    mkdir_if_missing(save_dir)
+    index_path = osp.join(save_dir, 'index.npz')
+    if osp.isfile(index_path):
+        index = np.load(index_path)
+        paths, shards = list(index['paths']), list(index['shards'])
+        offsets, lengths = list(index['offsets']), list(index['lengths'])
+    else:
+        paths, shards, offsets, lengths = [], [], [], []
+
+    known = set(paths)
+    new_paths = []
+    for img_path in img_paths:
+        if img_path not in known:
+            known.add(img_path)
+            new_paths.append(img_path)
+    if len(new_paths) == 0:
+        return
+
+    # always append to a fresh shard, existing shards are never rewritten
+    shard_id = max(shards) + 1 if shards else 0
+    shard_bytes = 0
+    f = open(osp.join(save_dir, 'shard-{:05d}.bin'.format(shard_id)), 'wb')
+    for img_path in new_paths:
+        if shard_bytes >= shard_size:
+            f.close()
+            shard_id += 1
+            shard_bytes = 0
+            f = open(osp.join(save_dir, 'shard-{:05d}.bin'.format(shard_id)), 'wb')
+        with open(img_path, 'rb') as img_f:
+            data = img_f.read()
+        f.write(data)
+        paths.append(img_path)
+        shards.append(shard_id)
+        offsets.append(shard_bytes)
+        lengths.append(len(data))
+        shard_bytes += len(data)
+    f.close()
+
+    # index is written last, an interrupted run leaves the previous index valid
+    tmp_path = osp.join(save_dir, 'index.tmp.npz')
+    np.savez(tmp_path, paths=np.asarray(paths), shards=np.asarray(shards, dtype=np.int32),
+             offsets=np.asarray(offsets, dtype=np.int64), lengths=np.asarray(lengths, dtype=np.int64))
+    os.rename(tmp_path, index_path)
+    print("Packed {} images into '{}' ({} in total)".format(len(new_paths), save_dir, len(paths)))
+
+
+def pack_dataset(dataset, save_dir, splits=('train', 'query', 'gallery'), shard_size=2**30):
+    """Packs the images of the given splits of a data_manager dataset (image or video)."""
+    for split in splits:
+        img_paths = []
+        for item in getattr(dataset, split):
+            if isinstance(item[0], (tuple, list)):
+                img_paths.extend(item[0])
+            else:
+                img_paths.append(item[0])
+        print("Packing {} split".format(split))
+        pack_images(img_paths, save_dir, shard_size=shard_size)
+
+
+class ImageShards(object):
+    """Read access to images written by pack_images.
+    The shards are memory-mapped on first use in every process, nothing is opened per image.
+
+    Args:
+    - shard_dir: directory written by pack_images.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        index = np.load(osp.join(shard_dir, 'index.npz'))
+        self.paths = index['paths']
+        self.shards = index['shards']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.path_to_id = {path: i for i, path in enumerate(self.paths.tolist())}
+        self._maps = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, img_path):
+        return img_path in self.path_to_id
+
+    def __getstate__(self):
+        # memmaps are reopened in the worker processes instead of being pickled
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        return state
+
+    def index_of(self, img_path):
+        if img_path not in self.path_to_id:
+            raise IOError("{} is not packed in '{}'".format(img_path, self.shard_dir))
+        return self.path_to_id[img_path]
+
+    def read_bytes(self, i):
+        if self._maps is None:
+            self._maps = {}
+        shard = int(self.shards[i])
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(osp.join(self.shard_dir, 'shard-{:05d}.bin'.format(shard)), dtype=np.uint8, mode='r')
+        offset = int(self.offsets[i])
+        return self._maps[shard][offset:offset + int(self.lengths[i])]
+
+    def read_image(self, i):
+        """Decodes the i-th packed image to an RGB PIL image."""
+        return Image.open(io.BytesIO(self.read_bytes(i))).convert('RGB')
+
+    def read_path(self, img_path):
+        """Decodes the packed image of img_path, a read_image drop-in."""
+        return self.read_image(self.index_of(img_path))
+
+
+class ShardImageDataset(Dataset):
+    """Image Person ReID Dataset reading from packed shards, drop-in for ImageDataset.
+
+    Args:
+    - dataset: list of (img_path, pid, camid) as given by data_manager.
+    - shard_dir: directory written by pack_images / pack_dataset.
+    - transform: same as ImageDataset.
+    - return_path: also return the image path.
+    """
+    def __init__(self, dataset, shard_dir, transform=None, return_path=False):
+        self.dataset = dataset
+        self.transform = transform
+        self.return_path = return_path
+        self.shards = ImageShards(shard_dir)
+        self.shard_ids = np.asarray([self.shards.index_of(img_path) for img_path, _, _ in dataset], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img_path, pid, camid = self.dataset[index]
+        img = self.shards.read_image(self.shard_ids[index])
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        if self.return_path:
+            return img, pid, camid, img_path
+        return img, pid, camid
+
+
+class ShardVideoDataset(VideoDataset):
+    """Video Person ReID Dataset reading frames from packed shards, drop-in for VideoDataset.
+
+    Args:
+    - dataset: list of (img_paths, pid, camid) as given by data_manager.
+    - shard_dir: directory written by pack_dataset.
+    - the other arguments are the same as VideoDataset.
+    """
+    def __init__(self, dataset, shard_dir, seq_len=15, sample='evenly', transform=None):
+        super(ShardVideoDataset, self).__init__(dataset, seq_len=seq_len, sample=sample, transform=transform)
+        self.shards = ImageShards(shard_dir)
+
+    def read_image(self, img_path):
+        return self.shards.read_path(img_path)
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+import torch
+from torch.utils.data import Dataset
+
+from .dataset_loader import VideoDataset, read_image
+
+
+class VideoClipDataset(VideoDataset):
+    """VideoDataset decoding the sampled frames of a tracklet with a pool of threads,
+    the frames are then transformed into one preallocated (seq_len, channel, height, width)
+    tensor. A frame sampled several times (padding of short tracklets, random sampling
+    with replacement) is decoded once, the transform still runs once per sampled frame.
+    The transforms run on the calling thread in frame order, so random transforms draw
+    from the global RNG exactly as in VideoDataset.
+
+    Args:
+    - the arguments of VideoDataset.
+    - num_threads: decoding threads, per process (i.e. per DataLoader worker).
+    """
+    def __init__(self, dataset, seq_len=15, sample='evenly', transform=None, num_threads=4):
+        super(VideoClipDataset, self).__init__(dataset, seq_len=seq_len, sample=sample, transform=transform)
+        self.num_threads = num_threads
+        self._pool = None
+
+    def __getstate__(self):
+        # the thread pool is created again in every DataLoader worker
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def _map(self, fn, items):
+        if self.num_threads <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        if self._pool is None:
+            self._pool = ThreadPool(self.num_threads)
+        return self._pool.map(fn, items)
+
+    def __getitem__(self, index):
+        img_paths, pid, camid = self.dataset[index]
+        indices = [int(i) for i in self.sample_indices(len(img_paths))]
+
+        unique_indices = sorted(set(indices))
+        frames = dict(zip(unique_indices, self._map(lambda i: self.read_image(img_paths[i]), unique_indices)))
+        if self.transform is None:
+            return [frames[i] for i in indices], pid, camid
+
+        first = self.transform(frames[indices[0]])
+        imgs = torch.empty((len(indices),) + tuple(first.size()), dtype=first.dtype)
+        imgs[0] = first
+        for t in range(1, len(indices)):
+            imgs[t] = self.transform(frames[indices[t]])
+
+        return imgs, pid, camid
+
+
+class VideoFrameDataset(Dataset):
+    """All frames of all tracklets as one flat dataset, to evaluate sample='all' with
+    batches of a fixed number of frames instead of one whole tracklet per batch.
+    Items are (img, tracklet index), use shuffle=False and average (or max) the frame
+    features of each tracklet with TrackletFeaturePooling. The loaders of this dataset
+    (e.g. eval_loaders(dataset, partial(VideoFrameDataset, transform=transform_test),
+    frames_per_batch)) can be passed to Engine.test and load_or_extract_features,
+    which pool the frame features with pool.
+
+    Args:
+    - dataset: list of (img_paths, pid, camid) as given by data_manager.
+    - transform: frame transform.
+    - read_fn: function loading an RGB PIL image from a path (default: read_image).
+    - pool: 'avg' or 'max', pooling of the frame features of a tracklet.
+    """
+    def __init__(self, dataset, transform=None, read_fn=read_image, pool='avg'):
+        assert pool in ['avg', 'max'], "Unknown pool: {}".format(pool)
+        self.dataset = dataset
+        self.transform = transform
+        self.read_fn = read_fn
+        self.pool = pool
+        lengths = np.asarray([len(item[0]) for item in dataset], dtype=np.int64)
+        # frames of tracklet t are frame_offsets[t] to frame_offsets[t+1]
+        self.frame_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self.pids = np.asarray([item[1] for item in dataset])
+        self.camids = np.asarray([item[2] for item in dataset])
+
+    def __len__(self):
+        return int(self.frame_offsets[-1])
+
+    def __getitem__(self, index):
+        tracklet = int(np.searchsorted(self.frame_offsets, index, side='right')) - 1
+        img_path = self.dataset[tracklet][0][index - self.frame_offsets[tracklet]]
+        img = self.read_fn(img_path)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, tracklet
+
+
+class TrackletFeaturePooling(object):
+    """Accumulates frame features batch by batch into one feature per tracklet,
+    without keeping the features of all frames.
+
+    Args:
+    - num_tracklets: number of tracklets.
+    - pool: 'avg' or 'max' over the frames of a tracklet.
+    """
+    def __init__(self, num_tracklets, pool='avg'):
+        assert pool in ['avg', 'max'], "Unknown pool: {}".format(pool)
+        self.num_tracklets = num_tracklets
+        self.pool = pool
+        self.features = None
+        self.counts = torch.zeros(num_tracklets)
+
+    def update(self, features, tracklets):
+        """
+        Args:
+        - features: frame features with shape (batch, feat_dim).
+        - tracklets: tracklet index of every frame, shape (batch,).
+        """
+        features = features.detach().float().cpu()
+        tracklets = torch.as_tensor(tracklets, dtype=torch.long)
+        if self.features is None:
+            fill = 0. if self.pool == 'avg' else -float('inf')
+            self.features = torch.full((self.num_tracklets, features.size(1)), fill)
+        self.counts.index_add_(0, tracklets, torch.ones(len(tracklets)))
+        if self.pool == 'avg':
+            self.features.index_add_(0, tracklets, features)
+        else:
+            # the frames of a batch cover a few consecutive tracklets
+            for t in torch.unique(tracklets).tolist():
+                self.features[t] = torch.max(self.features[t], features[tracklets == t].max(0)[0])
+
+    def result(self):
+        """Returns the (num_tracklets, feat_dim) tracklet features."""
+        assert (self.counts > 0).all(), "some tracklets have no frames"
+        if self.pool == 'avg':
+            return self.features / self.counts.unsqueeze(1)
+        return self.features
@@ -0,0 +1,483 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+import datetime
+import os.path as osp
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .losses import DeepSupervision, InfoLoss
+from .dataset_loader import quarantine_report
+from .eval_metrics import evaluate, evaluate_features, evaluate_recall
+from .utils.avgmeter import AverageMeter
+from .utils.distance import compute_distmat, mahalanobis_distmat
+from .utils.ecn import ECN_sparse
+from .utils.feature_store import load_or_extract_features
+from .utils.iotools import save_checkpoint
+from .utils.re_ranking import re_ranking_features
+from .utils.torchtools import set_bn_to_eval
+from .utils.train_step import TrainStep
+
+
+class LossTerm(object):
+    """One term of the training loss.
+
+    Args:
+    - name: name of the term in the logs, e.g. 'Xent'.
+    - fn: function (outputs, pids) returning the loss of a batch, outputs being what
+      forward_fn returns (by default, the output of the model in training mode).
+    - weight: weight of the term in the total loss, None to only log the term.
+    """
+    def __init__(self, name, fn, weight=1.):
+        self.name = name
+        self.fn = fn
+        self.weight = weight
+
+
+def supervise(criterion, outputs, pids):
+    """criterion(outputs, pids), averaged over the outputs when they are a tuple (deep
+    supervision)."""
+    if isinstance(outputs, tuple):
+        return DeepSupervision(criterion, outputs, pids)
+    return criterion(outputs, pids)
+
+
+def criterion_term(name, criterion, weight=1., index=None):
+    """LossTerm applying criterion(x, pids) to the model output, or to outputs[index] for
+    models returning several outputs."""
+    def fn(outputs, pids):
+        return supervise(criterion, outputs if index is None else outputs[index], pids)
+    return LossTerm(name, fn, weight)
+
+
+def info_term(weight, index=0):
+    """LossTerm 'Info' of the vib models: InfoLoss of the (mu, std) encoding at
+    outputs[index]."""
+    criterion = InfoLoss()
+    def fn(outputs, pids):
+        mu, std = outputs[index]
+        return criterion(mu, std)
+    return LossTerm('Info', fn, weight)
+
+
+class Hook(object):
+    """Base class of the Engine hooks, the methods are called at these points of the
+    loops and do nothing by default. A hook setting needs_paths makes test() keep the
+    image paths of the query and gallery sets (the loaders must return them).
+
+    after_test receives the results dict of test()/test_recall(): 'query' and 'gallery'
+    (the arrays of load_or_extract_features), 'distmat' (None when the ranking was
+    evaluated block by block) and 'cmc' and 'mAP', or 'recall' and 'K_range'.
+    """
+    needs_paths = False
+
+    def before_epoch(self, engine, epoch):
+        pass
+
+    def after_batch(self, engine, epoch, batch_idx, num_batches):
+        pass
+
+    def after_epoch(self, engine, epoch):
+        pass
+
+    def after_test(self, engine, epoch, results):
+        pass
+
+
+class PrintHook(Hook):
+    """Prints the time and loss meters every print_freq batches."""
+    def __init__(self, print_freq=10):
+        self.print_freq = print_freq
+        self.printed = False
+
+    def before_epoch(self, engine, epoch):
+        self.printed = False
+
+    def after_batch(self, engine, epoch, batch_idx, num_batches):
+        if (batch_idx + 1) % self.print_freq != 0:
+            return
+        if self.printed and hasattr(sys.stdout, 'console'):
+            # clean the previous line of the terminal, the log file keeps it
+            sys.stdout.console.write("\033[F\033[K")
+        self.printed = True
+        text = ('Epoch: [{0}][{1}/{2}]\t'
+                'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                'Data {data_time.val:.4f} ({data_time.avg:.4f})\t'.format(
+                 epoch + 1, batch_idx + 1, num_batches,
+                 batch_time=engine.batch_time, data_time=engine.data_time))
+        for name, meter in engine.meters.items():
+            text += '{}_Loss {:.4f} ({:.4f})\t'.format(name, meter.val, meter.avg)
+        print(text)
+
+
+class TensorboardHook(Hook):
+    """Writes the epoch averages of the losses and the test results to a SummaryWriter."""
+    def __init__(self, writer):
+        self.writer = writer
+
+    def after_epoch(self, engine, epoch):
+        self.writer.add_scalars(
+          'Losses',
+          dict((name.lower() + '_loss', meter.avg) for name, meter in engine.meters.items()),
+          epoch + 1)
+
+    def after_test(self, engine, epoch, results):
+        if 'recall' in results:
+            scalars = dict(rank_1=results['recall'][0],
+                           rank_2=results['recall'][1])
+        else:
+            scalars = dict(rank_1=results['cmc'][0],
+                           rank_5=results['cmc'][4],
+                           mAP=results['mAP'])
+        self.writer.add_scalars('Testing', scalars, epoch + 1)
+
+
+class QuarantineHook(Hook):
+    """Reports at the end of each epoch the images quarantined during the epoch by
+    read_image, in every DataLoader worker when a quarantine file is set (see
+    dataset_loader.set_quarantine_file)."""
+    def __init__(self):
+        self.reported = set()
+
+    def after_epoch(self, engine, epoch):
+        quarantined = quarantine_report()
+        new_paths = sorted(set(quarantined) - self.reported)
+        if not new_paths:
+            return
+        print("=> Epoch {}: {} unreadable images quarantined ({} in total), replaced by other images:".format(
+            epoch + 1, len(new_paths), len(quarantined)))
+        for img_path in new_paths:
+            print("   {}\t{}".format(img_path, quarantined[img_path]))
+        self.reported.update(new_paths)
+
+
+class TSNEHook(Hook):
+    """Draws the t-SNE plot of the query and gallery features after each test."""
+    needs_paths = True
+
+    def __init__(self, save_dir, num_clusters=3):
+        self.save_dir = save_dir
+        self.num_clusters = num_clusters
+
+    def after_test(self, engine, epoch, results):
+        # reidtools pulls in matplotlib, only needed when plotting
+        from .utils.reidtools import drawTSNE
+        query, gallery = results['query'], results['gallery']
+        drawTSNE(query['features'], gallery['features'], query['pids'], gallery['pids'],
+                 query['camids'], gallery['camids'], query['paths'], gallery['paths'],
+                 self.num_clusters, self.save_dir)
+
+
+def forward_images(engine, batch):
+    """Default forward_fn of Engine, for (imgs, pids, camids) batches."""
+    imgs, pids = batch[0], batch[1]
+    if engine.use_gpu:
+        imgs, pids = imgs.cuda(), pids.cuda()
+    return engine.train_step.forward(engine.model, imgs), pids
+
+
+def first_output(outputs):
+    """Default feature_fn of Engine: the eval-mode output of the model, or its first
+    element for the models returning a tuple (mu of the vib models)."""
+    if isinstance(outputs, (tuple, list)):
+        return outputs[0]
+    return outputs
+
+
+def mu_std_features(outputs):
+    """feature_fn of the vib models keeping the std next to the features (mu), for
+    mahalanobis_metric."""
+    return {'features': outputs[0], 'std': outputs[1]}
+
+
+def ecn_metric(query, gallery, use_cosine=False):
+    """ECN re-ranked distances (k=25, t=3, q=8, rankdist)."""
+    return ECN_sparse(query['features'], gallery['features'], k=25, t=3, q=8, method='rankdist',
+                      use_cosine=use_cosine).transpose()
+
+
+def re_ranking_metric(query, gallery, use_cosine=False):
+    """k-reciprocal re-ranked distances (k1=20, k2=6, lambda=0.3)."""
+    return re_ranking_features(query['features'], gallery['features'], k1=20, k2=6, lambda_value=0.3,
+                               use_cosine=use_cosine)
+
+
+def mahalanobis_metric(query, gallery):
+    """Mahalanobis distances with the diagonal covariance given by the std of each
+    query, needs feature_fn=mu_std_features."""
+    return mahalanobis_distmat(query['features'], gallery['features'], query['std'])
+
+
+def select_metric(use_cosine=False, use_ecn=False, re_ranking=False, mahalanobis=False):
+    """Returns the Engine metric for the evaluation options of the train scripts."""
+    if use_ecn:
+        return partial(ecn_metric, use_cosine=use_cosine)
+    if mahalanobis:
+        print("Using STD for Mahalanobis distance")
+        return mahalanobis_metric
+    if re_ranking:
+        print("Re-Ranking with Cosine" if use_cosine else "Normal Re-Ranking")
+        return partial(re_ranking_metric, use_cosine=use_cosine)
+    return 'cosine' if use_cosine else 'euclidean'
+
+
+class Engine(object):
+    """Train and test loops of the train scripts. A script describes its loss as a list
+    of LossTerm, and adds logging or other per-batch/per-epoch work as hooks.
+
+    Args:
+    - model: model, possibly wrapped in nn.DataParallel.
+    - optimizer: optimizer of the training epochs.
+    - loss_terms: list of LossTerm, the loss is the weighted sum of the terms.
+    - use_gpu: the model runs on GPU.
+    - train_step: TrainStep running the forward pass and the optimization step,
+      default is a float32 TrainStep.
+    - hooks: list of Hook.
+    - forward_fn: function (engine, batch) returning (outputs, pids) for a train batch,
+      default is forward_images.
+    - feature_fn: function of the eval-mode model output returning the features (or a
+      dict of tensors, see load_or_extract_features), default is first_output.
+    - metric: 'euclidean', 'cosine', or function (query, gallery) of the arrays of
+      load_or_extract_features returning the distance matrix (see select_metric).
+    - use_metric_cuhk03: evaluate with the cuhk03 metric.
+    - eval_block_size: number of queries whose euclidean/cosine distances are held in
+      memory at once by test(), 0 to always build the full distance matrix.
+    - feature_store: FeatureStore of the features of test(..., feature_key=key).
+    """
+    def __init__(self, model, optimizer, loss_terms, use_gpu=False, train_step=None, hooks=None,
+                 forward_fn=forward_images, feature_fn=first_output, metric='euclidean',
+                 use_metric_cuhk03=False, eval_block_size=1000, feature_store=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_terms = loss_terms
+        self.use_gpu = use_gpu
+        self.train_step = train_step if train_step is not None else TrainStep(use_gpu)
+        self.hooks = list(hooks) if hooks is not None else []
+        self.forward_fn = forward_fn
+        self.feature_fn = feature_fn
+        self.metric = metric
+        self.use_metric_cuhk03 = use_metric_cuhk03
+        self.eval_block_size = eval_block_size
+        self.feature_store = feature_store
+        self.meters = OrderedDict()
+        self.batch_time = AverageMeter()
+        self.data_time = AverageMeter()
+
+    def _call_hooks(self, name, *args):
+        for hook in self.hooks:
+            getattr(hook, name)(self, *args)
+
+    def train(self, epoch, trainloader, optimizer=None, loss_terms=None, freeze_bn=False):
+        """Trains one epoch.
+
+        Args:
+        - epoch: 0-based epoch.
+        - trainloader: iterable of train batches.
+        - optimizer, loss_terms: replace those of the engine for this epoch (e.g. to
+          train the classifier only during the first epochs).
+        - freeze_bn: keep the BatchNorm statistics fixed.
+        """
+        optimizer = optimizer if optimizer is not None else self.optimizer
+        loss_terms = loss_terms if loss_terms is not None else self.loss_terms
+        self.meters = OrderedDict((term.name, AverageMeter()) for term in loss_terms)
+        self.meters['Total'] = AverageMeter()
+        self.batch_time = AverageMeter()
+        self.data_time = AverageMeter()
+
+        self.model.train()
+        if freeze_bn:
+            self.model.apply(set_bn_to_eval)
+        self._call_hooks('before_epoch', epoch)
+
+        end = time.time()
+        for batch_idx, batch in enumerate(trainloader):
+            self.data_time.update(time.time() - end)
+
+            outputs, pids = self.forward_fn(self, batch)
+            values = [term.fn(outputs, pids) for term in loss_terms]
+            loss = sum(term.weight * value for term, value in zip(loss_terms, values) if term.weight is not None)
+            self.train_step.step(loss, optimizer)
+
+            self.batch_time.update(time.time() - end)
+
+            batch_size = (pids[0] if isinstance(pids, (tuple, list)) else pids).size(0)
+            for term, value in zip(loss_terms, values):
+                self.meters[term.name].update(value.item(), batch_size)
+            self.meters['Total'].update(loss.item(), batch_size)
+            self._call_hooks('after_batch', epoch, batch_idx, len(trainloader))
+
+            end = time.time()
+
+        self._call_hooks('after_epoch', epoch)
+
+    def extract_features(self, loaders, feature_key=None):
+        """Returns ({split: arrays}, batch_time) of the dict {split: dataloader}, see
+        load_or_extract_features."""
+        return load_or_extract_features(
+            self.model, loaders, use_gpu=self.use_gpu, store=self.feature_store, key=feature_key,
+            need_paths=any(hook.needs_paths for hook in self.hooks), feature_fn=self.feature_fn,
+        )
+
+    def compute_distmat(self, query, gallery):
+        """Returns the (num_query, num_gallery) numpy distance matrix."""
+        if callable(self.metric):
+            distmat = self.metric(query, gallery)
+        else:
+            distmat = compute_distmat(query['features'], gallery['features'], use_cosine=self.metric == 'cosine')
+        return distmat.numpy() if torch.is_tensor(distmat) else distmat
+
+    def test(self, queryloader, galleryloader, epoch=-1, ranks=[1, 5, 10, 20], return_distmat=False, feature_key=None):
+        """Extracts the query and gallery features and evaluates the ranking.
+        Euclidean and cosine rankings are evaluated a block of queries at a time, the
+        full distance matrix is only built for other metrics, the cuhk03 metric, with
+        return_distmat or when eval_block_size is 0.
+
+        Args:
+        - feature_key: key of the features in feature_store, they are loaded from there
+          when present and saved there otherwise.
+
+        Returns the rank-1 accuracy, or the distance matrix with return_distmat.
+        """
+        splits, batch_time = self.extract_features(
+            OrderedDict([('query', queryloader), ('gallery', galleryloader)]), feature_key=feature_key)
+        query, gallery = splits['query'], splits['gallery']
+        print("==> BatchTime(s)/BatchSize(img): {:.3f}/{}".format(batch_time.avg, queryloader.batch_size))
+
+        distmat = None
+        if return_distmat or self.use_metric_cuhk03 or callable(self.metric) or self.eval_block_size <= 0:
+            distmat = self.compute_distmat(query, gallery)
+            print("Computing CMC and mAP")
+            cmc, mAP = evaluate(distmat, query['pids'], gallery['pids'], query['camids'], gallery['camids'],
+                                use_metric_cuhk03=self.use_metric_cuhk03)
+        else:
+            print("Computing CMC and mAP in blocks of {} queries".format(self.eval_block_size))
+            cmc, mAP = evaluate_features(query['features'], gallery['features'], query['pids'], gallery['pids'],
+                                         query['camids'], gallery['camids'],
+                                         use_cosine=self.metric == 'cosine', block_size=self.eval_block_size)
+
+        print("Results ----------")
+        print("mAP: {:.1%}".format(mAP))
+        print("CMC curve")
+        for r in ranks:
+            print("Rank-{:<3}: {:.1%}".format(r, cmc[r-1]))
+        print("------------------")
+
+        self._call_hooks('after_test', epoch, dict(query=query, gallery=gallery, distmat=distmat, cmc=cmc, mAP=mAP))
+        if return_distmat:
+            return distmat
+        return cmc[0]
+
+    def test_recall(self, testloader, epoch=-1, K_range=[1, 2, 4, 8, 16, 32], return_distmat=False, feature_key=None):
+        """Retrieval evaluation: every image of testloader is ranked against the others
+        and Recall@K is computed for K in K_range.
+
+        Returns Recall@K_range[0], or the (num_test, num_test) distance matrix with
+        return_distmat.
+        """
+        splits, batch_time = self.extract_features({'test': testloader}, feature_key=feature_key)
+        test = splits['test']
+        print("==> BatchTime(s)/BatchSize(img): {:.3f}/{}".format(batch_time.avg, testloader.batch_size))
+
+        distmat = self.compute_distmat(test, test)
+        print("Computing Recall@K")
+        recall = evaluate_recall(distmat, test['pids'], K_range)
+
+        print("Results ----------")
+        print("Recall@K results")
+        for k, value in zip(K_range, recall):
+            print("Recall@{:<3}: {:.1%}".format(k, value))
+        print("------------------")
+
+        self._call_hooks('after_test', epoch, dict(query=test, gallery=test, distmat=distmat, recall=recall, K_range=K_range))
+        if return_distmat:
+            return distmat
+        return recall[0]
+
+    def save_checkpoint(self, epoch, rank1, save_dir, is_best=False, prefix='checkpoint_ep'):
+        """Saves the weights of the model (without its nn.DataParallel wrapper) to
+        save_dir/<prefix><epoch + 1>.pth.tar, and to best_model.pth.tar when is_best."""
+        model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+        save_checkpoint({
+            'state_dict': model.state_dict(),
+            'rank1': rank1,
+            'epoch': epoch,
+        }, is_best, osp.join(save_dir, prefix + str(epoch + 1) + '.pth.tar'))
+
+    def run(self, trainloader, test_fn, max_epoch, save_dir, start_epoch=0, best_rank1=-np.inf, scheduler=None,
+            fixbase_epoch=0, fixbase_optimizer=None, fixbase_loss_terms=None, freeze_bn=False, eval_step=-1, start_eval=0,
+            save_before_test=False, train_fn=None, save_on_interrupt=False, score_name='Rank-1'):
+        """Training loop of the train scripts. The classifier is first trained alone for
+        fixbase_epoch epochs with fixbase_optimizer (and fixbase_loss_terms), then epochs start_epoch..max_epoch-1
+        are trained, stepping scheduler after each of them. test_fn(epoch) is called every
+        eval_step epochs after start_eval and after the last epoch, a checkpoint is saved
+        after each test and best_model.pth.tar follows the best score.
+
+        Args:
+        - test_fn: function (epoch) returning the score (rank-1) of the model.
+        - save_before_test: also save 'beforeTesting_checkpoint_ep' before the last test.
+        - train_fn: function (epoch) training an epoch, default is self.train.
+        - save_on_interrupt: on KeyboardInterrupt, save 'keyboardInterrupt_checkpoint_ep'
+          and return (None, None).
+        - score_name: name of the score in the summary.
+
+        Returns (best_rank1, best_epoch).
+        """
+        if train_fn is None:
+            train_fn = partial(self.train, trainloader=trainloader, freeze_bn=freeze_bn)
+        start_time = time.time()
+        train_time = 0
+        best_epoch = start_epoch
+        print("==> Start training")
+
+        if fixbase_epoch > 0:
+            print("Train classifier for {} epochs while keeping base network frozen".format(fixbase_epoch))
+
+            for epoch in range(fixbase_epoch):
+                start_train_time = time.time()
+                self.train(epoch, trainloader, optimizer=fixbase_optimizer, loss_terms=fixbase_loss_terms, freeze_bn=True)
+                train_time += round(time.time() - start_train_time)
+
+            print("Now open all layers for training")
+
+        epoch = start_epoch
+        try:
+            for epoch in range(start_epoch, max_epoch):
+                start_train_time = time.time()
+                train_fn(epoch)
+                train_time += round(time.time() - start_train_time)
+
+                if scheduler is not None:
+                    scheduler.step()
+
+                if (epoch + 1) > start_eval and eval_step > 0 and (epoch + 1) % eval_step == 0 or (epoch + 1) == max_epoch:
+                    if save_before_test and (epoch + 1) == max_epoch:
+                        self.save_checkpoint(epoch, -1, save_dir, prefix='beforeTesting_checkpoint_ep')
+                    print("==> Test")
+                    rank1 = test_fn(epoch)
+                    is_best = rank1 > best_rank1
+
+                    if is_best:
+                        best_rank1 = rank1
+                        best_epoch = epoch + 1
+
+                    self.save_checkpoint(epoch, rank1, save_dir, is_best=is_best)
+        except KeyboardInterrupt:
+            if not save_on_interrupt:
+                raise
+            self.save_checkpoint(epoch, -1, save_dir, prefix='keyboardInterrupt_checkpoint_ep')
+            return None, None
+
+        print("==> Best {} {:.1%}, achieved at epoch {}".format(score_name, best_rank1, best_epoch))
+
+        elapsed = round(time.time() - start_time)
+        elapsed = str(datetime.timedelta(seconds=elapsed))
+        train_time = str(datetime.timedelta(seconds=train_time))
+        print("Finished. Total elapsed time (h:m:s): {}. Training time (h:m:s): {}.".format(elapsed, train_time))
+        return best_rank1, best_epoch
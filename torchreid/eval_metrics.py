@@ -3,10 +3,13 @@ from __future__ import print_function
 from __future__ import division
 
 import numpy as np
+import torch
 import copy
 from collections import defaultdict
 import sys
 import pdb
+
+from torchreid.utils.distance import iter_distmat_blocks
 try:
     from torchreid.eval_lib.cython_eval import eval_market1501_wrap
     CYTHON_EVAL_AVAI = True
@@ -139,6 +142,214 @@ def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
 
     return all_cmc, mAP
 
+
+def _eval_market1501_block(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
+    """Reduces a block of rows of the distance matrix with the market1501 metric.
+    Returns the histogram of the rank of the first correct match over the valid
+    queries of the block and their average precisions.
+    """
+    indices = np.argsort(distmat, axis=1)
+    same_pid = g_pids[indices] == q_pids[:, np.newaxis]
+    same_cam = g_camids[indices] == q_camids[:, np.newaxis]
+
+    # remove gallery samples that have the same pid and camid with query
+    keep = np.invert(same_pid & same_cam)
+    good = same_pid & keep # positions with value 1 are correct matches
+    valid = good.any(axis=1)
+    keep, good = keep[valid], good[valid]
+
+    # 1-based rank of every gallery sample once the removed ones are skipped
+    kept_rank = np.cumsum(keep, axis=1, dtype=np.int32)
+
+    # compute cmc curve from the rank of the first correct match
+    first_match = kept_rank[np.arange(len(good)), good.argmax(axis=1)] - 1
+    first_match_hist = np.bincount(first_match[first_match < max_rank], minlength=max_rank)
+
+    # compute average precision
+    num_rel = good.sum(axis=1)
+    precision = np.zeros(good.shape, dtype=np.float64)
+    np.divide(np.cumsum(good, axis=1, dtype=np.int32), kept_rank, out=precision, where=good)
+    return first_match_hist, precision.sum(axis=1) / num_rel
+
+
+def eval_market1501_vectorized(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, block_size=256):
+    """Evaluation with market1501 metric, vectorized over blocks of queries.
+    Gives the same cmc and mAP as eval_market1501, but each block of `block_size`
+    queries is handled with masked cumsums instead of a Python loop per query.
+    Key: for each query identity, its gallery images from the same camera view are discarded.
+    """
+    num_q, num_g = distmat.shape
+    if num_g < max_rank:
+        max_rank = num_g
+        print("Note: number of gallery samples is quite small, got {}".format(num_g))
+    q_pids, g_pids = np.asarray(q_pids), np.asarray(g_pids)
+    q_camids, g_camids = np.asarray(q_camids), np.asarray(g_camids)
+
+    first_match_hist = np.zeros(max_rank, dtype=np.int64) # number of valid queries whose first match is at rank r
+    all_AP = []
+    for start in range(0, num_q, block_size):
+        stop = min(start + block_size, num_q)
+        hist, AP = _eval_market1501_block(distmat[start:stop], q_pids[start:stop], g_pids,
+                                          q_camids[start:stop], g_camids, max_rank)
+        first_match_hist += hist
+        all_AP.append(AP)
+    all_AP = np.concatenate(all_AP)
+    num_valid_q = float(len(all_AP)) # number of valid query
+
+    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
+
+    all_cmc = np.cumsum(first_match_hist).astype(np.float32) / num_valid_q
+    mAP = np.mean(all_AP)
+
+    return all_cmc, mAP
+
+
+def evaluate_features(qf, gf, q_pids, g_pids, q_camids, g_camids, max_rank=50, use_cosine=False, block_size=1000):
+    """Evaluation with market1501 metric straight from query and gallery features.
+    The distance matrix is computed for `block_size` queries at a time and reduced
+    into the cmc/AP accumulators right away, so peak memory is bounded by
+    block_size x num_gallery instead of the full distance matrix. Gives the same cmc
+    and mAP as evaluate() on the dense distance matrix.
+
+    Args:
+    - qf, gf: query and gallery feature tensors with shape (m, feat_dim) and (n, feat_dim).
+    - use_cosine: rank with 1 - cosine similarity instead of squared euclidean distance.
+    - block_size: number of queries whose distances are held in memory at once.
+    """
+    num_g = gf.size(0)
+    if num_g < max_rank:
+        max_rank = num_g
+        print("Note: number of gallery samples is quite small, got {}".format(num_g))
+    q_pids, g_pids = np.asarray(q_pids), np.asarray(g_pids)
+    q_camids, g_camids = np.asarray(q_camids), np.asarray(g_camids)
+
+    first_match_hist = np.zeros(max_rank, dtype=np.int64) # number of valid queries whose first match is at rank r
+    all_AP = []
+    for start, stop, distmat in iter_distmat_blocks(qf, gf, block_size=block_size, use_cosine=use_cosine):
+        hist, AP = _eval_market1501_block(distmat, q_pids[start:stop], g_pids,
+                                          q_camids[start:stop], g_camids, max_rank)
+        first_match_hist += hist
+        all_AP.append(AP)
+    all_AP = np.concatenate(all_AP)
+    num_valid_q = float(len(all_AP)) # number of valid query
+
+    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
+
+    all_cmc = np.cumsum(first_match_hist).astype(np.float32) / num_valid_q
+    mAP = np.mean(all_AP)
+
+    return all_cmc, mAP
+
+
+def rank_matches(dist, match, junk):
+    """Ranks the correct matches of one query without sorting the whole gallery.
+    Returns the gallery indices of the correct matches ordered by distance and their
+    1-based ranks once junk samples are discarded. Samples at the same distance are
+    ranked by gallery index.
+    """
+    match_idx = np.flatnonzero(match)
+    match_idx = match_idx[np.argsort(dist[match_idx], kind='stable')]
+    match_dist = dist[match_idx]
+    # number of correct matches ranked in front of each remaining gallery sample
+    other_idx = np.flatnonzero(np.invert(match | junk))
+    other_dist = dist[other_idx]
+    num_before = np.searchsorted(match_dist, other_dist, side='left')
+    tied = np.flatnonzero(np.searchsorted(match_dist, other_dist, side='right') > num_before)
+    if len(tied) > 0:
+        num_before[tied] += ((match_dist == other_dist[tied, np.newaxis]) &
+                             (match_idx < other_idx[tied, np.newaxis])).sum(axis=1)
+    num_ahead = np.bincount(num_before, minlength=len(match_idx) + 1)
+    ranks = np.cumsum(num_ahead)[:len(match_idx)] + np.arange(1, len(match_idx) + 1)
+    return match_idx, ranks
+
+
+def _eval_market1501_partial_block(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
+    """Same as _eval_market1501_block, from the ranks of the correct matches only: each
+    gallery sample is placed among the sorted correct matches of its query by a batched
+    binary search, instead of argsorting the whole rows. Only the correct matches are
+    sorted, but the masks and search results still take block x num_gallery memory,
+    like the rows of distmat themselves."""
+    distmat = np.asarray(distmat)
+    same_pid = q_pids[:, np.newaxis] == g_pids[np.newaxis, :]
+    junk = same_pid & (q_camids[:, np.newaxis] == g_camids[np.newaxis, :])
+    match = same_pid & np.invert(junk)
+    num_rel = match.sum(axis=1)
+    valid = num_rel > 0
+    distmat, match, junk, num_rel = distmat[valid], match[valid], junk[valid], num_rel[valid]
+    num_q = len(distmat)
+    if num_q == 0:
+        return np.zeros(max_rank, dtype=np.int64), np.zeros(0)
+
+    # correct matches of each query ordered by (distance, gallery index), padded with inf
+    num_slots = num_rel.max()
+    q_idx, g_idx = np.nonzero(match)
+    slot = np.arange(len(q_idx)) - np.repeat(np.cumsum(num_rel) - num_rel, num_rel)
+    match_dist = np.full((num_q, num_slots), np.inf, dtype=distmat.dtype)
+    match_dist[q_idx, slot] = distmat[q_idx, g_idx]
+    match_idx = np.full((num_q, num_slots), distmat.shape[1], dtype=np.int64)
+    match_idx[q_idx, slot] = g_idx
+    order = np.argsort(match_dist, axis=1, kind='stable')
+    match_dist = np.take_along_axis(match_dist, order, axis=1)
+    match_idx = np.take_along_axis(match_idx, order, axis=1)
+
+    # number of correct matches ranked in front of each gallery sample
+    sorted_dist, dist = torch.from_numpy(np.ascontiguousarray(match_dist)), torch.from_numpy(np.ascontiguousarray(distmat))
+    num_before = torch.searchsorted(sorted_dist, dist).numpy()
+    others = np.invert(match | junk)
+    tq, tg = np.nonzero((torch.searchsorted(sorted_dist, dist, right=True).numpy() > num_before) & others)
+    if len(tq) > 0:
+        num_before[tq, tg] += ((match_dist[tq] == distmat[tq, tg][:, np.newaxis]) &
+                               (match_idx[tq] < tg[:, np.newaxis])).sum(axis=1)
+    # the correct matches and junk samples go to the last bin, which is not counted
+    num_before[np.invert(others)] = num_slots
+    flat = (np.arange(num_q)[:, np.newaxis] * (num_slots + 1) + num_before).ravel()
+    num_ahead = np.bincount(flat, minlength=num_q * (num_slots + 1)).reshape(num_q, num_slots + 1)
+    ranks = np.cumsum(num_ahead[:, :num_slots], axis=1) + np.arange(1, num_slots + 1)
+
+    # compute cmc curve from the rank of the first correct match
+    first_match = ranks[:, 0] - 1
+    first_match_hist = np.bincount(first_match[first_match < max_rank], minlength=max_rank)
+
+    # precision at the rank of each correct match
+    is_match = np.arange(num_slots) < num_rel[:, np.newaxis]
+    precision = np.where(is_match, np.arange(1, num_slots + 1) / ranks.astype(np.float64), 0.)
+    return first_match_hist, precision.sum(axis=1) / num_rel
+
+
+def eval_market1501_partial(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, block_size=256):
+    """Evaluation with market1501 metric from the ranks of the correct matches only.
+    Each query costs O(G log P) for P correct matches instead of a full O(G log G) argsort,
+    and blocks of `block_size` queries are handled together, memory grows with
+    block_size x num_gallery. Gallery samples at the same distance are ranked by gallery
+    index, so this gives the same cmc and mAP as eval_market1501 when no distances tie;
+    with ties, eval_market1501 and the Cython evaluator keep the order of np.argsort.
+    Key: for each query identity, its gallery images from the same camera view are discarded.
+    """
+    num_q, num_g = distmat.shape
+    if num_g < max_rank:
+        max_rank = num_g
+        print("Note: number of gallery samples is quite small, got {}".format(num_g))
+    q_pids, g_pids = np.asarray(q_pids), np.asarray(g_pids)
+    q_camids, g_camids = np.asarray(q_camids), np.asarray(g_camids)
+
+    first_match_hist = np.zeros(max_rank, dtype=np.int64) # number of valid queries whose first match is at rank r
+    all_AP = []
+    for start in range(0, num_q, block_size):
+        stop = min(start + block_size, num_q)
+        hist, AP = _eval_market1501_partial_block(distmat[start:stop], q_pids[start:stop], g_pids,
+                                                  q_camids[start:stop], g_camids, max_rank)
+        first_match_hist += hist
+        all_AP.append(AP)
+    all_AP = np.concatenate(all_AP)
+    num_valid_q = float(len(all_AP)) # number of valid query
+
+    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
+
+    all_cmc = np.cumsum(first_match_hist).astype(np.float32) / num_valid_q
+    mAP = np.mean(all_AP)
+
+    return all_cmc, mAP
+
 def evaluate_recall(distmat, q_pids, K_range = [1, 10, 100, 1000]):
 
     def compute_recall_at_K(D, K, q_pids, num):
@@ -161,11 +372,15 @@ def evaluate_recall(distmat, q_pids, K_range = [1, 10, 100, 1000]):
         recall.append(compute_recall_at_K(distmat, K, q_pids, num))
     return recall
 
-def evaluate(distmat, q_pids, g_pids, q_camids, g_camids, max_rank=50, use_metric_cuhk03=False, use_cython=True):
+def evaluate(distmat, q_pids, g_pids, q_camids, g_camids, max_rank=50, use_metric_cuhk03=False, use_cython=True, use_vectorized=False, use_partial_sort=False):
     if use_metric_cuhk03:
         return eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
     else:
-        if use_cython and CYTHON_EVAL_AVAI:
+        if use_partial_sort:
+            return eval_market1501_partial(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
+        elif use_vectorized:
+            return eval_market1501_vectorized(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
+        elif use_cython and CYTHON_EVAL_AVAI:
             return eval_market1501_wrap(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
         else:
             return eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
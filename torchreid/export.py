@@ -0,0 +1,202 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os.path as osp
+import time
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+from . import models
+from .utils.iotools import mkdir_if_missing
+
+
+def read_state_dict(fpath):
+    """Reads the state dict of a checkpoint written by save_checkpoint (or of a bare
+    state dict) on cpu, without the 'module.' prefixes left by nn.DataParallel.
+    """
+    checkpoint = torch.load(fpath, map_location='cpu')
+    state_dict = checkpoint['state_dict'] if 'state_dict' in checkpoint else checkpoint
+    return OrderedDict((key[len('module.'):] if key.startswith('module.') else key, value)
+                       for key, value in state_dict.items())
+
+
+def load_checkpoint(model, fpath):
+    """Loads a checkpoint written by save_checkpoint into model. Weights of modules which
+    are not in model any more (e.g. stripped classifiers) are skipped.
+    """
+    state_dict = read_state_dict(fpath)
+    model_keys = set(model.state_dict().keys())
+    loaded = OrderedDict((key, value) for key, value in state_dict.items() if key in model_keys)
+    missing = model_keys - set(loaded.keys())
+    if missing:
+        raise KeyError("Checkpoint '{}' has no weights for {}".format(fpath, sorted(missing)))
+    model.load_state_dict(loaded)
+    return model
+
+
+def uses_classifier_in_eval(model):
+    """True for the models whose eval-mode output goes through their classifier
+    (MuDeep returns the logits), the classifier is then part of the feature extractor."""
+    return isinstance(model, models.MuDeep)
+
+
+def strip_classifier(model):
+    """Removes the classifier layers (classifier, classifier_*), unused in eval mode.
+    Raises ValueError for the models which use them in eval mode (uses_classifier_in_eval).
+    """
+    if uses_classifier_in_eval(model):
+        raise ValueError("{} uses its classifier in eval mode, it can't be stripped".format(type(model).__name__))
+    for name, module in list(model.named_children()):
+        if name == 'classifier' or name.startswith('classifier_'):
+            setattr(model, name, None)
+    return model
+
+
+def _fold_pair(conv, bn):
+    # conv(x) * gamma / sqrt(var + eps) + (beta - mean * gamma / sqrt(var + eps))
+    scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+    conv.weight.data.mul_(scale.view(-1, 1, 1, 1))
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias.data)
+
+
+def fold_bn(model):
+    """Folds every BatchNorm2d which directly follows a Conv2d into the conv, in eval mode.
+    The pairs are found by structure: consecutive modules of an nn.Sequential, and
+    attributes named conv/bn or convN/bnN of the same module (torchvision ResNet blocks,
+    the ConvBlocks of torchreid). The folded BatchNorm is replaced by an identity.
+
+    Returns the number of folded BatchNorm layers.
+    """
+    num_folded = 0
+    for module in model.modules():
+        pairs = []
+        if isinstance(module, nn.Sequential):
+            children = list(module._modules.items())
+            for (_, conv), (bn_name, bn) in zip(children[:-1], children[1:]):
+                pairs.append((conv, bn_name, bn))
+        else:
+            for name, conv in module._modules.items():
+                if name.startswith('conv'):
+                    bn_name = 'bn' + name[len('conv'):]
+                    pairs.append((conv, bn_name, module._modules.get(bn_name)))
+        for conv, bn_name, bn in pairs:
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                _fold_pair(conv, bn)
+                module._modules[bn_name] = Identity()
+                num_folded += 1
+    return num_folded
+
+
+class Identity(nn.Module):
+    def forward(self, x):
+        return x
+
+
+class FeatureExtractor(nn.Module):
+    """Eval-mode feature extractor of a torchreid model: images in, one (batch, feat_dim)
+    tensor out, which is what the test() functions use as features. Models returning a
+    tuple in eval mode (ResNet50_vib returns (mu, std)) give their first element.
+    """
+    def __init__(self, model):
+        super(FeatureExtractor, self).__init__()
+        self.model = model.eval()
+
+    def forward(self, x):
+        features = self.model(x)
+        if isinstance(features, (tuple, list)):
+            features = features[0]
+        return features
+
+
+def build_feature_extractor(arch, fpath=None, fold=True, num_classes=None, **kwargs):
+    """Builds the eval-mode feature extractor of an init_model architecture.
+
+    Args:
+    - arch: model name, see models.get_names().
+    - fpath: checkpoint written by save_checkpoint, None keeps the initial weights.
+    - fold: fold the BatchNorm layers into the convs.
+    - num_classes: number of training identities, only needed by the models whose features
+      depend on it (squeezenet). By default it is read from the classifier of the checkpoint.
+    - kwargs: passed to models.init_model.
+    """
+    if num_classes is None:
+        num_classes = 1
+        if fpath:
+            for key, value in read_state_dict(fpath).items():
+                if key.startswith('classifier') and key.endswith('weight'):
+                    num_classes = value.size(0)
+                    break
+    kwargs.setdefault('use_gpu', False)
+    model = models.init_model(arch, num_classes=num_classes, **kwargs)
+    if not uses_classifier_in_eval(model):
+        strip_classifier(model)
+    if fpath:
+        load_checkpoint(model, fpath)
+    model.eval()
+    if hasattr(model, 'cam'):
+        model.cam = False
+    if fold:
+        print("Folded {} BatchNorm layers".format(fold_bn(model)))
+    return FeatureExtractor(model)
+
+
+def export_feature_extractor(extractor, save_dir, height=256, width=128, formats=('torchscript', 'onnx'), check=True,
+                             reference=None):
+    """Traces extractor and writes save_dir/feature_extractor.pt (TorchScript) and/or
+    save_dir/feature_extractor.onnx, both with a dynamic batch dimension.
+
+    Args:
+    - extractor: FeatureExtractor.
+    - save_dir: output directory.
+    - height, width: input image size.
+    - formats: subset of ('torchscript', 'onnx').
+    - check: compare the traced module to extractor on another batch size, and extractor
+      to reference.
+    - reference: unfolded feature extractor (build_feature_extractor with fold=False) the
+      folded extractor is checked against, None skips that comparison.
+
+    Returns the traced module.
+    """
+    mkdir_if_missing(save_dir)
+    extractor.eval()
+    example = torch.randn(2, 3, height, width)
+    with torch.no_grad():
+        traced = torch.jit.trace(extractor, example)
+        if check:
+            x = torch.randn(5, 3, height, width)
+            expected, got = extractor(x), traced(x)
+            if not torch.allclose(expected, got, rtol=1e-4, atol=1e-5):
+                raise RuntimeError("Traced feature extractor differs from the eager model (max diff {})".format(
+                    (expected - got).abs().max().item()))
+            if reference is not None:
+                unfolded = reference.eval()(x)
+                if not torch.allclose(unfolded, expected, rtol=1e-3, atol=1e-4):
+                    raise RuntimeError("Folded feature extractor differs from the unfolded model (max diff {})".format(
+                        (unfolded - expected).abs().max().item()))
+    if 'torchscript' in formats:
+        fpath = osp.join(save_dir, 'feature_extractor.pt')
+        traced.save(fpath)
+        print("TorchScript feature extractor saved to '{}'".format(fpath))
+    if 'onnx' in formats:
+        fpath = osp.join(save_dir, 'feature_extractor.onnx')
+        torch.onnx.export(extractor, example, fpath, input_names=['images'], output_names=['features'],
+                          dynamic_axes={'images': {0: 'batch'}, 'features': {0: 'batch'}}, opset_version=11)
+        print("ONNX feature extractor saved to '{}'".format(fpath))
+    return traced
+
+
+def benchmark(model, height=256, width=128, batch_size=32, num_iters=10, num_warmup=2):
+    """Returns the CPU throughput of model in images per second."""
+    x = torch.randn(batch_size, 3, height, width)
+    with torch.no_grad():
+        for _ in range(num_warmup):
+            model(x)
+        start = time.time()
+        for _ in range(num_iters):
+            model(x)
+        elapsed = time.time() - start
+    return batch_size * num_iters / elapsed
@@ -14,6 +14,7 @@ from .entropy_loss import ConfidencePenalty
 from .customTripletLoss import TripletLoss_custom,SoftTripletLoss_custom
 from .MI_loss import MI_loss
 from .jsd import JSD_loss
+from .info_loss import InfoLoss
 
 
 def DeepSupervision(criterion, xs, y):
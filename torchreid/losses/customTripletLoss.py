@@ -4,12 +4,19 @@ from __future__ import division
 import torch
 import torch.nn as nn
 
+from .hard_mine_triplet_loss import mine_triplets
+
 class TripletLoss_custom(nn.Module):
     """TODO: make sure each anchor use their relative positive image
+
+    Args:
+    - margin (float): margin for triplet.
+    - mining (str): 'batch_hard' (default), 'batch_all' or 'semi_hard'.
     """
-    def __init__(self, margin=0.3):
+    def __init__(self, margin=0.3, mining='batch_hard'):
         super(TripletLoss_custom, self).__init__()
         self.margin = margin
+        self.mining = mining
         self.ranking_loss = nn.MarginRankingLoss(margin=margin)
 
     def forward(self, inputs_a, inputs_p, targets_a, targets_p):
@@ -22,7 +29,7 @@ class TripletLoss_custom(nn.Module):
         m, n = inputs_a.size(0), inputs_p.size(0)
         dist = torch.pow(inputs_a, 2).sum(dim=1, keepdim=True).expand(m, n) + \
                   torch.pow(inputs_p, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        dist.addmm_(1, -2, inputs_a, inputs_p.t())
+        dist.addmm_(inputs_a, inputs_p.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()
 
         # Compute pairwise distance, replace by the official when merged
@@ -33,12 +40,7 @@ class TripletLoss_custom(nn.Module):
 
         # For each anchor, find the hardest positive and negative
         mask = targets_a.expand(m, m).eq(targets_p.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(m):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
+        dist_ap, dist_an = mine_triplets(dist, mask, self.mining)
 
         # Compute ranking hinge loss
         y = torch.ones_like(dist_an)
@@ -53,10 +55,11 @@ class SoftTripletLoss_custom(nn.Module):
     Code imported from https://github.com/Cysu/open-reid/blob/master/reid/loss/triplet.py.
 
     Args:
-    - margin (float): margin for triplet.
+    - mining (str): 'batch_hard' (default), 'batch_all' or 'semi_hard'.
     """
-    def __init__(self):
+    def __init__(self, mining='batch_hard'):
         super(SoftTripletLoss_custom, self).__init__()
+        self.mining = mining
         self.softplus = nn.Softplus(beta=1, threshold=20)
 
     def forward(self, inputs_a, inputs_p, targets_a, targets_p):
@@ -68,7 +71,7 @@ class SoftTripletLoss_custom(nn.Module):
         m, n = inputs_a.size(0), inputs_p.size(0)
         dist = torch.pow(inputs_a, 2).sum(dim=1, keepdim=True).expand(m, n) + \
                   torch.pow(inputs_p, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        dist.addmm_(1, -2, inputs_a, inputs_p.t())
+        dist.addmm_(inputs_a, inputs_p.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()
 
         # Compute pairwise distance, replace by the official when merged
@@ -79,12 +82,10 @@ class SoftTripletLoss_custom(nn.Module):
 
         # For each anchor, find the hardest positive and negative
         mask = targets_a.expand(m, m).eq(targets_p.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(m):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
+        dist_ap, dist_an = mine_triplets(dist, mask, self.mining)
         # Compute ranking hinge loss
-        loss = self.softplus(dist_ap - dist_an).sum()
-        return loss
+        loss = self.softplus(dist_ap - dist_an)
+        if self.mining == 'batch_hard':
+            return loss.sum()
+        # keep the per-anchor scale of the batch hard loss
+        return loss.mean() * m
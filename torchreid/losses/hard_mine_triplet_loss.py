@@ -4,6 +4,72 @@ from __future__ import division
 import torch
 import torch.nn as nn
 
+
+def hard_example_mining(dist, mask):
+    """Hardest positive and hardest negative of every anchor (row), without a python loop.
+
+    Args:
+    - dist: distance matrix with shape (num_anchors, num_samples)
+    - mask: bool matrix of the same shape, True where the sample has the anchor's label
+    """
+    dist_ap = torch.where(mask, dist, torch.full_like(dist, -float('inf'))).max(dim=1)[0]
+    dist_an = torch.where(mask, torch.full_like(dist, float('inf')), dist).min(dim=1)[0]
+    return dist_ap, dist_an
+
+
+def batch_all_mining(dist, mask, pos_mask=None):
+    """Every valid (anchor, positive, negative) triplet, returned as flat dist_ap, dist_an.
+
+    Args:
+    - dist: distance matrix with shape (num_anchors, num_samples)
+    - mask: bool matrix, True where the sample has the anchor's label
+    - pos_mask: bool matrix of the positives to use (default: mask)
+    """
+    if pos_mask is None:
+        pos_mask = mask
+    valid = pos_mask.unsqueeze(2) & ~mask.unsqueeze(1)
+    dist_ap = dist.unsqueeze(2).expand_as(valid)[valid]
+    dist_an = dist.unsqueeze(1).expand_as(valid)[valid]
+    return dist_ap, dist_an
+
+
+def semi_hard_mining(dist, mask, pos_mask=None):
+    """Semi-hard negative of every (anchor, positive) pair: the closest negative that is
+    still farther than the positive. Pairs without one fall back to the farthest negative.
+
+    Args:
+    - dist: distance matrix with shape (num_anchors, num_samples)
+    - mask: bool matrix, True where the sample has the anchor's label
+    - pos_mask: bool matrix of the positives to use (default: mask)
+    """
+    if pos_mask is None:
+        pos_mask = mask
+    anchor_idx, pos_idx = pos_mask.nonzero(as_tuple=True)
+    dist_ap = dist[anchor_idx, pos_idx]
+    dist_neg = dist[anchor_idx]
+    is_neg = ~mask[anchor_idx]
+    inf = torch.full_like(dist_neg, float('inf'))
+    semi_hard = is_neg & (dist_neg > dist_ap.unsqueeze(1))
+    dist_an = torch.where(semi_hard, dist_neg, inf).min(dim=1)[0]
+    easiest = torch.where(is_neg, dist_neg, -inf).max(dim=1)[0]
+    dist_an = torch.where(semi_hard.any(dim=1), dist_an, easiest)
+    return dist_ap, dist_an
+
+
+def mine_triplets(dist, mask, mining, pos_mask=None):
+    """Returns dist_ap, dist_an for mining in ('batch_hard', 'batch_all', 'semi_hard').
+    pos_mask gives the positives for the pair based variants, e.g. mask without the diagonal
+    when the anchors are part of the samples.
+    """
+    if mining == 'batch_hard':
+        return hard_example_mining(dist, mask)
+    elif mining == 'batch_all':
+        return batch_all_mining(dist, mask, pos_mask)
+    elif mining == 'semi_hard':
+        return semi_hard_mining(dist, mask, pos_mask)
+    raise ValueError("Unknown triplet mining: {}".format(mining))
+
+
 class TripletLoss(nn.Module):
     """Triplet loss with hard positive/negative mining.
 
@@ -13,10 +79,12 @@ class TripletLoss(nn.Module):
 
     Args:
     - margin (float): margin for triplet.
+    - mining (str): 'batch_hard' (default), 'batch_all' or 'semi_hard'.
     """
-    def __init__(self, margin=0.3):
+    def __init__(self, margin=0.3, mining='batch_hard'):
         super(TripletLoss, self).__init__()
         self.margin = margin
+        self.mining = mining
         self.ranking_loss = nn.MarginRankingLoss(margin=margin)
 
     def forward(self, inputs, targets):
@@ -30,17 +98,13 @@ class TripletLoss(nn.Module):
         # Compute pairwise distance, replace by the official when merged
         dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
         dist = dist + dist.t()
-        dist.addmm_(1, -2, inputs, inputs.t())
+        dist.addmm_(inputs, inputs.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
 
         # For each anchor, find the hardest positive and negative
         mask = targets.expand(n, n).eq(targets.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(n):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
+        pos_mask = mask & ~torch.eye(n, dtype=torch.bool, device=mask.device)
+        dist_ap, dist_an = mine_triplets(dist, mask, self.mining, pos_mask)
 
         # Compute ranking hinge loss
         y = torch.ones_like(dist_an)
@@ -55,10 +119,11 @@ class SoftTripletLoss(nn.Module):
     Code imported from https://github.com/Cysu/open-reid/blob/master/reid/loss/triplet.py.
 
     Args:
-    - margin (float): margin for triplet.
+    - mining (str): 'batch_hard' (default), 'batch_all' or 'semi_hard'.
     """
-    def __init__(self):
+    def __init__(self, mining='batch_hard'):
         super(SoftTripletLoss, self).__init__()
+        self.mining = mining
         self.softplus = nn.Softplus(beta=1, threshold=20)
 
     def forward(self, inputs, targets):
@@ -72,19 +137,18 @@ class SoftTripletLoss(nn.Module):
         # Compute pairwise distance, replace by the official when merged
         dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
         dist = dist + dist.t()
-        dist.addmm_(1, -2, inputs, inputs.t())
+        dist.addmm_(inputs, inputs.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
 
         # For each anchor, find the hardest positive and negative
         mask = targets.expand(n, n).eq(targets.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(n):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
+        pos_mask = mask & ~torch.eye(n, dtype=torch.bool, device=mask.device)
+        dist_ap, dist_an = mine_triplets(dist, mask, self.mining, pos_mask)
 
         # Compute ranking hinge loss
         y = torch.ones_like(dist_an)
-        loss = self.softplus(dist_ap - dist_an).sum()
-        return loss
+        loss = self.softplus(dist_ap - dist_an)
+        if self.mining == 'batch_hard':
+            return loss.sum()
+        # keep the per-anchor scale of the batch hard loss
+        return loss.mean() * n
@@ -0,0 +1,13 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import math
+
+from torch import nn
+
+
+class InfoLoss(nn.Module):
+    """KL divergence (in bits) between the N(mu, std) encoding of the vib models and
+    N(0, 1), averaged over the batch."""
+    def forward(self, mu, std):
+        return -0.5*(1+2*std.log()-mu.pow(2)-std.pow(2)).sum(1).mean().div(math.log(2))
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 from .resnet import *
+from .resnet_vib import *
 from .resnext import *
 from .seresnet import *
 from .densenet import *
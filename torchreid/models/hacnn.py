@@ -198,12 +198,18 @@ class HACNN(nn.Module):
     - nchannels (list): number of channels AFTER concatenation
     - feat_dim (int): feature dimension for a single stream
     - learn_region (bool): whether to learn region features (i.e. local branch)
+    - batch_regions (bool): in eval mode, run the 4 regions of the local branch stacked
+      along the batch dimension, with one grid_sample and one local conv per block. The
+      features are the same as with the per-region loop. Train mode always uses the
+      per-region loop, so the BatchNorm statistics of the local convs stay per region.
     """
-    def __init__(self, num_classes, loss={'xent'}, nchannels=[128, 256, 384], feat_dim=512, learn_region=True, use_gpu=True, **kwargs):
+    def __init__(self, num_classes, loss={'xent'}, nchannels=[128, 256, 384], feat_dim=512, learn_region=True, use_gpu=True,
+                 batch_regions=True, **kwargs):
         super(HACNN, self).__init__()
         self.loss = loss
         self.learn_region = learn_region
         self.use_gpu = use_gpu
+        self.batch_regions = batch_regions
 
         self.conv = ConvBlock(3, 32, 3, s=2, p=1)
 
@@ -279,6 +285,40 @@ class HACNN(nn.Module):
         if self.use_gpu: theta = theta.cuda()
         return theta
 
+    def transform_theta_batched(self, theta):
+        """Transform theta (batch, 4, 2) of the 4 regions to include (s_w, s_h),
+        resulting in (4*batch, 2, 3) ordered region by region (like x.repeat(4, 1, 1, 1))"""
+        translations = theta.transpose(0, 1).unsqueeze(-1) # (4, batch, 2, 1)
+        scale_factors = torch.stack(self.scale_factors).to(theta.device).unsqueeze(1)
+        # expanded with the batch size of theta, so that traced models keep a dynamic batch size
+        scale_factors = scale_factors.expand(-1, translations.size(1), -1, -1)
+        return torch.cat((scale_factors, translations), 3).view(-1, 2, 3)
+
+    def local_block(self, x, theta, size, local_conv, x_prev=None):
+        """Local branch of one block for the 4 regions: spatial transform of x, resizing,
+        adding the local features of the previous block (x_prev) and local_conv.
+        The regions are stacked along the batch dimension, region by region, in x_prev
+        and in the output."""
+        if self.batch_regions and not self.training:
+            x_trans = self.stn(x.repeat(4, 1, 1, 1), self.transform_theta_batched(theta))
+            x_trans = F.upsample(x_trans, size, mode='bilinear', align_corners=True)
+            if x_prev is not None:
+                x_trans = x_trans + x_prev
+            return local_conv(x_trans)
+
+        if x_prev is not None:
+            x_prev = x_prev.chunk(4, 0)
+        x_local_list = []
+        for region_idx in range(4):
+            theta_i = theta[:,region_idx,:]
+            theta_i = self.transform_theta(theta_i, region_idx)
+            x_trans_i = self.stn(x, theta_i)
+            x_trans_i = F.upsample(x_trans_i, size, mode='bilinear', align_corners=True)
+            if x_prev is not None:
+                x_trans_i = x_trans_i + x_prev[region_idx]
+            x_local_list.append(local_conv(x_trans_i))
+        return torch.cat(x_local_list, 0)
+
     def forward(self, x):
         assert x.size(2) == 160 and x.size(3) == 64, \
             "Input size does not match, expected (160, 64) but got ({}, {})".format(x.size(2), x.size(3))
@@ -291,14 +331,7 @@ class HACNN(nn.Module):
         x1_out = x1 * x1_attn
         # local branch
         if self.learn_region:
-            x1_local_list = []
-            for region_idx in range(4):
-                x1_theta_i = x1_theta[:,region_idx,:]
-                x1_theta_i = self.transform_theta(x1_theta_i, region_idx)
-                x1_trans_i = self.stn(x, x1_theta_i)
-                x1_trans_i = F.upsample(x1_trans_i, (24, 28), mode='bilinear', align_corners=True)
-                x1_local_i = self.local_conv1(x1_trans_i)
-                x1_local_list.append(x1_local_i)
+            x1_local = self.local_block(x, x1_theta, (24, 28), self.local_conv1)
 
         # ============== Block 2 ==============
         # Block 2
@@ -308,15 +341,7 @@ class HACNN(nn.Module):
         x2_out = x2 * x2_attn
         # local branch
         if self.learn_region:
-            x2_local_list = []
-            for region_idx in range(4):
-                x2_theta_i = x2_theta[:,region_idx,:]
-                x2_theta_i = self.transform_theta(x2_theta_i, region_idx)
-                x2_trans_i = self.stn(x1_out, x2_theta_i)
-                x2_trans_i = F.upsample(x2_trans_i, (12, 14), mode='bilinear', align_corners=True)
-                x2_local_i = x2_trans_i + x1_local_list[region_idx]
-                x2_local_i = self.local_conv2(x2_local_i)
-                x2_local_list.append(x2_local_i)
+            x2_local = self.local_block(x1_out, x2_theta, (12, 14), self.local_conv2, x1_local)
 
         # ============== Block 3 ==============
         # Block 3
@@ -326,15 +351,7 @@ class HACNN(nn.Module):
         x3_out = x3 * x3_attn
         # local branch
         if self.learn_region:
-            x3_local_list = []
-            for region_idx in range(4):
-                x3_theta_i = x3_theta[:,region_idx,:]
-                x3_theta_i = self.transform_theta(x3_theta_i, region_idx)
-                x3_trans_i = self.stn(x2_out, x3_theta_i)
-                x3_trans_i = F.upsample(x3_trans_i, (6, 7), mode='bilinear', align_corners=True)
-                x3_local_i = x3_trans_i + x2_local_list[region_idx]
-                x3_local_i = self.local_conv3(x3_local_i)
-                x3_local_list.append(x3_local_i)
+            x3_local = self.local_block(x2_out, x3_theta, (6, 7), self.local_conv3, x2_local)
 
         # ============== Feature generation ==============
         # global branch
@@ -342,12 +359,10 @@ class HACNN(nn.Module):
         x_global = self.fc_global(x_global)
         # local branch
         if self.learn_region:
-            x_local_list = []
-            for region_idx in range(4):
-                x_local_i = x3_local_list[region_idx]
-                x_local_i = F.avg_pool2d(x_local_i, x_local_i.size()[2:]).view(x_local_i.size(0), -1)
-                x_local_list.append(x_local_i)
-            x_local = torch.cat(x_local_list, 1)
+            # (4*batch, c) region by region -> (batch, 4*c), regions side by side
+            batch = x3_out.size(0)
+            x_local = F.avg_pool2d(x3_local, x3_local.size()[2:]).view(4, batch, -1)
+            x_local = x_local.transpose(0, 1).contiguous().view(batch, -1)
             x_local = self.fc_local(x_local)
 
         if not self.training:
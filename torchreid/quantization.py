@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import copy
+import time
+
+import numpy as np
+import torch
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:
+    from torch.quantization import get_default_qconfig_mapping
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def calibration_subset(dataset, num_images=300, seed=0):
+    """Returns num_images random items of dataset (e.g. dataset.train of a data_manager
+    dataset, list or DatasetTable), the calibration images of quantize_feature_extractor.
+    """
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(len(dataset), min(num_images, len(dataset)), replace=False)
+    return [dataset[i] for i in sorted(indices)]
+
+
+def quantize_feature_extractor(extractor, calib_loader, backend='x86'):
+    """Post-training static int8 quantization of a feature extractor (see
+    torchreid.export.build_feature_extractor, build it with fold=False: conv, BatchNorm
+    and ReLU are fused here). The model is traced with torch.fx, observers record the
+    activation ranges on the calibration batches, then convs and linears run in int8.
+    The returned module takes and returns float tensors, on cpu.
+
+    Args:
+    - extractor: float eval-mode feature extractor.
+    - calib_loader: iterable of batches whose first element is an image tensor, e.g. a
+      DataLoader over calibration_subset(dataset.train).
+    - backend: quantized engine, 'x86'/'fbgemm' for x86 servers, 'qnnpack' for ARM.
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(extractor).cpu().eval()
+    example = None
+    for batch in calib_loader:
+        example = batch[0]
+        break
+    if example is None:
+        raise ValueError("calib_loader is empty")
+
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (example,))
+    num_images = 0
+    with torch.no_grad():
+        for batch in calib_loader:
+            prepared(batch[0])
+            num_images += batch[0].size(0)
+    print("Calibrated on {} images".format(num_images))
+    return convert_fx(prepared)
+
+
+def extract_features(model, dataloader, use_gpu=False):
+    """Returns (features, pids, camids, seconds spent in the model) over dataloader,
+    the way the test() functions of the train scripts extract them."""
+    features, pids, camids = [], [], []
+    model_time = 0.
+    with torch.no_grad():
+        for imgs, batch_pids, batch_camids in dataloader:
+            if use_gpu: imgs = imgs.cuda()
+            end = time.time()
+            batch_features = model(imgs)
+            model_time += time.time() - end
+            features.append(batch_features.data.cpu())
+            pids.extend(batch_pids)
+            camids.extend(batch_camids)
+    return torch.cat(features, 0), np.asarray(pids), np.asarray(camids), model_time
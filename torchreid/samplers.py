@@ -10,62 +10,104 @@ import torch
 from torch.utils.data.sampler import Sampler
 
 
+def _sample_distinct(rng, n, k):
+    """k distinct integers of range(n) in random order. The first k distinct values of a
+    stream of uniform draws are a uniform sample, this avoids permuting range(n) when k << n.
+    """
+    if n < 4 * k:
+        return rng.choice(n, k, replace=False)
+    while True:
+        draws = rng.randint(0, n, size=2 * k)
+        _, first = np.unique(draws, return_index=True)
+        if len(first) >= k:
+            return draws[np.sort(first)[:k]]
+
+
+def _sample_distinct_rows(rng, n, k):
+    """k distinct integers of range(n[r]) for every row r, in random order.
+    Floyd's algorithm run on all rows at once, n[r] >= k.
+    """
+    out = np.empty((len(n), k), dtype=np.int64)
+    for j in range(k):
+        top = n - k + j
+        t = (rng.rand(len(n)) * (top + 1)).astype(np.int64)
+        taken = (out[:, :j] == t[:, None]).any(axis=1)
+        out[:, j] = np.where(taken, top, t)
+    # Floyd's algorithm gives a uniform subset, shuffle it for a uniform order as well
+    return np.take_along_axis(out, np.argsort(rng.rand(len(n), k), axis=1), axis=1)
+
+
 class RandomIdentitySampler(Sampler):
     """
     Randomly sample N identities, then for each identity,
     randomly sample K instances, therefore batch size is N*K.
 
+    The indices of every identity are kept in one CSR-style array (index, index_ptr),
+    so an epoch is built with a few array operations instead of per-identity lists.
+
     Args:
     - data_source (Dataset): dataset to sample from.
     - num_instances (int): number of instances per identity in a batch.
     - batch_size (int): number of examples in a batch.
+    - seed (int): seed of the sampler's own random state, the global numpy state is used if None.
     """
-    def __init__(self, data_source, batch_size, num_instances):
+    def __init__(self, data_source, batch_size, num_instances, seed=None):
         self.data_source = data_source
         self.batch_size = batch_size
         self.num_instances = num_instances
         self.num_pids_per_batch = self.batch_size // self.num_instances
-        self.index_dic = defaultdict(list)
-        for index, (_, pid, _) in enumerate(self.data_source):
-            self.index_dic[pid].append(index)
-        self.pids = list(self.index_dic.keys())
+        self.rng = np.random.RandomState(seed) if seed is not None else np.random
+
+        if hasattr(data_source, 'pids'):
+            pids = np.asarray(data_source.pids) # DatasetTable, no need to build every item
+        else:
+            pids = np.asarray([item[1] for item in self.data_source])
+        self.pids, pid_labels, counts = np.unique(pids, return_inverse=True, return_counts=True)
+        # indices of the p-th identity are index[index_ptr[p]:index_ptr[p+1]]
+        self.index = np.argsort(pid_labels, kind='stable')
+        self.index_ptr = np.concatenate(([0], np.cumsum(counts)))
+        # identities with less than K images still give one batch chunk (sampled with replacement)
+        self.num_chunks = np.maximum(counts // self.num_instances, 1)
 
         # estimate number of examples in an epoch
-        self.length = 0
-        for pid in self.pids:
-            idxs = self.index_dic[pid]
-            num = len(idxs)
-            if num < self.num_instances:
-                num = self.num_instances
-            self.length += num - num % self.num_instances
+        self.length = int(self.num_chunks.sum()) * self.num_instances
 
     def __iter__(self):
-        batch_idxs_dict = defaultdict(list)
-
-        for pid in self.pids:
-            idxs = copy.deepcopy(self.index_dic[pid])
-            if len(idxs) < self.num_instances:
-                idxs = np.random.choice(idxs, size=self.num_instances, replace=True)
-            random.shuffle(idxs)
-            batch_idxs = []
-            for idx in idxs:
-                batch_idxs.append(idx)
-                if len(batch_idxs) == self.num_instances:
-                    batch_idxs_dict[pid].append(batch_idxs)
-                    batch_idxs = []
-
-        avai_pids = copy.deepcopy(self.pids)
-        final_idxs = []
-
+        rng = self.rng
+        num_pids = len(self.pids)
+        counts = np.diff(self.index_ptr)
+
+        # shuffle inside every identity: pid label plus a random fraction keeps the segments in place
+        order = np.argsort(np.repeat(np.arange(num_pids), counts) + rng.rand(len(self.index)))
+        idxs = self.index[order]
+
+        # cut every identity into chunks of K instances, leftovers are dropped
+        chunk_pid = np.repeat(np.arange(num_pids), self.num_chunks)
+        first_chunk = np.cumsum(self.num_chunks) - self.num_chunks
+        offset = (np.arange(len(chunk_pid)) - first_chunk[chunk_pid]) * self.num_instances
+        pos = (self.index_ptr[chunk_pid] + offset)[:, None] + np.arange(self.num_instances)
+        small = counts[chunk_pid] < self.num_instances
+        if small.any():
+            small_pid = chunk_pid[small]
+            draws = (rng.rand(len(small_pid), self.num_instances) * counts[small_pid][:, None]).astype(np.int64)
+            pos[small] = self.index_ptr[small_pid][:, None] + draws
+        chunks = idxs[pos]
+
+        # pick N distinct identities among the ones that still have chunks, take one chunk of each
+        remaining = self.num_chunks.copy()
+        avai_pids = np.arange(num_pids)
+        batch_chunks = []
         while len(avai_pids) >= self.num_pids_per_batch:
-            selected_pids = random.sample(avai_pids, self.num_pids_per_batch)
-            for pid in selected_pids:
-                batch_idxs = batch_idxs_dict[pid].pop(0)
-                final_idxs.extend(batch_idxs)
-                if len(batch_idxs_dict[pid]) == 0:
-                    avai_pids.remove(pid)
+            selected_pids = avai_pids[_sample_distinct(rng, len(avai_pids), self.num_pids_per_batch)]
+            batch_chunks.append(first_chunk[selected_pids] + self.num_chunks[selected_pids] - remaining[selected_pids])
+            remaining[selected_pids] -= 1
+            if (remaining[selected_pids] == 0).any():
+                avai_pids = avai_pids[remaining[avai_pids] > 0]
 
-        return iter(final_idxs)
+        if len(batch_chunks) == 0:
+            return iter([])
+        final_idxs = chunks[np.concatenate(batch_chunks)].ravel()
+        return iter(final_idxs.tolist())
 
     def __len__(self):
         return self.length
@@ -75,57 +117,78 @@ def No_index(a, b):
     return [i for i, j in enumerate(a) if j != b]
     
 class RandomMultipleGallerySampler(Sampler):
-    def __init__(self, data_source, num_instances=4):
+    """
+    Every image of the dataset in random order, each followed by num_instances-1 more images
+    of its identity. They are taken from the identity's other cameras when it has any, otherwise
+    from its other images (without replacement when there are at least num_instances candidates).
+
+    Images are kept sorted by (pid, camera), so the candidates of an anchor are the pid's range
+    with one hole (its own camera, or the anchor itself) and all draws of an epoch are batched.
+
+    Args:
+    - data_source (Dataset): dataset to sample from.
+    - num_instances (int): number of images per anchor, including the anchor.
+    - seed (int): seed of the sampler's own random state, the global numpy state is used if None.
+    """
+    def __init__(self, data_source, num_instances=4, seed=None):
         self.data_source = data_source
-        self.index_pid = defaultdict(int)
-        self.pid_cam = defaultdict(list)
-        self.pid_index = defaultdict(list)
         self.num_instances = num_instances
+        self.rng = np.random.RandomState(seed) if seed is not None else np.random
 
         self.num_samples = len(data_source)
 
-        for index, (_, pid, cam) in enumerate(data_source):
-            self.index_pid[index] = pid
-            self.pid_cam[pid].append(cam)
-            self.pid_index[pid].append(index)
+        if hasattr(data_source, 'pids'):
+            pids, cams = np.asarray(data_source.pids), np.asarray(data_source.camids) # DatasetTable
+        else:
+            pids = np.asarray([item[1] for item in data_source])
+            cams = np.asarray([item[2] for item in data_source])
+        # dataset indices sorted by pid then camera, dataset order inside each group
+        self.index = np.lexsort((cams, pids))
+        self.position = np.empty(self.num_samples, dtype=np.int64)
+        self.position[self.index] = np.arange(self.num_samples)
+
+        sorted_pids, sorted_cams = pids[self.index], cams[self.index]
+        new_pid = np.concatenate(([True], sorted_pids[1:] != sorted_pids[:-1]))
+        new_cam = new_pid | np.concatenate(([True], sorted_cams[1:] != sorted_cams[:-1]))
+        # [pid_lo, pid_hi) and [cam_lo, cam_hi) are the sorted positions of the same pid / pid+camera
+        pid_lo, cam_lo = np.flatnonzero(new_pid), np.flatnonzero(new_cam)
+        pid_hi = np.append(pid_lo[1:], self.num_samples)
+        cam_hi = np.append(cam_lo[1:], self.num_samples)
+        pid_group, cam_group = np.cumsum(new_pid) - 1, np.cumsum(new_cam) - 1
+        self.pid_lo, self.pid_hi = pid_lo[pid_group][self.position], pid_hi[pid_group][self.position]
+        self.cam_lo, self.cam_hi = cam_lo[cam_group][self.position], cam_hi[cam_group][self.position]
+        # identity seen by one camera only: the candidates are its other images
+        self.one_cam = (self.cam_hi - self.cam_lo) == (self.pid_hi - self.pid_lo)
+        self.num_cand = (self.pid_hi - self.pid_lo) - np.where(self.one_cam, 1, self.cam_hi - self.cam_lo)
 
     def __len__(self):
-        return self.num_samples * self.num_instances
+        # identities with a single image only give the anchor
+        return self.num_samples + (self.num_instances - 1) * int((self.num_cand > 0).sum())
 
     def __iter__(self):
-        indices = torch.randperm(self.num_samples)
-        ret = []
-        for i_ind, i in enumerate(indices):
-            _, i_pid, i_cam = self.data_source[i]
-
-            ret.append(i)
-
-            pid_i = self.index_pid[i]
-            cams = self.pid_cam[pid_i]
-            index = self.pid_index[pid_i]
-            select_cams = No_index(cams, i_cam)
-
-
-            if select_cams:
-
-                if len(select_cams) >= self.num_instances:
-                    cam_indexes = np.random.choice(select_cams, size=self.num_instances-1, replace=False)
-                else:
-                    cam_indexes = np.random.choice(select_cams, size=self.num_instances-1, replace=True)
-
-                for kk in cam_indexes:
-                    ret.append(index[kk])
-
-            else:
-                select_indexes = No_index(index, i)
-
-                if len(select_indexes) >= self.num_instances:
-                    ind_indexes = np.random.choice(select_indexes, size=self.num_instances-1, replace=False)
-                else:
-                    ind_indexes = np.random.choice(select_indexes, size=self.num_instances-1, replace=True)
-
-                for kk in ind_indexes:
-                    ret.append(index[kk])
-
-
-        return iter(ret)
+        rng = self.rng
+        num_draws = self.num_instances - 1
+        anchors = rng.permutation(self.num_samples)
+        lo = self.pid_lo[anchors]
+        hole_lo, hole_hi = self.cam_lo[anchors], self.cam_hi[anchors]
+        # identity seen by one camera only: any other image of it
+        one_cam = self.one_cam[anchors]
+        hole_lo = np.where(one_cam, self.position[anchors], hole_lo)
+        hole_hi = np.where(one_cam, hole_lo + 1, hole_hi)
+        num_cand = self.num_cand[anchors]
+
+        draws = np.zeros((self.num_samples, num_draws), dtype=np.int64)
+        replace = (num_cand > 0) & (num_cand < self.num_instances)
+        draws[replace] = (rng.rand(replace.sum(), num_draws) * num_cand[replace, None]).astype(np.int64)
+        distinct = num_cand >= self.num_instances
+        draws[distinct] = _sample_distinct_rows(rng, num_cand[distinct], num_draws)
+
+        # u-th candidate of the range, skipping the hole
+        pos = lo[:, None] + draws
+        pos = np.where(pos >= hole_lo[:, None], pos + (hole_hi - hole_lo)[:, None], pos)
+        pos[num_cand == 0] = 0
+        ret = np.concatenate((anchors[:, None], self.index[pos]), axis=1)
+        # identities with a single image only give the anchor
+        keep = np.ones(ret.shape, dtype=bool)
+        keep[num_cand == 0, 1:] = False
+        return iter(ret[keep].tolist())
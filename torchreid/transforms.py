@@ -7,6 +7,9 @@ from PIL import Image
 import random
 import numpy as np
 
+import torch
+from torch.utils.data.dataloader import default_collate
+
 from torchvision.transforms import functional as F
 
 class RandomSizedEarser(object):
@@ -102,3 +105,162 @@ class RandomHorizontalFlip_custom(object):
 
     def __repr__(self):
         return self.__class__.__name__ + '(p={})'.format(self.p)
+
+
+class ToByteTensor(object):
+    """Converts a PIL image to a uint8 tensor of shape (3, H, W) without scaling.
+    Used in front of the batch transforms below, which work on collated batches.
+    """
+    def __call__(self, img):
+        img = torch.from_numpy(np.asarray(img, dtype=np.uint8).copy())
+        return img.permute(2, 0, 1).contiguous()
+
+
+class BatchRandom2DTranslation(object):
+    """Random2DTranslation on a (batch, C, height, width) tensor.
+    Every image is, with probability p, upscaled to (1 + 1/8) and randomly cropped back.
+    Unlike Random2DTranslation, which resizes the source image once, this resizes images
+    which are usually already resized (a second interpolation, slightly blurrier). When
+    the source images are at hand, use Random2DTranslation in place of the Resize of the
+    DataLoader workers instead, it costs the same there.
+
+    Args:
+    - height (int): target height.
+    - width (int): target width.
+    - p (float): probability of performing this transformation. Default: 0.5.
+    """
+    def __init__(self, height, width, p=0.5):
+        self.height = height
+        self.width = width
+        self.p = p
+
+    def __call__(self, imgs):
+        if tuple(imgs.shape[-2:]) != (self.height, self.width):
+            imgs = _resize(imgs, self.height, self.width)
+        idx = (torch.rand(imgs.size(0)) <= self.p).nonzero().view(-1)
+        if idx.numel() == 0:
+            return imgs
+        new_width, new_height = int(round(self.width * 1.125)), int(round(self.height * 1.125))
+        resized = _resize(imgs[idx], new_height, new_width)
+        x1 = torch.round(torch.rand(idx.numel()) * (new_width - self.width)).long().tolist()
+        y1 = torch.round(torch.rand(idx.numel()) * (new_height - self.height)).long().tolist()
+        imgs = imgs.clone()
+        # crops are views, copying them one by one is cheaper than a gather over the batch
+        for j, i in enumerate(idx.tolist()):
+            imgs[i] = resized[j, :, y1[j]:y1[j] + self.height, x1[j]:x1[j] + self.width]
+        return imgs
+
+
+class BatchRandomSizedEarser(object):
+    """RandomSizedEarser on a (batch, 3, H, W) tensor, uint8 or float in [0, 1] (before normalization).
+    Same sampling as the per-image version: an image is erased when uniform(-1, 1) <= p, the
+    rectangle area and aspect ratio follow sl, sh and asratio, and it is filled with one random color.
+
+    Args:
+    - sl, sh (float): range of the erased area relative to the image area.
+    - asratio (float): aspect ratios are drawn from [asratio, 1/asratio].
+    - p (float): see above.
+    - legacy_position (bool): RandomSizedEarser pastes the patch with its top-left corner at
+      (patch width, patch height) instead of the sampled (x1, y1); keep that by default so
+      existing runs are reproduced, set False to erase at the sampled position.
+    """
+    def __init__(self, sl=0.02, sh=0.2, asratio=0.3, p=0.5, legacy_position=True):
+        self.sl = sl
+        self.sh = sh
+        self.asratio = asratio
+        self.p = p
+        self.legacy_position = legacy_position
+
+    def __call__(self, imgs):
+        B, C, H, W = imgs.shape
+        idx = (torch.rand(B) * 2 - 1 <= self.p).nonzero().view(-1)
+        if idx.numel() == 0:
+            return imgs
+        n = idx.numel()
+        area = H * W
+        xe, ye = torch.zeros(n, dtype=torch.float64), torch.zeros(n, dtype=torch.float64)
+        We, He = torch.zeros(n, dtype=torch.float64), torch.zeros(n, dtype=torch.float64)
+        todo = torch.ones(n, dtype=torch.bool)
+        # rejection sampling for all images at once, redraw only the rejected ones
+        while todo.any():
+            m = int(todo.sum())
+            Se = (self.sl + torch.rand(m, dtype=torch.float64) * (self.sh - self.sl)) * area
+            re = self.asratio + torch.rand(m, dtype=torch.float64) * (1 / self.asratio - self.asratio)
+            h, w = torch.sqrt(Se * re), torch.sqrt(Se / re)
+            x, y = torch.rand(m, dtype=torch.float64) * (W - w), torch.rand(m, dtype=torch.float64) * (H - h)
+            ok = (x + w <= W) & (y + h <= H) & (x > 0) & (y > 0)
+            sel = todo.nonzero().view(-1)[ok]
+            xe[sel], ye[sel], We[sel], He[sel] = x[ok], y[ok], w[ok], h[ok]
+            todo[sel] = False
+        x1, y1 = torch.ceil(xe), torch.ceil(ye)
+        x2, y2 = torch.floor(x1 + We), torch.floor(y1 + He)
+        w, h = (x2 - x1).long(), (y2 - y1).long()
+        if self.legacy_position:
+            x1, y1 = w, h
+        else:
+            x1, y1 = x1.long(), y1.long()
+        color = torch.randint(0, 256, (n, C, 1, 1))
+        if imgs.dtype == torch.uint8:
+            color = color.to(torch.uint8)
+        else:
+            color = color.to(imgs.dtype) / 255
+        imgs = imgs.clone()
+        # slicing clips the rectangle at the border, like PIL paste
+        for j, (i, x, y, ww, hh) in enumerate(zip(idx.tolist(), x1.tolist(), y1.tolist(), w.tolist(), h.tolist())):
+            imgs[i, :, y:y + hh, x:x + ww] = color[j]
+        return imgs
+
+
+class BatchRandomHorizontalFlip(object):
+    """Flips every image of a (batch, C, H, W) tensor with probability p."""
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs):
+        flip = torch.rand(imgs.size(0)) < self.p
+        if not flip.any():
+            return imgs
+        return torch.where(flip[:, None, None, None].to(imgs.device), imgs.flip(-1), imgs)
+
+
+class BatchNormalize(object):
+    """ToTensor scaling (for uint8 input) followed by Normalize, on a whole batch."""
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    def __call__(self, imgs):
+        # (x / 255 - mean) / std as one multiply-add
+        scale = 1 / self.std
+        if imgs.dtype == torch.uint8:
+            scale = scale / 255
+        return imgs.float().mul_(scale.to(imgs.device)).sub_((self.mean / self.std).to(imgs.device))
+
+
+class BatchTransformCollate(object):
+    """collate_fn applying a batch transform to the images after default collation.
+
+    Args:
+    - transform: callable on a (batch, C, H, W) tensor, e.g. Compose of the Batch* transforms.
+    """
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        batch = list(default_collate(batch))
+        batch[0] = self.transform(batch[0])
+        return batch
+
+
+def _resize(imgs, height, width):
+    """Bilinear resize of a (batch, C, H, W) tensor, uint8 results are rounded back to uint8."""
+    if imgs.dtype == torch.uint8:
+        try:
+            # recent pytorch resizes uint8 directly, several times faster than going through float
+            return torch.nn.functional.interpolate(imgs, size=(height, width), mode='bilinear', align_corners=False)
+        except RuntimeError:
+            pass
+    out = torch.nn.functional.interpolate(imgs.float(), size=(height, width), mode='bilinear', align_corners=False)
+    if imgs.dtype == torch.uint8:
+        out = out.round_().clamp_(0, 255).to(torch.uint8)
+    return out
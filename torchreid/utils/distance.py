@@ -0,0 +1,72 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import torch
+
+
+def compute_distmat(qf, gf, use_cosine=False):
+    """Computes the query-gallery distance matrix the same way as the test() functions.
+
+    Args:
+    - qf: query features with shape (m, feat_dim).
+    - gf: gallery features with shape (n, feat_dim).
+    - use_cosine: if True, returns 1 - cosine similarity, otherwise squared euclidean distance.
+    """
+    m, n = qf.size(0), gf.size(0)
+    if use_cosine:
+        qf_norm = qf/qf.norm(dim=1)[:,None]
+        gf_norm = gf/gf.norm(dim=1)[:,None]
+        return torch.addmm(torch.ones((m, n), dtype=qf.dtype, device=qf.device), qf_norm, gf_norm.t(), beta=1, alpha=-1)
+    distmat = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
+              torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
+    distmat.addmm_(qf, gf.t(), beta=1, alpha=-2)
+    return distmat
+
+
+def mahalanobis_distmat(qf, gf, q_std):
+    """Squared mahalanobis distances with a diagonal covariance per query: the distance
+    of query i to gallery j is sum(((qf[i] - gf[j]) / q_std[i]) ** 2).
+
+    Args:
+    - qf: query features with shape (m, feat_dim).
+    - gf: gallery features with shape (n, feat_dim).
+    - q_std: std of the query features with shape (m, feat_dim).
+    """
+    inv_var = 1. / torch.pow(q_std, 2)
+    distmat = (torch.pow(qf, 2) * inv_var).sum(dim=1, keepdim=True) + torch.mm(inv_var, torch.pow(gf, 2).t())
+    distmat.addmm_(qf * inv_var, gf.t(), beta=1, alpha=-2)
+    return distmat
+
+
+def iter_distmat_blocks(qf, gf, block_size=1000, use_cosine=False):
+    """Yields the query-gallery distance matrix one block of queries at a time.
+    Only a (block_size, n) slice is alive at any moment, the gallery side terms are
+    computed once. Values are the same as compute_distmat.
+
+    Yields (start, stop, distmat) where distmat is a numpy array holding rows start:stop.
+    """
+    m, n = qf.size(0), gf.size(0)
+    if use_cosine:
+        qf = qf/qf.norm(dim=1)[:,None]
+        gf = gf/gf.norm(dim=1)[:,None]
+    else:
+        gf_sqnorm = torch.pow(gf, 2).sum(dim=1, keepdim=True).t()
+    gf_t = gf.t()
+    for start in range(0, m, block_size):
+        stop = min(start + block_size, m)
+        q = qf[start:stop]
+        if use_cosine:
+            distmat = torch.addmm(torch.ones((stop - start, n), dtype=q.dtype, device=q.device), q, gf_t, beta=1, alpha=-1)
+        else:
+            distmat = torch.pow(q, 2).sum(dim=1, keepdim=True).expand(stop - start, n) + gf_sqnorm.expand(stop - start, n)
+            distmat.addmm_(q, gf_t, beta=1, alpha=-2)
+        yield start, stop, distmat.cpu().numpy()
+
+
+def paired_distance(x, y, use_cosine=False):
+    """Distance between x[i] and y[i] for every row i, with the same formula as compute_distmat."""
+    if use_cosine:
+        x = x/x.norm(dim=1)[:,None]
+        y = y/y.norm(dim=1)[:,None]
+        return 1 - (x * y).sum(dim=1)
+    return torch.pow(x, 2).sum(dim=1) + torch.pow(y, 2).sum(dim=1) - 2 * (x * y).sum(dim=1)
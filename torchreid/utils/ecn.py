@@ -39,6 +39,8 @@ import os
 # ECN Re-ranking
 import pdb
 import torch
+
+from .distance import compute_distmat, iter_distmat_blocks
 def ECN_custom(queryset,testset,k,t,q,method, use_cosine=False):
     #nQuery=queryset.shape[0]
     #ntest=testset.shape[0]
@@ -116,6 +118,77 @@ def ECN(queryset,testset,k,t,q,method):
     ecn_dist=np.mean(np.concatenate((q_nbr_dist,t_nbr_dist),axis=0),axis=0)
     return ecn_dist
 
+def ECN_sparse(queryset,testset,k,t,q,method, use_cosine=False):
+    """Memory bounded ECN, gives the same ecn_dist as ECN_custom (and as ECN with use_cosine=True).
+    Only the top max(k, t+1, q+1) neighbours of every sample are kept, found from blocked
+    distance computations, rankdist is kept as a sparse matrix and the neighbour averages
+    are accumulated straight into the [#test x #query] output, a block of test samples at a time.
+    queryset and testset are feature matrices (numpy arrays or tensors) with samples in rows.
+    """
+    queryset = torch.as_tensor(np.asarray(queryset, dtype=np.float32)) if isinstance(queryset, np.ndarray) else queryset
+    testset = torch.as_tensor(np.asarray(testset, dtype=np.float32)) if isinstance(testset, np.ndarray) else testset
+    nQuery=queryset.shape[0]
+    ntest=testset.shape[0]
+    total= nQuery + ntest
+    mat= torch.cat((queryset,testset),0)
+    # rows handled at once, keeps each dense slice around 2^24 entries
+    block_size = max(1, 2**24 // total)
+
+    num_neigh = min(max(k, t+1, q+1), total)
+    initial_rank = np.empty((total, num_neigh), dtype=np.int32)
+    for start, stop, r_dist in iter_distmat_blocks(mat, mat, block_size=block_size, use_cosine=use_cosine):
+        top = np.argpartition(r_dist, num_neigh-1, axis=1)[:, :num_neigh]
+        order = np.argsort(np.take_along_axis(r_dist, top, axis=1), axis=1)
+        initial_rank[start:stop] = np.take_along_axis(top, order, axis=1)
+
+    top_t_nb=initial_rank[:,1:t+1]
+    t_ind=top_t_nb[nQuery:,:].T
+    next_2_tnbr=np.transpose(initial_rank[t_ind,1:q+1],[0,2,1])
+    next_2_tnbr=np.reshape(next_2_tnbr,(t*q,ntest))
+    t_ind=np.concatenate((t_ind,next_2_tnbr),axis=0)
+
+    q_ind=top_t_nb[:nQuery,:].T
+    next_2_qnbr=np.transpose(initial_rank[q_ind,1:q+1],[0,2,1])
+    next_2_qnbr=np.reshape(next_2_qnbr,(t*q,nQuery))
+    q_ind=np.concatenate((q_ind,next_2_qnbr),axis=0)
+    num_nbr = t_ind.shape[0]
+
+    # ecn_dist[j, i] is the mean of r_dist[t_ind[:, j], i] and r_dist[q_ind[:, i], nQuery+j]
+    ecn_dist = np.empty((ntest, nQuery), dtype=np.float64)
+    block_size = max(1, 2**24 // nQuery)
+    if method=='rankdist':
+        fac_1 = rankdist_sparse(initial_rank,k)
+        print('rankdist computed...commencing ECN')
+        # rankdist = -fac_1 * fac_1.T, so sums of rankdist rows are products with summed fac_1 rows
+        nbr_sum = csr_matrix((np.ones(q_ind.size), q_ind.T.ravel(), np.arange(0, q_ind.size+1, num_nbr)), shape=(nQuery, total))
+        q_nbr_fac = nbr_sum * fac_1
+        nbr_sum = csr_matrix((np.ones(t_ind.size), t_ind.T.ravel(), np.arange(0, t_ind.size+1, num_nbr)), shape=(ntest, total))
+        t_nbr_fac = nbr_sum * fac_1
+        for start in range(0, ntest, block_size):
+            stop = min(start + block_size, ntest)
+            ecn_dist[start:stop] = -((t_nbr_fac[start:stop] * fac_1[:nQuery].T) +
+                                     (fac_1[nQuery+start:nQuery+stop] * q_nbr_fac.T)).toarray()
+    else:
+        for start in range(0, ntest, block_size):
+            stop = min(start + block_size, ntest)
+            ecn_dist[start:stop] = 0
+            for s in range(num_nbr):
+                nbr = torch.from_numpy(t_ind[s, start:stop].astype(np.int64))
+                ecn_dist[start:stop] += compute_distmat(mat[nbr], queryset, use_cosine=use_cosine).cpu().numpy()
+                nbr = torch.from_numpy(q_ind[s].astype(np.int64))
+                ecn_dist[start:stop] += compute_distmat(testset[start:stop], mat[nbr], use_cosine=use_cosine).cpu().numpy()
+    print('ECN dist compute done...')
+    ecn_dist /= 2*num_nbr
+    return ecn_dist
+
+def rankdist_sparse(initial_rank,k):
+    """fac_1 of rankdist as a sparse matrix, built from the top-k columns of initial_rank only.
+    rankdist itself is -fac_1 * fac_1.T.
+    """
+    total = initial_rank.shape[0]
+    fac_1 = np.tile(np.arange(k, 0, -1, dtype=np.float64), total)
+    return csr_matrix((fac_1, initial_rank[:, :k].ravel(), np.arange(0, total*k+1, k)), shape=(total, total))
+
 def rankdist(initial_rank,k):
     pos_L1=initial_rank.argsort().astype(np.int32)
     fac_1=csr_matrix(np.maximum(0,k-pos_L1))
@@ -0,0 +1,217 @@
+from __future__ import absolute_import
+
+import os
+import os.path as osp
+import hashlib
+import json
+import shutil
+import time
+
+import numpy as np
+import torch
+
+from .avgmeter import AverageMeter
+from ..dataset_loader_video import VideoFrameDataset, TrackletFeaturePooling
+from .iotools import mkdir_if_missing, read_json, write_json
+
+
+def extract_features(model, dataloader, use_gpu=False, feature_fn=None):
+    """Runs the eval-mode model over dataloader, whose batches are (imgs, pids[, camids][, paths]).
+    Returns (arrays, batch_time): arrays holds 'features' (tensor), 'pids', 'camids' and
+    'paths' (numpy arrays, camids and paths are empty when the batches have none) and the
+    other tensors returned by feature_fn; batch_time is the AverageMeter of the model time
+    per batch.
+
+    Args:
+    - feature_fn: function of the model output returning the features, or a dict of
+      tensors holding 'features' and other per-image outputs to keep (e.g. the std of the
+      vib models). Default: the model output.
+    """
+    if isinstance(dataloader.dataset, VideoFrameDataset):
+        return extract_tracklet_features(model, dataloader, use_gpu=use_gpu, feature_fn=feature_fn)
+    batch_time = AverageMeter()
+    model.eval()
+    outputs = {}
+    pids, camids, paths = [], [], []
+    with torch.no_grad():
+        for batch in dataloader:
+            imgs = batch[0]
+            if use_gpu: imgs = imgs.cuda()
+
+            end = time.time()
+            batch_outputs = model(imgs)
+            batch_time.update(time.time() - end)
+
+            if feature_fn is not None:
+                batch_outputs = feature_fn(batch_outputs)
+            if not isinstance(batch_outputs, dict):
+                batch_outputs = {'features': batch_outputs}
+            for name, value in batch_outputs.items():
+                outputs.setdefault(name, []).append(value.data.cpu())
+            pids.extend(batch[1])
+            for field in batch[2:]:
+                if len(field) > 0 and isinstance(field[0], str):
+                    paths.extend(field)
+                else:
+                    camids.extend(field)
+    arrays = dict((name, torch.cat(values, 0)) for name, values in outputs.items())
+    arrays.update(pids=np.asarray(pids), camids=np.asarray(camids), paths=np.asarray(paths))
+    return arrays, batch_time
+
+
+def extract_tracklet_features(model, frameloader, use_gpu=False, feature_fn=None):
+    """extract_features of a loader of VideoFrameDataset (shuffle=False): the frame
+    features are pooled into one feature per tracklet (pool of the dataset), as the
+    sample='all' video test does with one tracklet per batch.
+    """
+    dataset = frameloader.dataset
+    batch_time = AverageMeter()
+    model.eval()
+    pooling = {}
+    with torch.no_grad():
+        for imgs, tracklets in frameloader:
+            if use_gpu: imgs = imgs.cuda()
+
+            end = time.time()
+            batch_outputs = model(imgs)
+            batch_time.update(time.time() - end)
+
+            if feature_fn is not None:
+                batch_outputs = feature_fn(batch_outputs)
+            if not isinstance(batch_outputs, dict):
+                batch_outputs = {'features': batch_outputs}
+            for name, value in batch_outputs.items():
+                if name not in pooling:
+                    pooling[name] = TrackletFeaturePooling(len(dataset.dataset), pool=dataset.pool)
+                pooling[name].update(value, tracklets)
+    arrays = dict((name, values.result()) for name, values in pooling.items())
+    arrays.update(pids=dataset.pids, camids=dataset.camids, paths=np.asarray([]))
+    return arrays, batch_time
+
+
+def checkpoint_hash(fpath, chunk_size=2**20):
+    """sha1 of a checkpoint file, 'none' when there is no such file (e.g. imagenet weights only)."""
+    if not fpath or not osp.isfile(fpath):
+        return 'none'
+    sha1 = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def feature_cache_key(checkpoints, arch, transform, split, **kwargs):
+    """Key of a feature store entry.
+
+    Args:
+    - checkpoints: checkpoint path or list of paths loaded into the model, in order.
+    - arch: model name.
+    - transform: test transform, its repr is used.
+    - split: dict describing the dataset split (name, root, split_id, ...).
+    - kwargs: any other setting that changes the extracted features.
+    """
+    if not isinstance(checkpoints, (list, tuple)):
+        checkpoints = [checkpoints]
+    desc = {
+        'checkpoints': [checkpoint_hash(fpath) for fpath in checkpoints],
+        'arch': arch,
+        'transform': repr(transform),
+        'split': split,
+    }
+    desc.update(kwargs)
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FeatureStore(object):
+    """Saves extracted features to disk so repeated evaluations of the same checkpoint
+    skip the forward pass. Every entry is a directory of .npy files (one per array)
+    with a meta.json, arrays are loaded back memory-mapped (copy-on-write: they can be
+    wrapped by torch.from_numpy without a copy, and the entry is never modified).
+
+    Args:
+    - root: directory holding the entries.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _entry_dir(self, key):
+        return osp.join(self.root, key)
+
+    def __contains__(self, key):
+        return osp.isfile(osp.join(self._entry_dir(key), 'meta.json'))
+
+    def load(self, key):
+        """Returns a dict name -> array (copy-on-write memmap), None when the key is missing."""
+        if key not in self:
+            return None
+        entry_dir = self._entry_dir(key)
+        meta = read_json(osp.join(entry_dir, 'meta.json'))
+        return {name: np.load(osp.join(entry_dir, name + '.npy'), mmap_mode='c') for name in meta['arrays']}
+
+    def save(self, key, **arrays):
+        """Saves tensors/arrays under key. The entry is written to a temporary directory
+        first and renamed, so an interrupted run never leaves a half written entry.
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = '{}.tmp{}'.format(entry_dir, os.getpid())
+        mkdir_if_missing(tmp_dir)
+        for name, array in arrays.items():
+            if torch.is_tensor(array):
+                array = array.cpu().numpy()
+            np.save(osp.join(tmp_dir, name + '.npy'), np.asarray(array))
+        write_json({'arrays': sorted(arrays.keys())}, osp.join(tmp_dir, 'meta.json'))
+        if osp.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(tmp_dir, entry_dir)
+
+    def load_splits(self, key, splits, need_paths=False):
+        """Returns {split: arrays} of an entry written by save_splits, the float arrays as
+        tensors sharing the memmaps. None when the key is missing, or when need_paths and
+        the entry was saved without image paths.
+        """
+        arrays = self.load(key)
+        if arrays is None:
+            return None
+        result = {}
+        for split in splits:
+            prefix = split + '_'
+            split_arrays = dict((name[len(prefix):], array) for name, array in arrays.items() if name.startswith(prefix))
+            if 'features' not in split_arrays or (need_paths and len(split_arrays['paths']) == 0):
+                return None
+            for name, array in split_arrays.items():
+                if array.dtype.kind == 'f':
+                    split_arrays[name] = torch.from_numpy(array)
+            result[split] = split_arrays
+        return result
+
+    def save_splits(self, key, split_arrays):
+        """Saves {split: arrays} (see extract_features) under key."""
+        self.save(key, **dict((split + '_' + name, array)
+                              for split, arrays in split_arrays.items() for name, array in arrays.items()))
+
+
+def load_or_extract_features(model, loaders, use_gpu=False, store=None, key=None, need_paths=False, feature_fn=None):
+    """Returns ({split: arrays}, batch_time) for the dict {split: dataloader} (see
+    extract_features). The arrays are loaded from store when it holds key, otherwise
+    they are extracted and saved under key.
+
+    Args:
+    - store: FeatureStore, or None to always extract.
+    - need_paths: the image paths are needed, entries saved without them are re-extracted.
+    """
+    batch_time = AverageMeter()
+    splits = store.load_splits(key, loaders.keys(), need_paths=need_paths) if store is not None and key else None
+    if splits is not None:
+        print("Loaded features from '{}'".format(store._entry_dir(key)))
+        return splits, batch_time
+
+    splits = {}
+    for split, dataloader in loaders.items():
+        splits[split], split_time = extract_features(model, dataloader, use_gpu=use_gpu, feature_fn=feature_fn)
+        batch_time.update(split_time.avg, split_time.count)
+        features = splits[split]['features']
+        print("Extracted features for {} set, obtained {}-by-{} matrix".format(split, features.size(0), features.size(1)))
+    if store is not None and key:
+        store.save_splits(key, splits)
+        print("Saved features to '{}'".format(store._entry_dir(key)))
+    return splits, batch_time
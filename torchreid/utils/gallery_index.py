@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import torch
+
+
+class GalleryIndex(object):
+    """Gallery of embeddings for live retrieval: new gallery entries are appended as they
+    come and queries return the top-k gallery entries, without building a distmat over the
+    whole query/gallery split. Features are kept in one contiguous (capacity, feat_dim)
+    tensor which doubles when full, a search is one matrix multiply per gallery block.
+    Distances are the ones of compute_distmat (squared euclidean, or 1 - cosine similarity).
+
+    Args:
+    - feat_dim: feature dimension.
+    - use_cosine: rank by cosine distance, features are normalized when added.
+    - dtype: storage type, torch.float32 or torch.float16 (half the memory, the products
+      are then computed in float16 on GPU).
+    - device: device holding the gallery, e.g. 'cuda'.
+    - capacity: number of entries allocated at first.
+    - block_size: number of gallery entries scored at once.
+    """
+    def __init__(self, feat_dim, use_cosine=False, dtype=torch.float32, device='cpu', capacity=1024, block_size=2**18):
+        self.feat_dim = feat_dim
+        self.use_cosine = use_cosine
+        self.dtype = dtype
+        self.device = torch.device(device)
+        self.block_size = block_size
+        self.size = 0
+        self.features = torch.empty((capacity, feat_dim), dtype=dtype, device=self.device)
+        self.sqnorms = torch.empty(capacity, dtype=torch.float32, device=self.device)
+        self.pids = torch.empty(capacity, dtype=torch.long, device=self.device)
+        self.camids = torch.empty(capacity, dtype=torch.long, device=self.device)
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, capacity):
+        if capacity <= self.features.size(0):
+            return
+        capacity = max(capacity, 2 * self.features.size(0))
+        for name in ['features', 'sqnorms', 'pids', 'camids']:
+            old = getattr(self, name)
+            new = old.new_empty((capacity,) + tuple(old.size()[1:]))
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _prepare(self, features):
+        features = torch.as_tensor(features).to(self.device, torch.float32)
+        if self.use_cosine:
+            features = features / features.norm(dim=1, keepdim=True)
+        return features
+
+    def add(self, features, pids, camids):
+        """Appends gallery entries.
+
+        Args:
+        - features: (n, feat_dim) features.
+        - pids, camids: n person and camera ids.
+
+        Returns the indices given to the new entries.
+        """
+        features = self._prepare(features)
+        n = features.size(0)
+        self._reserve(self.size + n)
+        start, stop = self.size, self.size + n
+        self.features[start:stop] = features.to(self.dtype)
+        self.sqnorms[start:stop] = features.pow(2).sum(dim=1)
+        self.pids[start:stop] = torch.as_tensor(pids, dtype=torch.long).to(self.device)
+        self.camids[start:stop] = torch.as_tensor(camids, dtype=torch.long).to(self.device)
+        self.size = stop
+        return torch.arange(start, stop)
+
+    def search(self, features, k=10, camids=None, pids=None):
+        """Returns the k nearest gallery entries of every query.
+        With camids, gallery entries of the query's camera are skipped, with pids too only
+        those of the same pid and camera are skipped, like eval_market1501. Positions
+        left without a valid entry (k larger than what is left) have an infinite distance.
+
+        Args:
+        - features: (m, feat_dim) query features.
+        - k: number of results per query.
+        - camids, pids: optional query camera and person ids, for the filtering.
+
+        Returns (distances, indices), both (m, k) cpu tensors sorted by increasing distance.
+        """
+        q = self._prepare(features)
+        m = q.size(0)
+        k = min(k, self.size)
+        q_sqnorms = q.pow(2).sum(dim=1, keepdim=True)
+        q = q.to(self.dtype) if self.device.type == 'cuda' else q
+        if camids is not None:
+            camids = torch.as_tensor(camids, dtype=torch.long).to(self.device).view(-1, 1)
+        if pids is not None:
+            pids = torch.as_tensor(pids, dtype=torch.long).to(self.device).view(-1, 1)
+
+        best_dist = torch.empty((m, 0), device=self.device)
+        best_idx = torch.empty((m, 0), dtype=torch.long, device=self.device)
+        for start in range(0, self.size, self.block_size):
+            stop = min(start + self.block_size, self.size)
+            gf = self.features[start:stop]
+            if gf.dtype != q.dtype:
+                gf = gf.to(q.dtype) # float16 storage, computed in float32 on cpu
+            if self.use_cosine:
+                distmat = 1 - torch.mm(q, gf.t()).float()
+            else:
+                distmat = torch.mm(q, gf.t()).float().mul_(-2).add_(q_sqnorms).add_(self.sqnorms[start:stop].view(1, -1))
+            if camids is not None:
+                remove = self.camids[start:stop].view(1, -1) == camids
+                if pids is not None:
+                    remove &= self.pids[start:stop].view(1, -1) == pids
+                distmat.masked_fill_(remove, float('inf'))
+            block_dist, block_idx = distmat.topk(min(k, stop - start), dim=1, largest=False)
+            best_dist = torch.cat((best_dist, block_dist), dim=1)
+            best_idx = torch.cat((best_idx, block_idx + start), dim=1)
+            if best_dist.size(1) > k:
+                best_dist, order = best_dist.topk(k, dim=1, largest=False)
+                best_idx = best_idx.gather(1, order)
+        # topk of a merged block is not sorted on every backend
+        best_dist, order = best_dist.sort(dim=1)
+        best_idx = best_idx.gather(1, order)
+        return best_dist.cpu(), best_idx.cpu()
@@ -3,8 +3,10 @@ from __future__ import absolute_import
 import os
 import os.path as osp
 import errno
+import glob
 import json
 import shutil
+import numpy as np
 
 import torch
 
@@ -42,4 +44,41 @@ def save_checkpoint(state, is_best=False, fpath='checkpoint.pth.tar'):
         mkdir_if_missing(osp.dirname(fpath))
     torch.save(state, fpath)
     if is_best:
-        shutil.copy(fpath, osp.join(osp.dirname(fpath), 'best_model.pth.tar'))
\ No newline at end of file
+        shutil.copy(fpath, osp.join(osp.dirname(fpath), 'best_model.pth.tar'))
+
+
+def load_manifest(dir_path, parse_fn, pattern='*.jpg'):
+    """Lists the images of dir_path and parses their (pid, camid) with parse_fn.
+    The result is cached in <dir_path>.manifest.npz next to the directory and reused
+    as long as the modification time of dir_path is unchanged (adding, removing or
+    renaming an image updates it), so later runs neither glob nor parse filenames.
+
+    Args:
+    - dir_path: image directory.
+    - parse_fn: function mapping an image path to (pid, camid).
+    - pattern: glob pattern of the images in dir_path.
+
+    Returns img_paths (list, in glob order), pids and camids (int64 arrays).
+    """
+    manifest_path = osp.normpath(dir_path) + '.manifest.npz'
+    mtime = os.stat(dir_path).st_mtime
+    if osp.isfile(manifest_path):
+        try:
+            manifest = np.load(manifest_path)
+            if float(manifest['mtime']) == mtime and str(manifest['pattern']) == pattern:
+                img_paths = [osp.join(dir_path, name) for name in manifest['names'].tolist()]
+                return img_paths, manifest['pids'], manifest['camids']
+        except (IOError, OSError, KeyError, ValueError):
+            pass # unreadable manifest, rebuild it
+
+    img_paths = glob.glob(osp.join(dir_path, pattern))
+    parsed = np.asarray([parse_fn(img_path) for img_path in img_paths], dtype=np.int64).reshape(-1, 2)
+    pids, camids = parsed[:, 0].copy(), parsed[:, 1].copy()
+    names = np.asarray([osp.basename(img_path) for img_path in img_paths], dtype=str)
+    tmp_path = osp.normpath(dir_path) + '.manifest.tmp.npz'
+    try:
+        np.savez(tmp_path, names=names, pids=pids, camids=camids, mtime=mtime, pattern=pattern)
+        os.rename(tmp_path, manifest_path)
+    except (IOError, OSError):
+        pass # read-only dataset directory, run without a manifest
+    return img_paths, pids, camids
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import torch
+
+
+def _to_cuda(batch):
+    if torch.is_tensor(batch):
+        return batch.cuda(non_blocking=True)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_to_cuda(item) for item in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    # tensors allocated on the side stream are now used on the main stream
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for item in batch:
+            _record_stream(item, stream)
+
+
+class _Raised(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_END = object()
+
+
+class DataPrefetcher(object):
+    """Wraps a DataLoader so the next batches are loaded while the current one is used.
+    A background thread keeps up to num_prefetch batches ready. With use_gpu, the next
+    batch is also copied to the GPU on a side CUDA stream with non-blocking copies
+    (create the DataLoader with pin_memory=True), so the .cuda() calls of the train
+    loops become no-ops. The data_time meters of the train loops then only measure the
+    loading that did not overlap with compute.
+
+    Args:
+    - loader: iterable of batches, e.g. a DataLoader.
+    - use_gpu: copy the batches to the current GPU.
+    - num_prefetch: number of batches kept ready by the background thread.
+    """
+    def __init__(self, loader, use_gpu=False, num_prefetch=2):
+        self.loader = loader
+        self.use_gpu = use_gpu
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = self._iter_thread()
+        if self.use_gpu:
+            batches = self._iter_cuda(batches)
+        return batches
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _load():
+            try:
+                for batch in self.loader:
+                    if not _put(batch):
+                        return
+                _put(_END)
+            except Exception as e:
+                _put(_Raised(e))
+
+        thread = threading.Thread(target=_load)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _END:
+                    break
+                if isinstance(batch, _Raised):
+                    raise batch.exc
+                yield batch
+        finally:
+            # also reached when the loop over the prefetcher is left early
+            stop.set()
+            thread.join()
+
+    def _iter_cuda(self, batches):
+        stream = torch.cuda.Stream()
+        next_batch = None
+        for batch in batches:
+            with torch.cuda.stream(stream):
+                batch = _to_cuda(batch)
+            if next_batch is not None:
+                yield next_batch
+            torch.cuda.current_stream().wait_stream(stream)
+            _record_stream(batch, torch.cuda.current_stream())
+            next_batch = batch
+        if next_batch is not None:
+            yield next_batch
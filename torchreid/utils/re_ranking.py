@@ -7,6 +7,9 @@ Modified by Houjing Huang, 2017-12-22.
 - This version accepts distance matrix instead of raw features.
 - The difference of `/` division between python 2 and 3 is handled.
 - numpy.float16 is replaced by numpy.float32 for numerical precision.
+- Only the top-(k1+1) neighbours of every sample are kept and V is a sparse
+  CSR matrix, so memory grows with (num_query + num_gallery) * k1 instead of
+  (num_query + num_gallery)^2.
 """
 
 """
@@ -27,6 +30,21 @@ Returns:
 
 
 import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+import torch
+
+from .distance import iter_distmat_blocks, paired_distance
+
+
+def _neighbour_csr(rank, num):
+    """Sparse 0/1 matrix with a row per sample marking the samples in `rank`."""
+    k = rank.shape[1]
+    indptr = np.arange(0, rank.shape[0] * k + 1, k)
+    return csr_matrix((np.ones(rank.size, dtype=np.float32), rank.ravel(), indptr), shape=(rank.shape[0], num))
+
+
+def _squared(dist):
+    return np.power(dist, 2).astype(np.float32)
 
 
 def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
@@ -34,66 +52,167 @@ def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
     # The following naming, e.g. gallery_num, is different from outer scope.
     # Don't care about it.
 
-    original_dist = np.concatenate(
-      [np.concatenate([q_q_dist, q_g_dist], axis=1),
-       np.concatenate([q_g_dist.T, g_g_dist], axis=1)],
-      axis=0)
-    original_dist = np.power(original_dist, 2).astype(np.float32)
-    original_dist = np.transpose(1. * original_dist/np.max(original_dist,axis = 0))
-    V = np.zeros_like(original_dist).astype(np.float32)
-    initial_rank = np.argsort(original_dist).astype(np.int32)
-
     query_num = q_g_dist.shape[0]
-    gallery_num = q_g_dist.shape[0] + q_g_dist.shape[1]
-    all_num = gallery_num
-
-    for i in range(all_num):
-        # k-reciprocal neighbors
-        forward_k_neigh_index = initial_rank[i,:k1+1]
-        backward_k_neigh_index = initial_rank[forward_k_neigh_index,:k1+1]
-        fi = np.where(backward_k_neigh_index==i)[0]
-        k_reciprocal_index = forward_k_neigh_index[fi]
-        k_reciprocal_expansion_index = k_reciprocal_index
-        for j in range(len(k_reciprocal_index)):
-            candidate = k_reciprocal_index[j]
-            candidate_forward_k_neigh_index = initial_rank[candidate,:int(np.around(k1/2.))+1]
-            candidate_backward_k_neigh_index = initial_rank[candidate_forward_k_neigh_index,:int(np.around(k1/2.))+1]
-            fi_candidate = np.where(candidate_backward_k_neigh_index == candidate)[0]
-            candidate_k_reciprocal_index = candidate_forward_k_neigh_index[fi_candidate]
-            if len(np.intersect1d(candidate_k_reciprocal_index,k_reciprocal_index))> 2./3*len(candidate_k_reciprocal_index):
-                k_reciprocal_expansion_index = np.append(k_reciprocal_expansion_index,candidate_k_reciprocal_index)
-
-        k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
-        weight = np.exp(-original_dist[i,k_reciprocal_expansion_index])
-        V[i,k_reciprocal_expansion_index] = 1.*weight/np.sum(weight)
-    original_dist = original_dist[:query_num,]
+    all_num = q_g_dist.shape[0] + q_g_dist.shape[1]
+    # rows of original_dist handled at once, keeps each dense slice around 2^25 entries
+    block_size = max(1, 2**25 // all_num)
+
+    def _original_dist_rows(start, stop):
+        # original_dist is the transpose of the stacked squared distance matrix,
+        # scaled column-wise by its maximum, so row i is column i of that matrix
+        if stop <= query_num:
+            rows = np.concatenate([q_q_dist[:, start:stop].T, q_g_dist[start:stop]], axis=1)
+        else:
+            rows = np.concatenate([q_g_dist[:, start-query_num:stop-query_num].T,
+                                   g_g_dist[:, start-query_num:stop-query_num].T], axis=1)
+        return 1. * _squared(rows) / max_dist[start:stop, np.newaxis]
+
+    def _original_dist_at(rows, cols):
+        # gather original_dist[rows, cols] without building the full matrix
+        dist = np.empty(len(rows), dtype=np.result_type(q_g_dist, q_q_dist, g_g_dist))
+        q_row, q_col = rows < query_num, cols < query_num
+        sel = q_row & q_col
+        dist[sel] = q_q_dist[cols[sel], rows[sel]]
+        sel = q_row & ~q_col
+        dist[sel] = q_g_dist[rows[sel], cols[sel]-query_num]
+        sel = ~q_row & q_col
+        dist[sel] = q_g_dist[cols[sel], rows[sel]-query_num]
+        sel = ~q_row & ~q_col
+        dist[sel] = g_g_dist[cols[sel]-query_num, rows[sel]-query_num]
+        return 1. * _squared(dist) / max_dist[rows]
+
+    # column-wise maximum of the stacked squared distance matrix
+    max_dist = np.empty(all_num, dtype=np.float32)
+    for start in range(0, query_num, block_size):
+        stop = min(start + block_size, query_num)
+        max_dist[start:stop] = np.maximum(_squared(q_q_dist[:, start:stop]).max(axis=0),
+                                          _squared(q_g_dist[start:stop]).max(axis=1))
+    for start in range(0, all_num - query_num, block_size):
+        stop = min(start + block_size, all_num - query_num)
+        max_dist[query_num+start:query_num+stop] = np.maximum(_squared(q_g_dist[:, start:stop]).max(axis=0),
+                                                              _squared(g_g_dist[:, start:stop]).max(axis=0))
+
+    # top-(k1+1) neighbours of every sample from a partial sort
+    num_neigh = min(max(k1 + 1, k2), all_num)
+    initial_rank = np.empty((all_num, num_neigh), dtype=np.int32)
+    for start in list(range(0, query_num, block_size)) + list(range(query_num, all_num, block_size)):
+        stop = min(start + block_size, query_num if start < query_num else all_num)
+        dist = _original_dist_rows(start, stop)
+        top = np.argpartition(dist, num_neigh - 1, axis=1)[:, :num_neigh]
+        order = np.argsort(np.take_along_axis(dist, top, axis=1), axis=1)
+        initial_rank[start:stop] = np.take_along_axis(top, order, axis=1)
+
+    original_dist = 1. * _squared(q_g_dist) / max_dist[:query_num, np.newaxis]
+    return _k_reciprocal_re_ranking(initial_rank, _original_dist_at, original_dist, k1, k2, lambda_value)
+
+
+def re_ranking_features(qf, gf, k1=20, k2=6, lambda_value=0.3, use_cosine=False):
+    """Re-ranking straight from query and gallery features.
+    The k1-nearest-neighbour graph is built with blocked matrix multiplies that keep
+    only the top-(k1+1) of each block of rows, so neither the query-query nor the
+    gallery-gallery distance matrix is ever materialized. Distances are the ones of
+    torchreid.utils.distance.compute_distmat, so the result matches
+    re_ranking(compute_distmat(qf, gf), compute_distmat(qf, qf), compute_distmat(gf, gf)).
+
+    Args:
+    - qf, gf: query and gallery feature tensors with shape (num_query, feat_dim) and (num_gallery, feat_dim).
+    - use_cosine: rank with 1 - cosine similarity instead of squared euclidean distance.
+    Returns:
+      final_dist: re-ranked distance, numpy array, shape [num_query, num_gallery]
+    """
+    query_num = qf.size(0)
+    all_num = qf.size(0) + gf.size(0)
+    feats = torch.cat((qf, gf), 0)
+    # rows of the distance matrix handled at once, keeps each dense slice around 2^25 entries
+    block_size = max(1, 2**25 // all_num)
+
+    max_dist = np.empty(all_num, dtype=np.float32)
+    num_neigh = min(max(k1 + 1, k2), all_num)
+    initial_rank = np.empty((all_num, num_neigh), dtype=np.int32)
+    original_dist = np.empty((query_num, all_num - query_num), dtype=np.float32)
+    for start, stop, dist in iter_distmat_blocks(feats, feats, block_size=block_size, use_cosine=use_cosine):
+        dist = _squared(dist)
+        # the distance matrix is symmetric, so the column maximum is the row maximum
+        max_dist[start:stop] = dist.max(axis=1)
+        top = np.argpartition(dist, num_neigh - 1, axis=1)[:, :num_neigh]
+        order = np.argsort(np.take_along_axis(dist, top, axis=1), axis=1)
+        initial_rank[start:stop] = np.take_along_axis(top, order, axis=1)
+        if start < query_num:
+            original_dist[start:min(stop, query_num)] = dist[:min(stop, query_num)-start, query_num:]
+    original_dist /= max_dist[:query_num, np.newaxis]
+
+    def _original_dist_at(rows, cols):
+        # distances of the requested pairs, a chunk of pairs at a time
+        dist = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), 2**16):
+            stop = min(start + 2**16, len(rows))
+            pair_rows = torch.from_numpy(rows[start:stop].astype(np.int64)).to(feats.device)
+            pair_cols = torch.from_numpy(cols[start:stop].astype(np.int64)).to(feats.device)
+            dist[start:stop] = paired_distance(feats[pair_rows], feats[pair_cols], use_cosine=use_cosine).cpu().numpy()
+        return 1. * _squared(dist) / max_dist[rows]
+
+    return _k_reciprocal_re_ranking(initial_rank, _original_dist_at, original_dist, k1, k2, lambda_value)
+
+
+def _k_reciprocal_re_ranking(initial_rank, original_dist_at, original_dist, k1, k2, lambda_value):
+    """Shared part of re_ranking and re_ranking_features.
+
+    Args:
+    - initial_rank: (all_num, >= k1+1) indices of the nearest neighbours of every sample, sorted.
+    - original_dist_at: callable returning the normalised original distance of (rows, cols) pairs.
+    - original_dist: normalised original query-gallery distance, shape [num_query, num_gallery].
+    """
+    query_num = original_dist.shape[0]
+    all_num = initial_rank.shape[0]
+
+    # k-reciprocal neighbours: j is in the top-(k1+1) of i and i in the top-(k1+1) of j
+    forward = _neighbour_csr(initial_rank[:, :k1+1], all_num)
+    k_reciprocal = forward.multiply(forward.T).tocsr()
+    half_forward = _neighbour_csr(initial_rank[:, :int(np.around(k1/2.))+1], all_num)
+    half_k_reciprocal = half_forward.multiply(half_forward.T).tocsr()
+
+    # a candidate j expands the set of i when more than 2/3 of the half-size
+    # k-reciprocal neighbours of j are k-reciprocal neighbours of i
+    overlap = k_reciprocal.multiply(k_reciprocal * half_k_reciprocal.T).tocoo()
+    half_count = np.diff(half_k_reciprocal.indptr)
+    expand = overlap.data > 2./3*half_count[overlap.col]
+    candidates = coo_matrix((np.ones(expand.sum(), dtype=np.float32), (overlap.row[expand], overlap.col[expand])),
+                            shape=(all_num, all_num)).tocsr()
+    k_reciprocal_expansion = (k_reciprocal + candidates * half_k_reciprocal).tocsr()
+    k_reciprocal_expansion.sum_duplicates()
+    k_reciprocal_expansion.sort_indices()
+
+    # V[i, j] = exp(-d(i, j)) normalised over the expanded k-reciprocal set of i
+    rows = np.repeat(np.arange(all_num), np.diff(k_reciprocal_expansion.indptr))
+    weight = np.exp(-original_dist_at(rows, k_reciprocal_expansion.indices))
+    weight_sum = np.bincount(rows, weights=weight, minlength=all_num).astype(np.float32)
+    V = csr_matrix((1.*weight/weight_sum[rows], k_reciprocal_expansion.indices, k_reciprocal_expansion.indptr),
+                   shape=(all_num, all_num))
     if k2 != 1:
-        V_qe = np.zeros_like(V,dtype=np.float32)
-        for i in range(all_num):
-            V_qe[i,:] = np.mean(V[initial_rank[i,:k2],:],axis=0)
-        V = V_qe
-        del V_qe
+        V = (_neighbour_csr(initial_rank[:, :k2], all_num) * V) / np.float32(k2)
     del initial_rank
-    invIndex = []
-    for i in range(gallery_num):
-        invIndex.append(np.where(V[:,i] != 0)[0])
-
-    jaccard_dist = np.zeros_like(original_dist,dtype = np.float32)
 
-
-    for i in range(query_num):
-        temp_min = np.zeros(shape=[1,gallery_num],dtype=np.float32)
-        indNonZero = np.where(V[i,:] != 0)[0]
-        indImages = []
-        indImages = [invIndex[ind] for ind in indNonZero]
-        for j in range(len(indNonZero)):
-            temp_min[0,indImages[j]] = temp_min[0,indImages[j]]+ np.minimum(V[i,indNonZero[j]],V[indImages[j],indNonZero[j]])
-        jaccard_dist[i] = 1-temp_min/(2.-temp_min)
+    # Jaccard distance from sparse min-sums between query rows and gallery rows of V
+    V_gallery = V[query_num:].tocsc()
+    g_indptr, g_rows, g_vals = V_gallery.indptr, V_gallery.indices, V_gallery.data
+    V_query = V[:query_num].tocsr()
+    # split the queries so that each block pairs up around 2^23 entries
+    query_rows = np.repeat(np.arange(query_num), np.diff(V_query.indptr))
+    num_pairs = np.cumsum(np.bincount(query_rows, weights=np.diff(g_indptr)[V_query.indices], minlength=query_num))
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(num_pairs, np.arange(2**23, num_pairs[-1], 2**23), side='right'), [query_num]]))
+    jaccard_dist = np.empty((query_num, all_num - query_num), dtype=np.float32)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        V_query = V[start:stop].tocoo()
+        # pair every query entry (i, l) with the gallery entries of column l
+        count = g_indptr[V_query.col + 1] - g_indptr[V_query.col]
+        pair_q = np.repeat(np.arange(len(V_query.data)), count)
+        pair_g = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + g_indptr[V_query.col][pair_q]
+        temp_min = coo_matrix((np.minimum(V_query.data[pair_q], g_vals[pair_g]), (V_query.row[pair_q], g_rows[pair_g])),
+                              shape=(stop - start, all_num - query_num)).toarray()
+        jaccard_dist[start:stop] = 1-temp_min/(2.-temp_min)
 
     final_dist = jaccard_dist*(1-lambda_value) + original_dist*lambda_value
     del original_dist
     del V
     del jaccard_dist
-    final_dist = final_dist[:query_num,query_num:]
     return final_dist
-
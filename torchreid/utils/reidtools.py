@@ -9,6 +9,7 @@ import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from .iotools import mkdir_if_missing
+from ..eval_metrics import rank_matches
 from collections import defaultdict
 from sortedcontainers import SortedDict
 
@@ -91,8 +92,9 @@ def plot_deltaTheta(distmat, dataset,save_dir='log/deltaTheta_results', min_rank
     assert num_q == len(dataset.query)
     assert num_g == len(dataset.gallery)
 
-    indices = np.argsort(distmat, axis=1)
     mkdir_if_missing(save_dir)
+    g_pids = np.asarray([gpid for _, gpid, _ in dataset.gallery])
+    g_rotations = np.asarray([grotation for _, _, grotation in dataset.gallery])
 
     dict_delta = defaultdict(int)
     dict_sum = defaultdict(int)
@@ -103,36 +105,29 @@ def plot_deltaTheta(distmat, dataset,save_dir='log/deltaTheta_results', min_rank
 
         qimg_path, qpid, qrotation = dataset.query[q_idx]
 
-
-        min_delta_rot = 360
-        min_delta_rank = min_rank
-        rank_idx = 1
-        for g_idx in indices[q_idx,:]:
-
-            gimg_path, gpid, grotation = dataset.gallery[g_idx]
-            invalid = (qpid == gpid) & (qrotation == grotation)
-
-            if not invalid :
-                if qpid == gpid and rank_idx >min_rank:
-                    sub_rot = abs(qrotation*root_angle - grotation*root_angle)
-                    delta_rot = 360 - sub_rot  if sub_rot >180 else sub_rot
-
-                    if delta_rot < min_delta_rot:
-                        min_delta_rot = delta_rot
-                        min_delta_rank = rank_idx
-                        min_gimg = gimg_path
-                        min_gidx = g_idx
-                elif qpid == gpid:
-                    break
-                rank_idx += 1
-        if min_delta_rank >min_rank:
-            dict_delta[min_delta_rot] += 1
-            dict_sum[min_delta_rot] += distmat[q_idx, min_gidx]
-            qdir = osp.join(save_dir,'Delta_Rot_{}'.format(str(min_delta_rot)),str(min_delta_rank)+'__'+ os.path.splitext(osp.basename(qimg_path))[0])
-            mkdir_if_missing(qdir)
-            #dict_imgs[min_delta_rot].append((qimg_path,min_gimg))
-            _cp_img_to(qimg_path, qdir, rank=0, prefix='query')
-            _cp_img_to(min_gimg, qdir, rank=min_delta_rank, prefix='gallery')
+        # only the ranks of the correct matches are needed, so the gallery is never fully sorted
+        same_pid = g_pids == qpid
+        invalid = same_pid & (g_rotations == qrotation)
+        match_idx, match_ranks = rank_matches(distmat[q_idx], same_pid & np.invert(invalid), invalid)
+        if len(match_ranks) == 0 or match_ranks[0] <= min_rank:
+            continue
+
+        sub_rot = np.abs(qrotation*root_angle - g_rotations[match_idx]*root_angle)
+        delta_rot = np.where(sub_rot > 180, 360 - sub_rot, sub_rot)
+        # matches are ordered by rank, so argmin keeps the best ranked one on ties
+        best = np.argmin(delta_rot)
+        min_delta_rot = delta_rot[best]
+        min_delta_rank = match_ranks[best]
+        min_gidx = match_idx[best]
+        min_gimg = dataset.gallery[min_gidx][0]
+
+        dict_delta[min_delta_rot] += 1
+        dict_sum[min_delta_rot] += distmat[q_idx, min_gidx]
+        qdir = osp.join(save_dir,'Delta_Rot_{}'.format(str(min_delta_rot)),str(min_delta_rank)+'__'+ os.path.splitext(osp.basename(qimg_path))[0])
+        mkdir_if_missing(qdir)
+        #dict_imgs[min_delta_rot].append((qimg_path,min_gimg))
+        _cp_img_to(qimg_path, qdir, rank=0, prefix='query')
+        _cp_img_to(min_gimg, qdir, rank=min_delta_rank, prefix='gallery')
 
     sorted_dict_delta = SortedDict(dict_delta)
     drawLineGraph(sorted_dict_delta,save_dir,'delta_rot_minRank_{}.png'.format(min_rank), 'Number of errors vs Delta Rotation', ylabel='Error Number')
@@ -175,8 +170,9 @@ def visualize_ranked_results(distmat, dataset, save_dir='log/ranked_results', to
     assert num_q == len(dataset.query)
     assert num_g == len(dataset.gallery)
 
-    indices = np.argsort(distmat, axis=1)
     mkdir_if_missing(save_dir)
+    g_pids = np.asarray([gpid for _, gpid, _ in dataset.gallery])
+    g_camids = np.asarray([gcamid for _, _, gcamid in dataset.gallery])
 
     def _cp_img_to(src, dst, rank, prefix):
         """
@@ -205,7 +201,12 @@ def visualize_ranked_results(distmat, dataset, save_dir='log/ranked_results', to
         _cp_img_to(qimg_path, qdir, rank=0, prefix=prefix)
         incorrect = False
         rank_idx = 1
-        for g_idx in indices[q_idx,:]:
+        # partially sort just enough samples to fill topk after the invalid ones are skipped
+        num_invalid = np.sum((g_pids == qpid) & (g_camids == qcamid))
+        num_ranked = min(num_g, topk + num_invalid)
+        order = np.argpartition(distmat[q_idx], num_ranked - 1)[:num_ranked]
+        order = order[np.argsort(distmat[q_idx, order])]
+        for g_idx in order:
             prefix='gallery'
             if rot_dict:
                 prefix = str(rank_idx)+'_gallery_rotp_'+ str(rot_dict['gallery'][g_idx])
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 from __future__ import division
+from __future__ import print_function
 
 import torch
 import torch.nn as nn
@@ -25,4 +26,26 @@ def count_num_param(model):
     if hasattr(model, 'classifier') and isinstance(model.classifier, nn.Module):
         # we ignore the classifier because it is unused at test time
         num_param -= sum(p.numel() for p in model.classifier.parameters()) / 1e+06
-    return num_param
\ No newline at end of file
+    return num_param
+
+def load_pretrained_weights(model, fpath):
+    """Loads the weights of checkpoint fpath into model, ignoring the layers which are
+    missing from model or don't match in size."""
+    pretrain_dict = torch.load(fpath)['state_dict']
+    model_dict = model.state_dict()
+    pretrain_dict = {k: v for k, v in pretrain_dict.items() if k in model_dict and model_dict[k].size() == v.size()}
+    model_dict.update(pretrain_dict)
+    model.load_state_dict(model_dict)
+    print("Loaded pretrained weights from '{}'".format(fpath))
+
+
+def resume_from_checkpoint(model, fpath):
+    """Loads checkpoint fpath into model, returns (start_epoch, rank1) to resume the
+    training from."""
+    checkpoint = torch.load(fpath)
+    model.load_state_dict(checkpoint['state_dict'])
+    start_epoch = checkpoint['epoch'] + 1
+    rank1 = checkpoint['rank1']
+    print("Loaded checkpoint from '{}'".format(fpath))
+    print("- start_epoch: {}\n- rank1: {}".format(start_epoch, rank1))
+    return start_epoch, rank1
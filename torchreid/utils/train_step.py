@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import torch
+
+
+def _to_float(outputs):
+    if torch.is_tensor(outputs):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(_to_float(item) for item in outputs)
+    return outputs
+
+
+class TrainStep(object):
+    """Forward and optimization step of the train loops, with optional mixed precision
+    and channels-last memory format.
+
+    With amp, the forward pass runs under autocast: float16 with a GradScaler on GPU,
+    bfloat16 on CPU (no scaling needed). The model outputs are cast back to float32, so
+    the losses (xent, htri, the information loss of the vib models, ...) are computed
+    in float32 exactly as without amp. With channels_last, the model weights and the
+    input images use the NHWC layout, faster for convolutions on tensor cores.
+
+    Args:
+    - use_gpu: the model runs on GPU.
+    - amp: use automatic mixed precision.
+    - channels_last: use the channels-last memory format.
+
+    Needs torch >= 2.0 (torch.autocast with bfloat16 on CPU).
+    """
+    def __init__(self, use_gpu=False, amp=False, channels_last=False):
+        self.device_type = 'cuda' if use_gpu else 'cpu'
+        self.amp = amp
+        self.dtype = torch.float16 if use_gpu else torch.bfloat16
+        self.channels_last = channels_last
+        if hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler(self.device_type, enabled=amp and use_gpu)
+        else:
+            # torch < 2.3
+            self.scaler = torch.cuda.amp.GradScaler(enabled=amp and use_gpu)
+
+    def prepare_model(self, model):
+        """Converts the model weights to the memory format, before nn.DataParallel."""
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def forward(self, model, imgs):
+        """Returns model(imgs), with float32 outputs."""
+        if self.channels_last and imgs.dim() == 4:
+            imgs = imgs.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(self.device_type, dtype=self.dtype, enabled=self.amp):
+            outputs = model(imgs)
+        return _to_float(outputs)
+
+    def step(self, loss, optimizer):
+        """Backward pass of loss and update of the parameters of optimizer."""
+        optimizer.zero_grad()
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
@@ -3,9 +3,8 @@ from __future__ import division
 
 import os
 import sys
-import time
-import datetime
 import argparse
+from functools import partial
 import os.path as osp
 import numpy as np
 
@@ -16,16 +15,19 @@ from torch.utils.data import DataLoader
 from torch.optim import lr_scheduler
 
 from torchreid import data_manager
-from torchreid.dataset_loader import ImageDataset
+from torchreid.dataset_loader import ImageDataset, eval_loaders, set_quarantine_file
+from torchreid.dataset_loader_cached import cached_eval_loaders
+from torchreid.dataset_loader_shards import ShardImageDataset
 from torchreid import transforms as T
 from torchreid import models
-from torchreid.losses import CrossEntropyLabelSmooth, TripletLoss, DeepSupervision,SoftTripletLoss
-from torchreid.utils.iotools import save_checkpoint, check_isfile
-from torchreid.utils.avgmeter import AverageMeter
+from torchreid.losses import CrossEntropyLabelSmooth, TripletLoss, SoftTripletLoss
+from torchreid.utils.iotools import check_isfile
+from torchreid.utils.prefetcher import DataPrefetcher
+from torchreid.utils.train_step import TrainStep
 from torchreid.utils.logger import Logger
-from torchreid.utils.torchtools import set_bn_to_eval, count_num_param
+from torchreid.utils.torchtools import count_num_param, load_pretrained_weights, resume_from_checkpoint
 from torchreid.utils.reidtools import visualize_ranked_results
-from torchreid.eval_metrics import evaluate
+from torchreid.engine import Engine, criterion_term, PrintHook, QuarantineHook, TensorboardHook
 from torchreid.samplers import RandomIdentitySampler
 from torchreid.optimizers import init_optim
 
@@ -72,6 +74,8 @@ parser.add_argument('--weight-decay', default=5e-04, type=float,
                     help="weight decay (default: 5e-04)")
 parser.add_argument('--margin', type=float, default=0.3,
                     help="margin for triplet loss")
+parser.add_argument('--mining', type=str, default='batch_hard', choices=['batch_hard', 'batch_all', 'semi_hard'],
+                    help="triplet mining strategy (default: batch_hard)")
 parser.add_argument('--num-instances', type=int, default=4,
                     help="number of instances per identity")
 parser.add_argument('--htri-only', action='store_true',
@@ -114,6 +118,20 @@ parser.add_argument('--use-avai-gpus', action='store_true',
                     help="use available gpus instead of specified devices (this is useful when using managed clusters)")
 parser.add_argument('--visualize-ranks', action='store_true',
                     help="visualize ranked results, only available in evaluation mode (default: False)")
+parser.add_argument('--prefetch', action='store_true',
+                    help="prefetch train batches in a background thread, and to the GPU on a side stream (default: False)")
+parser.add_argument('--amp', action='store_true',
+                    help="train with automatic mixed precision, float16 on GPU, bfloat16 on CPU (default: False)")
+parser.add_argument('--channels-last', action='store_true',
+                    help="train with the channels-last memory format (default: False)")
+parser.add_argument('--eval-cache', type=str, default='',
+                    help="directory of decoded and resized query/gallery images, built on first use (default: '', disabled)")
+parser.add_argument('--shard-dir', type=str, default='',
+                    help="read images from shards written by pack_dataset.py (default: '', read image files)")
+parser.add_argument('--draft-decode', action='store_true',
+                    help="decode large JPEGs at a reduced scale close to --height/--width (default: False)")
+parser.add_argument('--compact-tables', action='store_true',
+                    help="keep the dataset splits in compact arrays, DataLoader workers then share them instead of copying (default: False)")
 
 parser.add_argument('--soft-margin', action='store_true',
                     help="use Soft triplet loss (default: Fasle)")
@@ -146,6 +164,7 @@ def main(args):
     dataset = data_manager.init_imgreid_dataset(
         root=args.root, name=args.dataset, split_id=args.split_id,
         cuhk03_labeled=args.cuhk03_labeled, cuhk03_classic_split=args.cuhk03_classic_split,
+        compact=args.compact_tables,
     )
 
     transform_train = T.Compose([
@@ -163,25 +182,38 @@ def main(args):
     ])
 
     pin_memory = True if use_gpu else False
+    # unreadable images of all DataLoader workers are listed here
+    set_quarantine_file(osp.join(args.save_dir, 'quarantine.txt'))
+    if args.shard_dir:
+        image_dataset = partial(ShardImageDataset, shard_dir=args.shard_dir)
+        train_dataset = image_dataset
+    else:
+        image_dataset = partial(ImageDataset, draft_size=(args.width, args.height) if args.draft_decode else None)
+        # unreadable train images are replaced by other images, query/gallery ones raise IOError
+        train_dataset = partial(image_dataset, replace_unreadable=True)
 
     trainloader = DataLoader(
-        ImageDataset(dataset.train, transform=transform_train),
-        sampler=RandomIdentitySampler(dataset.train, args.train_batch, args.num_instances),
+        train_dataset(dataset.train, transform=transform_train),
+        sampler=RandomIdentitySampler(dataset.train, args.train_batch, args.num_instances, seed=args.seed),
         batch_size=args.train_batch, num_workers=args.workers,
         pin_memory=pin_memory, drop_last=True,
     )
 
-    queryloader = DataLoader(
-        ImageDataset(dataset.query, transform=transform_test),
-        batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-        pin_memory=pin_memory, drop_last=False,
+    queryloader, galleryloader = eval_loaders(
+        dataset, partial(image_dataset, transform=transform_test), args.test_batch,
+        num_workers=args.workers, pin_memory=pin_memory,
     )
 
-    galleryloader = DataLoader(
-        ImageDataset(dataset.gallery, transform=transform_test),
-        batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-        pin_memory=pin_memory, drop_last=False,
-    )
+    if args.eval_cache:
+        # decode and resize query/gallery once, ToTensor + Normalize run on whole batches
+        queryloader, galleryloader = cached_eval_loaders(
+            dataset, args.eval_cache, args.dataset, args.height, args.width, args.test_batch,
+            return_path=False, pin_memory=pin_memory,
+        )
+
+    if args.prefetch:
+        # load the next batches (and copy them to the GPU) while the current step runs
+        trainloader = DataPrefetcher(trainloader, use_gpu)
 
     print("Initializing model: {}".format(args.arch))
     model = models.init_model(name=args.arch, num_classes=dataset.num_train_pids, loss={'xent', 'htri'})
@@ -193,42 +225,42 @@ def main(args):
         criterion_xent = nn.CrossEntropyLoss()
 
     if args.soft_margin:
-        criterion_htri = SoftTripletLoss()
+        criterion_htri = SoftTripletLoss(mining=args.mining)
     else:
-        criterion_htri = TripletLoss(margin=args.margin)
+        criterion_htri = TripletLoss(margin=args.margin, mining=args.mining)
 
     optimizer = init_optim(args.optim, model.parameters(), args.lr, args.weight_decay)
     scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=args.stepsize, gamma=args.gamma)
+    fixbase_optimizer = None
     if args.fixbase_epoch > 0:
         if hasattr(model, 'classifier') and isinstance(model.classifier, nn.Module):
-            optimizer_tmp = init_optim(args.optim, model.classifier.parameters(), args.fixbase_lr, args.weight_decay)
+            fixbase_optimizer = init_optim(args.optim, model.classifier.parameters(), args.fixbase_lr, args.weight_decay)
         else:
             print("Warn: model has no attribute 'classifier' and fixbase_epoch is reset to 0")
             args.fixbase_epoch = 0
     if args.load_weights and check_isfile(args.load_weights):
-        # load pretrained weights but ignore layers that don't match in size
-        checkpoint = torch.load(args.load_weights)
-        pretrain_dict = checkpoint['state_dict']
-        model_dict = model.state_dict()
-        pretrain_dict = {k: v for k, v in pretrain_dict.items() if k in model_dict and model_dict[k].size() == v.size()}
-        model_dict.update(pretrain_dict)
-        model.load_state_dict(model_dict)
-        print("Loaded pretrained weights from '{}'".format(args.load_weights))
+        load_pretrained_weights(model, args.load_weights)
 
     if args.resume and check_isfile(args.resume):
-        checkpoint = torch.load(args.resume)
-        model.load_state_dict(checkpoint['state_dict'])
-        args.start_epoch = checkpoint['epoch'] + 1
-        best_rank1 = checkpoint['rank1']
-        print("Loaded checkpoint from '{}'".format(args.resume))
-        print("- start_epoch: {}\n- rank1: {}".format(args.start_epoch, best_rank1))
+        args.start_epoch, best_rank1 = resume_from_checkpoint(model, args.resume)
+
+    train_step = TrainStep(use_gpu, amp=args.amp, channels_last=args.channels_last)
+    model = train_step.prepare_model(model)
 
     if use_gpu:
         model = nn.DataParallel(model).cuda()
 
+    xent_term = criterion_term('Xent', criterion_xent, args.lambda_xent, index=0)
+    htri_term = criterion_term('Htri', criterion_htri, args.lambda_htri, index=1)
+    engine = Engine(
+        model, optimizer, [htri_term] if args.htri_only else [xent_term, htri_term],
+        use_gpu=use_gpu, train_step=train_step, hooks=[PrintHook(args.print_freq), QuarantineHook()],
+        use_metric_cuhk03=args.use_metric_cuhk03,
+    )
+
     if args.evaluate:
         print("Evaluate only")
-        distmat = test(model, queryloader, galleryloader, use_gpu,args,writer=None,epoch=-1, return_distmat=True)
+        distmat = engine.test(queryloader, galleryloader, return_distmat=True)
         if args.visualize_ranks:
             visualize_ranked_results(
                 distmat, dataset,
@@ -238,207 +270,13 @@ def main(args):
         return
 
     writer = SummaryWriter(log_dir=osp.join(args.save_dir, 'tensorboard'))
-    start_time = time.time()
-    train_time = 0
-    best_epoch = args.start_epoch
-    print("==> Start training")
-
-    if args.fixbase_epoch > 0:
-        print("Train classifier for {} epochs while keeping base network frozen".format(args.fixbase_epoch))
-
-        for epoch in range(args.fixbase_epoch):
-            start_train_time = time.time()
-            train(epoch, model, criterion_xent, None, optimizer_tmp, trainloader, use_gpu,writer, args, freeze_bn=True)
-            train_time += round(time.time() - start_train_time)
-
-        del optimizer_tmp
-        print("Now open all layers for training")
-
-    for epoch in range(args.start_epoch, args.max_epoch):
-        start_train_time = time.time()
-        train(epoch, model, criterion_xent, criterion_htri, optimizer, trainloader, use_gpu,writer, args)
-        train_time += round(time.time() - start_train_time)
-
-        scheduler.step()
-
-        if (epoch + 1) > args.start_eval and args.eval_step > 0 and (epoch + 1) % args.eval_step == 0 or (epoch + 1) == args.max_epoch:
-            print("==> Test")
-            rank1 = test(model, queryloader, galleryloader, use_gpu,args=args,writer=writer,epoch=epoch)
-            is_best = rank1 > best_rank1
-
-            if is_best:
-                best_rank1 = rank1
-                best_epoch = epoch + 1
-
-            if use_gpu:
-                state_dict = model.module.state_dict()
-            else:
-                state_dict = model.state_dict()
-
-            save_checkpoint({
-                'state_dict': state_dict,
-                'rank1': rank1,
-                'epoch': epoch,
-            }, is_best, osp.join(args.save_dir, 'checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-
-    print("==> Best Rank-1 {:.1%}, achieved at epoch {}".format(best_rank1, best_epoch))
-
-    elapsed = round(time.time() - start_time)
-    elapsed = str(datetime.timedelta(seconds=elapsed))
-    train_time = str(datetime.timedelta(seconds=train_time))
-    print("Finished. Total elapsed time (h:m:s): {}. Training time (h:m:s): {}.".format(elapsed, train_time))
-    return best_rank1, best_epoch
-
-def train(epoch, model, criterion_xent, criterion_htri, optimizer, trainloader, use_gpu,writer, args, freeze_bn=False):
-    losses = AverageMeter()
-    xent_losses = AverageMeter()
-    htri_losses = AverageMeter()
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    printed = False
-    model.train()
-    if freeze_bn or args.freeze_bn:
-        model.apply(set_bn_to_eval)
-    end = time.time()
-    for batch_idx, (imgs, pids, _) in enumerate(trainloader):
-        data_time.update(time.time() - end)
-
-        if use_gpu:
-            imgs, pids = imgs.cuda(), pids.cuda()
-
-        outputs, features = model(imgs)
-        if args.htri_only:
-            if isinstance(features, tuple):
-                htri_loss = DeepSupervision(criterion_htri, features, pids)
-            else:
-                htri_loss = criterion_htri(features, pids)
-            loss = args.lambda_htri * htri_loss
-        else:
-            if isinstance(outputs, tuple):
-                xent_loss = DeepSupervision(criterion_xent, outputs, pids)
-            else:
-                xent_loss = criterion_xent(outputs, pids)
-
-            htri_loss = 0
-            if not (criterion_htri is None):
-                if isinstance(features, tuple):
-                    htri_loss = DeepSupervision(criterion_htri, features, pids)
-                else:
-                    htri_loss = criterion_htri(features, pids)
-
-            loss = args.lambda_xent * xent_loss + args.lambda_htri * htri_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        batch_time.update(time.time() - end)
-
-        losses.update(loss.item(), pids.size(0))
-        if not args.htri_only:
-            xent_losses.update(xent_loss.item(), pids.size(0))
-        if criterion_htri is None:
-            htri_losses.update(htri_loss, pids.size(0))
-        else:
-            htri_losses.update(htri_loss.item(), pids.size(0))
-        if (batch_idx + 1) % args.print_freq == 0:
-            if not printed:
-              printed = True
-            else:
-              # Clean the current line
-              sys.stdout.console.write("\033[F\033[K")
-              #sys.stdout.console.write("\033[K")
-            print('Epoch: [{0}][{1}/{2}]\t'
-                  'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                  'Data {data_time.val:.4f} ({data_time.avg:.4f})\t'
-                  'Xent Loss {xent_loss.val:.4f} ({xent_loss.avg:.4f})\t'
-                  'Htri Loss {htri_loss.val:.4f} ({htri_loss.avg:.4f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   epoch + 1, batch_idx + 1, len(trainloader), batch_time=batch_time,
-                   data_time=data_time,xent_loss=xent_losses,htri_loss=htri_losses, loss=losses))
-
-        end = time.time()
-
-    writer.add_scalars(
-      'Losses',
-      dict(total_loss=losses.avg,
-           xen_loss=xent_losses.avg,
-           htri_loss=htri_losses.avg),
-      epoch + 1)
-
-
-def test(model, queryloader, galleryloader, use_gpu,args,writer,epoch, ranks=[1, 5, 10, 20], return_distmat=False):
-    batch_time = AverageMeter()
-
-    model.eval()
-
-    with torch.no_grad():
-        qf, q_pids, q_camids = [], [], []
-        for batch_idx, (imgs, pids, camids) in enumerate(queryloader):
-            if use_gpu:
-                imgs = imgs.cuda()
-
-            end = time.time()
-            features = model(imgs)
-            batch_time.update(time.time() - end)
-
-            features = features.data.cpu()
-            qf.append(features)
-            q_pids.extend(pids)
-            q_camids.extend(camids)
-        qf = torch.cat(qf, 0)
-        q_pids = np.asarray(q_pids)
-        q_camids = np.asarray(q_camids)
-
-        print("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
-
-        gf, g_pids, g_camids = [], [], []
-        for batch_idx, (imgs, pids, camids) in enumerate(galleryloader):
-            if use_gpu:
-                imgs = imgs.cuda()
-
-            end = time.time()
-            features = model(imgs)
-            batch_time.update(time.time() - end)
-
-            features = features.data.cpu()
-            gf.append(features)
-            g_pids.extend(pids)
-            g_camids.extend(camids)
-        gf = torch.cat(gf, 0)
-        g_pids = np.asarray(g_pids)
-        g_camids = np.asarray(g_camids)
-
-        print("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
-
-    print("==> BatchTime(s)/BatchSize(img): {:.3f}/{}".format(batch_time.avg, args.test_batch))
-
-    m, n = qf.size(0), gf.size(0)
-    distmat = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-              torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-    distmat.addmm_(1, -2, qf, gf.t())
-    distmat = distmat.numpy()
-
-    print("Computing CMC and mAP")
-    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, use_metric_cuhk03=args.use_metric_cuhk03)
-
-    print("Results ----------")
-    print("mAP: {:.1%}".format(mAP))
-    print("CMC curve")
-    for r in ranks:
-        print("Rank-{:<3}: {:.1%}".format(r, cmc[r-1]))
-    print("------------------")
-
-    if return_distmat:
-        return distmat
-    if writer != None:
-        writer.add_scalars(
-          'Testing',
-          dict(rank_1=cmc[0],
-               rank_5 = cmc[4],
-               mAP=mAP),
-          epoch + 1)
-    return cmc[0]
-
+    engine.hooks.append(TensorboardHook(writer))
+    return engine.run(
+        trainloader, lambda epoch: engine.test(queryloader, galleryloader, epoch=epoch),
+        args.max_epoch, args.save_dir, start_epoch=args.start_epoch, best_rank1=best_rank1,
+        fixbase_epoch=args.fixbase_epoch, fixbase_optimizer=fixbase_optimizer, fixbase_loss_terms=[xent_term],
+        scheduler=scheduler, freeze_bn=args.freeze_bn, eval_step=args.eval_step, start_eval=args.start_eval,
+    )
 
 if __name__ == '__main__':
     main(sys.argv[1:])
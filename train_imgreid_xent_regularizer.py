@@ -4,8 +4,8 @@ from __future__ import division
 import os
 import sys
 import time
-import datetime
 import argparse
+from functools import partial
 import os.path as osp
 import numpy as np
 
@@ -16,19 +16,23 @@ from torch.utils.data import DataLoader
 from torch.optim import lr_scheduler
 
 from torchreid import data_manager
+from torchreid.dataset_loader import eval_loaders
 from torchreid.dataset_loader_custom import ImageDataset
+from torchreid.dataset_loader_cached import cached_eval_loaders
+from torchreid.dataset_loader_shards import ShardImageDataset
 from torchreid import transforms as T
 from torchreid import models
-from torchreid.losses import CrossEntropyLabelSmooth, DeepSupervision
+from torchreid.losses import CrossEntropyLabelSmooth
 from torchried.losses import AngularLabelSmooth, AngleLoss, ConfidencePenalty, JSD_loss
-from torchreid.utils.iotools import save_checkpoint, check_isfile
-from torchreid.utils.avgmeter import AverageMeter
+from torchreid.utils.feature_store import FeatureStore, feature_cache_key
+from torchreid.utils.iotools import check_isfile
+from torchreid.utils.prefetcher import DataPrefetcher
+from torchreid.utils.train_step import TrainStep
 from torchreid.utils.logger import Logger
-from torchreid.utils.torchtools import set_bn_to_eval, count_num_param
-from torchreid.utils.reidtools import visualize_ranked_results, drawTSNE
-from torchreid.eval_metrics import evaluate
+from torchreid.utils.torchtools import count_num_param, load_pretrained_weights, resume_from_checkpoint
+from torchreid.utils.reidtools import visualize_ranked_results
 from torchreid.optimizers import init_optim
-from torchreid.utils.re_ranking import re_ranking
+from torchreid.engine import Engine, criterion_term, select_metric, PrintHook, TensorboardHook, TSNEHook
 
 from tensorboardX import SummaryWriter
 import random
@@ -39,8 +43,6 @@ import torchvision
 from torchreid.utils.visualize_class_activation_map import GradCam, show_cam_on_image
 from torchreid.utils.iotools import mkdir_if_missing
 
-## ECN
-from torchreid.utils.ecn import ECN_custom
 parser = argparse.ArgumentParser(description='Train image model with cross entropy loss')
 # Datasets
 parser.add_argument('--root', type=str, default='data',
@@ -118,6 +120,18 @@ parser.add_argument('--use-avai-gpus', action='store_true',
                     help="use available gpus instead of specified devices (this is useful when using managed clusters)")
 parser.add_argument('--visualize-ranks', action='store_true',
                     help="visualize ranked results, only available in evaluation mode (default: False)")
+parser.add_argument('--prefetch', action='store_true',
+                    help="prefetch train batches in a background thread, and to the GPU on a side stream (default: False)")
+parser.add_argument('--amp', action='store_true',
+                    help="train with automatic mixed precision, float16 on GPU, bfloat16 on CPU (default: False)")
+parser.add_argument('--channels-last', action='store_true',
+                    help="train with the channels-last memory format (default: False)")
+parser.add_argument('--eval-cache', type=str, default='',
+                    help="directory of decoded and resized query/gallery images, built on first use (default: '', disabled)")
+parser.add_argument('--shard-dir', type=str, default='',
+                    help="read images from shards written by pack_dataset.py (default: '', read image files)")
+parser.add_argument('--compact-tables', action='store_true',
+                    help="keep the dataset splits in compact arrays, DataLoader workers then share them instead of copying (default: False)")
 
 parser.add_argument('--lambda-xent', type=float, default=1,
                     help="weight to balance cross entropy loss")
@@ -146,6 +160,10 @@ parser.add_argument("--use-ecn", action='store_true',
 
 parser.add_argument("--use-cosine", action='store_true',
                     help="Use cosine distance to rank (default: False)")
+parser.add_argument('--eval-block-size', type=int, default=0,
+                    help="evaluate from features in blocks of N queries without building the full distance matrix (default: 0, disabled)")
+parser.add_argument('--feature-cache', type=str, default='',
+                    help="directory to save/load test features, with --evaluate the same checkpoint is only extracted once (default: '', disabled)")
 def main(args):
     args = parser.parse_args(args)
     #global best_rank1
@@ -180,6 +198,7 @@ def main(args):
     dataset = data_manager.init_imgreid_dataset(
         root=args.root, name=args.dataset, split_id=args.split_id,
         cuhk03_labeled=args.cuhk03_labeled, cuhk03_classic_split=args.cuhk03_classic_split,
+        compact=args.compact_tables,
     )
 
     transform_train = T.Compose([
@@ -198,24 +217,32 @@ def main(args):
     ])
 
     pin_memory = True if use_gpu else False
+    if args.shard_dir:
+        image_dataset = partial(ShardImageDataset, shard_dir=args.shard_dir)
+    else:
+        image_dataset = ImageDataset
 
     trainloader = DataLoader(
-        ImageDataset(dataset.train, transform=transform_train),
+        image_dataset(dataset.train, transform=transform_train),
         batch_size=args.train_batch, shuffle=True, num_workers=args.workers,
         pin_memory=pin_memory, drop_last=True,
     )
 
-    queryloader = DataLoader(
-        ImageDataset(dataset.query, transform=transform_test, return_path=args.draw_tsne),
-        batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-        pin_memory=pin_memory, drop_last=False,
+    queryloader, galleryloader = eval_loaders(
+        dataset, partial(image_dataset, transform=transform_test, return_path=args.draw_tsne), args.test_batch,
+        num_workers=args.workers, pin_memory=pin_memory,
     )
 
-    galleryloader = DataLoader(
-        ImageDataset(dataset.gallery, transform=transform_test, return_path=args.draw_tsne),
-        batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-        pin_memory=pin_memory, drop_last=False,
-    )
+    if args.eval_cache:
+        # decode and resize query/gallery once, ToTensor + Normalize run on whole batches
+        queryloader, galleryloader = cached_eval_loaders(
+            dataset, args.eval_cache, args.dataset, args.height, args.width, args.test_batch,
+            return_path=args.draw_tsne, pin_memory=pin_memory,
+        )
+
+    if args.prefetch:
+        # load the next batches (and copy them to the GPU) while the current step runs
+        trainloader = DataPrefetcher(trainloader, use_gpu)
 
     print("Initializing model: {}".format(args.arch))
     model = models.init_model(name=args.arch, num_classes=dataset.num_train_pids, loss={'xent','angular'} if args.use_angular else {'xent'}, use_gpu=use_gpu)
@@ -244,37 +271,52 @@ def main(args):
             print("Using Angular Loss")
             criterion = AngleLoss()
     optimizer = init_optim(args.optim, model.parameters(), args.lr, args.weight_decay)
+    scheduler = None
     if args.scheduler:
         scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=args.stepsize, gamma=args.gamma)
 
+    fixbase_optimizer = None
     if args.fixbase_epoch > 0:
         if hasattr(model, 'classifier') and isinstance(model.classifier, nn.Module):
-            optimizer_tmp = init_optim(args.optim, model.classifier.parameters(), args.fixbase_lr, args.weight_decay)
+            fixbase_optimizer = init_optim(args.optim, model.classifier.parameters(), args.fixbase_lr, args.weight_decay)
         else:
             print("Warn: model has no attribute 'classifier' and fixbase_epoch is reset to 0")
             args.fixbase_epoch = 0
 
     if args.load_weights and check_isfile(args.load_weights):
-        # load pretrained weights but ignore layers that don't match in size
-        checkpoint = torch.load(args.load_weights)
-        pretrain_dict = checkpoint['state_dict']
-        model_dict = model.state_dict()
-        pretrain_dict = {k: v for k, v in pretrain_dict.items() if k in model_dict and model_dict[k].size() == v.size()}
-        model_dict.update(pretrain_dict)
-        model.load_state_dict(model_dict)
-        print("Loaded pretrained weights from '{}'".format(args.load_weights))
+        load_pretrained_weights(model, args.load_weights)
 
     if args.resume and check_isfile(args.resume):
-        checkpoint = torch.load(args.resume)
-        model.load_state_dict(checkpoint['state_dict'])
-        args.start_epoch = checkpoint['epoch'] + 1
-        best_rank1 = checkpoint['rank1']
-        print("Loaded checkpoint from '{}'".format(args.resume))
-        print("- start_epoch: {}\n- rank1: {}".format(args.start_epoch, best_rank1))
+        args.start_epoch, best_rank1 = resume_from_checkpoint(model, args.resume)
+
+    train_step = TrainStep(use_gpu, amp=args.amp, channels_last=args.channels_last)
+    model = train_step.prepare_model(model)
 
     if use_gpu:
         model = nn.DataParallel(model).cuda()
 
+    if isinstance(criterion, tuple):
+        if args.confidence_penalty:
+            regularizer_weight = -args.confidence_beta
+        elif args.jsd:
+            regularizer_weight = args.confidence_beta
+        else:
+            regularizer_weight = None
+        loss_terms = [criterion_term('Xent', criterion[0], args.lambda_xent),
+                      criterion_term('JSD' if args.jsd else 'Confi', criterion[1], regularizer_weight)]
+    else:
+        loss_terms = [criterion_term('Xent', criterion, args.lambda_xent)]
+    hooks = [PrintHook(args.print_freq)]
+    if args.draw_tsne:
+        hooks.append(TSNEHook(args.save_dir, args.tsne_labels))
+    engine = Engine(
+        model, optimizer, loss_terms,
+        use_gpu=use_gpu, train_step=train_step, hooks=hooks,
+        metric=select_metric(use_cosine=args.use_cosine, use_ecn=args.use_ecn, re_ranking=args.re_ranking),
+        use_metric_cuhk03=args.use_metric_cuhk03, eval_block_size=args.eval_block_size,
+        feature_store=FeatureStore(args.feature_cache) if args.feature_cache else None,
+    )
+
     if args.single_folder != '':
         extract_features(model, use_gpu, args,transform_test, return_distmat=False)
         return
@@ -286,7 +328,12 @@ def main(args):
                 test_dir = os.path.dirname(args.resume)
             else:
                 test_dir = os.path.dirname(args.load_weights)
-        distmat = test(model, queryloader, galleryloader, use_gpu, args,writer=None,epoch=-1, return_distmat=True,draw_tsne=args.draw_tsne,tsne_clusters=args.tsne_labels)
+        feature_key = None
+        if args.feature_cache:
+            feature_key = feature_cache_key([args.load_weights, args.resume], args.arch, transform_test,
+                                            dict(root=args.root, dataset=args.dataset, split_id=args.split_id,
+                                                 cuhk03_labeled=args.cuhk03_labeled, cuhk03_classic_split=args.cuhk03_classic_split), use_angular=args.use_angular)
+        distmat = engine.test(queryloader, galleryloader, return_distmat=True, feature_key=feature_key)
 
         if args.visualize_ranks:
             visualize_ranked_results(
@@ -298,273 +345,13 @@ def main(args):
 
 
     writer = SummaryWriter(log_dir=osp.join(args.save_dir, 'tensorboard'))
-    start_time = time.time()
-    train_time = 0
-    best_epoch = args.start_epoch
-    print("==> Start training")
-
-    if args.fixbase_epoch > 0:
-        print("Train classifier for {} epochs while keeping base network frozen".format(args.fixbase_epoch))
-
-        for epoch in range(args.fixbase_epoch):
-            start_train_time = time.time()
-            train(epoch, model, criterion, optimizer_tmp, trainloader, use_gpu,writer, args, freeze_bn=True)
-            train_time += round(time.time() - start_train_time)
-
-        del optimizer_tmp
-        print("Now open all layers for training")
-    best_epoch = 0
-    for epoch in range(args.start_epoch, args.max_epoch):
-        start_train_time = time.time()
-        train(epoch, model, criterion, optimizer, trainloader, use_gpu,writer, args)
-        train_time += round(time.time() - start_train_time)
-
-        if args.scheduler:
-            scheduler.step()
-
-
-        if (epoch + 1) > args.start_eval and args.eval_step > 0 and (epoch + 1) % args.eval_step == 0 or (epoch + 1) == args.max_epoch:
-            if (epoch + 1) == args.max_epoch:
-                if use_gpu:
-                    state_dict = model.module.state_dict()
-                else:
-                    state_dict = model.state_dict()
-
-                save_checkpoint({
-                    'state_dict': state_dict,
-                    'rank1': -1,
-                    'epoch': epoch,
-                }, False, osp.join(args.save_dir, 'beforeTesting_checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-            print("==> Test")
-
-            rank1 = test(model, queryloader, galleryloader, use_gpu, args,writer=writer,epoch=epoch)
-
-            is_best = rank1 > best_rank1
-
-            if is_best:
-                best_rank1 = rank1
-                best_epoch = epoch + 1
-
-            if use_gpu:
-                state_dict = model.module.state_dict()
-            else:
-                state_dict = model.state_dict()
-
-            save_checkpoint({
-                'state_dict': state_dict,
-                'rank1': rank1,
-                'epoch': epoch,
-            }, is_best, osp.join(args.save_dir, 'checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-
-    print("==> Best Rank-1 {:.1%}, achieved at epoch {}".format(best_rank1, best_epoch))
-
-    elapsed = round(time.time() - start_time)
-    elapsed = str(datetime.timedelta(seconds=elapsed))
-    train_time = str(datetime.timedelta(seconds=train_time))
-    print("Finished. Total elapsed time (h:m:s): {}. Training time (h:m:s): {}.".format(elapsed, train_time))
-    return best_rank1, best_epoch
-
-def train(epoch, model, criterion, optimizer, trainloader, use_gpu,writer, args,freeze_bn=False):
-    losses = AverageMeter()
-    xent_losses = AverageMeter()
-    confidence_losses = AverageMeter()
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    printed = False
-    model.train()
-
-    if freeze_bn or args.freeze_bn:
-        model.apply(set_bn_to_eval)
-
-    end = time.time()
-    for batch_idx, (imgs, pids, _) in enumerate(trainloader):
-        data_time.update(time.time() - end)
-
-        if use_gpu:
-            imgs, pids = imgs.cuda(), pids.cuda()
-
-        outputs = model(imgs)
-        if isinstance(outputs, tuple):
-            xent_loss = DeepSupervision(criterion[0], outputs, pids)
-            confidence_loss = DeepSupervision(criterion[1],outputs,pids)
-        else:
-            xent_loss = criterion[0](outputs, pids)
-            confidence_loss = criterion[1](outputs,pids)
-        if args.confidence_penalty:
-
-            loss = args.lambda_xent *xent_loss - args.confidence_beta *confidence_loss
-        elif args.jsd:
-            loss = args.lambda_xent *xent_loss + args.confidence_beta *confidence_loss
-        else:
-            loss = args.lambda_xent *xent_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        batch_time.update(time.time() - end)
-
-        losses.update(loss.item(), pids.size(0))
-        xent_losses.update(xent_loss.item(), pids.size(0))
-        confidence_losses.update(confidence_loss.item(), pids.size(0))
-
-        if (batch_idx + 1) % args.print_freq == 0:
-            if not printed:
-              printed = True
-            else:
-              # Clean the current line
-              sys.stdout.console.write("\033[F\033[K")
-              #sys.stdout.console.write("\033[K")
-            if args.jsd:
-                print('Epoch: [{0}][{1}/{2}]\t'
-                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                      'Data {data_time.val:.4f} ({data_time.avg:.4f})\t'
-                      'Xent_Loss {xent_loss.val:.4f} ({xent_loss.avg:.4f})\t'
-                      'JSD_Loss {confidence_loss.val:.4f} ({confidence_loss.avg:.4f})\t'
-                      'Total_Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                       epoch + 1, batch_idx + 1, len(trainloader), batch_time=batch_time,
-                       data_time=data_time,xent_loss=xent_losses,confidence_loss=confidence_losses, loss=losses))
-            else:
-                print('Epoch: [{0}][{1}/{2}]\t'
-                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                      'Data {data_time.val:.4f} ({data_time.avg:.4f})\t'
-                      'Xent_Loss {xent_loss.val:.4f} ({xent_loss.avg:.4f})\t'
-                      'Confi_Loss {confidence_loss.val:.4f} ({confidence_loss.avg:.4f})\t'
-                      'Total_Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                       epoch + 1, batch_idx + 1, len(trainloader), batch_time=batch_time,
-                       data_time=data_time,xent_loss=xent_losses,confidence_loss=confidence_losses, loss=losses))
-
-        end = time.time()
-
-    writer.add_scalars(
-      'loss',
-      dict(loss=losses.avg,
-            xent_loss = xent_losses.avg,
-            confidence_loss = confidence_losses.avg),
-      epoch + 1)
-
-def test(model, queryloader, galleryloader, use_gpu, args,writer,epoch, ranks=[1, 5, 10, 20], return_distmat=False,tsne_clusters=3):
-
-    batch_time = AverageMeter()
-
-    model.eval()
-
-    with torch.no_grad():
-        qf, q_pids, q_camids = [], [], []
-        q_imgPath = []
-        for batch_idx, (input) in enumerate(queryloader):
-            if not args.draw_tsne:
-                imgs, pids, camids = input
-            else:
-                imgs, pids, camids,img_path = input
-                q_imgPath.extend(img_path)
-            if use_gpu: imgs = imgs.cuda()
-
-            end = time.time()
-            features = model(imgs)
-            batch_time.update(time.time() - end)
-
-            features = features.data.cpu()
-            qf.append(features)
-            q_pids.extend(pids)
-            q_camids.extend(camids)
-        qf = torch.cat(qf, 0)
-        q_pids = np.asarray(q_pids)
-        q_camids = np.asarray(q_camids)
-        q_imgPath = np.asarray(q_imgPath)
-
-        print("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
-
-        gf, g_pids, g_camids = [], [], []
-        g_imgPath = []
-        end = time.time()
-        for batch_idx, (input) in enumerate(galleryloader):
-            if not args.draw_tsne:
-                imgs, pids, camids = input
-            else:
-                imgs, pids, camids,img_path = input
-                g_imgPath.extend(img_path)
-            if use_gpu: imgs = imgs.cuda()
-
-            end = time.time()
-            features = model(imgs)
-            batch_time.update(time.time() - end)
-
-            features = features.data.cpu()
-            gf.append(features)
-            g_pids.extend(pids)
-            g_camids.extend(camids)
-        gf = torch.cat(gf, 0)
-        g_pids = np.asarray(g_pids)
-        g_camids = np.asarray(g_camids)
-        g_imgPath = np.asarray(q_imgPath)
-
-        print("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
-
-    print("==> BatchTime(s)/BatchSize(img): {:.3f}/{}".format(batch_time.avg, args.test_batch))
-
-    if args.use_ecn:
-        distmat= (ECN_custom(qf,gf,k=25,t=3,q=8,method='rankdist',use_cosine=args.use_cosine)).transpose()
-    elif not args.use_cosine:
-        m, n = qf.size(0), gf.size(0)
-        distmat = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-                  torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        distmat.addmm_(1, -2, qf, gf.t())
-        distmat = distmat.numpy()
-
-        if args.re_ranking:
-            distmat_q_q = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m) + \
-                      torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m).t()
-            distmat_q_q.addmm_(1, -2, qf, qf.t())
-            distmat_q_q = distmat_q_q.numpy()
-
-            distmat_g_g = torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n) + \
-                      torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n).t()
-            distmat_g_g.addmm_(1, -2, gf, gf.t())
-            distmat_g_g = distmat_g_g.numpy()
-
-            distmat = re_ranking(distmat, distmat_q_q, distmat_g_g, k1=20, k2=6, lambda_value=0.3)
-
-
-    else:
-        m, n = qf.size(0), gf.size(0)
-        qf_norm = qf/qf.norm(dim=1)[:,None]
-        gf_norm = gf/gf.norm(dim=1)[:,None]
-        distmat = torch.addmm(1,torch.ones((m,n)),-1,qf_norm,gf_norm.transpose(0,1))
-        distmat = distmat.numpy()
-
-        if args.re_ranking:
-            distmat_q_q = torch.addmm(1,torch.ones((m,m)),-1,qf_norm,qf_norm.transpose(0,1))
-            distmat_q_q = distmat_q_q.numpy()
-
-            distmat_g_g = torch.addmm(1,torch.ones((n,n)),-1,gf_norm,gf_norm.transpose(0,1))
-            distmat_g_g = distmat_g_g.numpy()
-
-            distmat = re_ranking(distmat, distmat_q_q, distmat_g_g, k1=20, k2=6, lambda_value=0.3)
-
-    print("Computing CMC and mAP")
-    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, use_metric_cuhk03=args.use_metric_cuhk03)
-
-    print("Results ----------")
-    print("mAP: {:.1%}".format(mAP))
-    print("CMC curve")
-    for r in ranks:
-        print("Rank-{:<3}: {:.1%}".format(r, cmc[r-1]))
-    print("------------------")
-
-    if args.draw_tsne:
-        drawTSNE(qf,gf,q_pids, g_pids, q_camids, g_camids,q_imgPath, g_imgPath,tsne_clusters,args.save_dir)
-    if return_distmat:
-        return distmat
-
-
-    if writer != None:
-        writer.add_scalars(
-          'Testing',
-          dict(rank_1=cmc[0],
-               rank_5 = cmc[4],
-               mAP=mAP),
-          epoch + 1)
-    return cmc[0]
+    engine.hooks.append(TensorboardHook(writer))
+    return engine.run(
+        trainloader, lambda epoch: engine.test(queryloader, galleryloader, epoch=epoch),
+        args.max_epoch, args.save_dir, start_epoch=args.start_epoch, best_rank1=best_rank1,
+        fixbase_epoch=args.fixbase_epoch, fixbase_optimizer=fixbase_optimizer,
+        scheduler=scheduler, freeze_bn=args.freeze_bn, eval_step=args.eval_step, start_eval=args.start_eval, save_before_test=True,
+    )
 
 def extract_features(model, use_gpu, args,test_transform, return_distmat=False):
     batch_size = 64
@@ -4,8 +4,8 @@ from __future__ import division
 import os
 import sys
 import time
-import datetime
 import argparse
+from functools import partial
 import os.path as osp
 import numpy as np
 
@@ -16,17 +16,23 @@ from torch.utils.data import DataLoader
 from torch.optim import lr_scheduler
 
 from torchreid import data_manager
+from torchreid.dataset_loader import eval_loaders
 from torchreid.dataset_loader_custom import ImageDataset
+from torchreid.dataset_loader_shards import ImageShards
+from torchreid.dataset_loader_cached import cached_eval_loaders
 from torchreid import transforms as T
 from torchreid import models
-from torchreid.losses import CrossEntropyLabelSmooth, DeepSupervision, DeepSupervisionAdaptive,AdaptiveLabelSmooth,LabelSmooth_sigmoid,AdaptiveLabelSmooth_sigmoid,modifiedBCE
-from torchreid.utils.iotools import save_checkpoint, check_isfile
+from torchreid.losses import CrossEntropyLabelSmooth, DeepSupervisionAdaptive,AdaptiveLabelSmooth,LabelSmooth_sigmoid,AdaptiveLabelSmooth_sigmoid,modifiedBCE
+from torchreid.utils.feature_store import FeatureStore, feature_cache_key
+from torchreid.utils.iotools import check_isfile
 from torchreid.utils.avgmeter import AverageMeter
+from torchreid.utils.prefetcher import DataPrefetcher
+from torchreid.utils.train_step import TrainStep
 from torchreid.utils.logger import Logger
-from torchreid.utils.torchtools import set_bn_to_eval, count_num_param
+from torchreid.utils.torchtools import set_bn_to_eval, count_num_param, load_pretrained_weights, resume_from_checkpoint
 from torchreid.utils.reidtools import visualize_ranked_results, plot_deltaTheta
-from torchreid.eval_metrics import evaluate
 from torchreid.optimizers import init_optim
+from torchreid.engine import Engine, LossTerm, PrintHook, TensorboardHook, supervise
 
 from tensorboardX import SummaryWriter
 import random
@@ -115,6 +121,16 @@ parser.add_argument('--use-avai-gpus', action='store_true',
                     help="use available gpus instead of specified devices (this is useful when using managed clusters)")
 parser.add_argument('--visualize-ranks', action='store_true',
                     help="visualize ranked results, only available in evaluation mode (default: False)")
+parser.add_argument('--prefetch', action='store_true',
+                    help="prefetch train batches in a background thread, and to the GPU on a side stream (default: False)")
+parser.add_argument('--amp', action='store_true',
+                    help="train with automatic mixed precision, float16 on GPU, bfloat16 on CPU (default: False)")
+parser.add_argument('--channels-last', action='store_true',
+                    help="train with the channels-last memory format (default: False)")
+parser.add_argument('--eval-cache', type=str, default='',
+                    help="directory of decoded and resized query/gallery images, built on first use (default: '', disabled)")
+parser.add_argument('--shard-dir', type=str, default='',
+                    help="read images from shards written by pack_dataset.py (default: '', read image files)")
 
 parser.add_argument('--lambda-xent', type=float, default=1,
                     help="weight to balance cross entropy loss")
@@ -124,6 +140,10 @@ parser.add_argument('--initial-train', type=int, default=0,
 
 parser.add_argument('--use-sigmoid', action='store_true',
                     help="use sigmoid instead of softmax(default: False)")
+parser.add_argument('--eval-block-size', type=int, default=0,
+                    help="evaluate from features in blocks of N queries without building the full distance matrix (default: 0, disabled)")
+parser.add_argument('--feature-cache', type=str, default='',
+                    help="directory to save/load test features, with --evaluate the same checkpoint is only extracted once (default: '', disabled)")
 # global variables
 #args = parser.parse_args()
 #best_rank1 = -np.inf
@@ -187,43 +207,32 @@ def main(args):
     ])
 
     pin_memory = True if use_gpu else False
+    image_dataset = ImageDataset
+    if args.shard_dir:
+        # the custom ImageDataset still applies the transforms (RandomHorizontalFlip_rot)
+        image_dataset = partial(ImageDataset, read_fn=ImageShards(args.shard_dir).read_path)
+
+    trainloader = DataLoader(
+        image_dataset(dataset.train, transform=transform_train),
+        batch_size=args.train_batch, shuffle=True, num_workers=args.workers,
+        pin_memory=pin_memory, drop_last=True,
+    )
 
-    if not (args.dataset == 'market1501' or args.dataset == 'msmt17' or args.dataset == 'dukemtmcreid' or args.dataset == 'cuhk03'):
-        trainloader = DataLoader(
-            ImageDataset(dataset.train,dataset.root_angle, transform=transform_train),
-            batch_size=args.train_batch, shuffle=True, num_workers=args.workers,
-            pin_memory=pin_memory, drop_last=True,
-        )
-
-        queryloader = DataLoader(
-            ImageDataset(dataset.query,dataset.root_angle, transform=transform_test),
-            batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-            pin_memory=pin_memory, drop_last=False,
-        )
-
-        galleryloader = DataLoader(
-            ImageDataset(dataset.gallery,dataset.root_angle, transform=transform_test),
-            batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-            pin_memory=pin_memory, drop_last=False,
-        )
-    else:
-        trainloader = DataLoader(
-            ImageDataset(dataset.train,-1, transform=transform_train),
-            batch_size=args.train_batch, shuffle=True, num_workers=args.workers,
-            pin_memory=pin_memory, drop_last=True,
-        )
+    queryloader, galleryloader = eval_loaders(
+        dataset, partial(image_dataset, transform=transform_test), args.test_batch,
+        num_workers=args.workers, pin_memory=pin_memory,
+    )
 
-        queryloader = DataLoader(
-            ImageDataset(dataset.query,-1, transform=transform_test),
-            batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-            pin_memory=pin_memory, drop_last=False,
+    if args.eval_cache:
+        # decode and resize query/gallery once, ToTensor + Normalize run on whole batches
+        queryloader, galleryloader = cached_eval_loaders(
+            dataset, args.eval_cache, args.dataset, args.height, args.width, args.test_batch,
+            return_path=False, pin_memory=pin_memory,
         )
 
-        galleryloader = DataLoader(
-            ImageDataset(dataset.gallery,-1, transform=transform_test),
-            batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-            pin_memory=pin_memory, drop_last=False,
-        )
+    if args.prefetch:
+        # load the next batches (and copy them to the GPU) while the current step runs
+        trainloader = DataPrefetcher(trainloader, use_gpu)
 
     print("Initializing model: {}".format(args.arch))
     model = models.init_model(name=args.arch, num_classes=dataset.num_train_pids, loss={'xent'}, use_gpu=use_gpu)
@@ -245,37 +254,40 @@ def main(args):
         else:
             criterion_simple = nn.CrossEntropyLoss()
     optimizer = init_optim(args.optim, model.parameters(), args.lr, args.weight_decay)
+    scheduler = None
     if args.scheduler != 0:
         scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=args.stepsize, gamma=args.gamma)
 
+    fixbase_optimizer = None
     if args.fixbase_epoch > 0:
         if hasattr(model, 'classifier') and isinstance(model.classifier, nn.Module):
-            optimizer_tmp = init_optim(args.optim, model.classifier.parameters(), args.fixbase_lr, args.weight_decay)
+            fixbase_optimizer = init_optim(args.optim, model.classifier.parameters(), args.fixbase_lr, args.weight_decay)
         else:
             print("Warn: model has no attribute 'classifier' and fixbase_epoch is reset to 0")
             args.fixbase_epoch = 0
 
     if args.load_weights and check_isfile(args.load_weights):
-        # load pretrained weights but ignore layers that don't match in size
-        checkpoint = torch.load(args.load_weights)
-        pretrain_dict = checkpoint['state_dict']
-        model_dict = model.state_dict()
-        pretrain_dict = {k: v for k, v in pretrain_dict.items() if k in model_dict and model_dict[k].size() == v.size()}
-        model_dict.update(pretrain_dict)
-        model.load_state_dict(model_dict)
-        print("Loaded pretrained weights from '{}'".format(args.load_weights))
+        load_pretrained_weights(model, args.load_weights)
 
     if args.resume and check_isfile(args.resume):
-        checkpoint = torch.load(args.resume)
-        model.load_state_dict(checkpoint['state_dict'])
-        args.start_epoch = checkpoint['epoch'] + 1
-        best_rank1 = checkpoint['rank1']
-        print("Loaded checkpoint from '{}'".format(args.resume))
-        print("- start_epoch: {}\n- rank1: {}".format(args.start_epoch, best_rank1))
+        args.start_epoch, best_rank1 = resume_from_checkpoint(model, args.resume)
+
+    train_step = TrainStep(use_gpu, amp=args.amp, channels_last=args.channels_last)
+    model = train_step.prepare_model(model)
 
     if use_gpu:
         model = nn.DataParallel(model).cuda()
 
+    # the model outputs (outputs, epsilon), epsilon is logged as a term of weight None
+    epsilon_term = LossTerm('Epsilon', lambda outputs, pids: outputs[1].mean(), None)
+    simple_terms = [smoothing_term(criterion_simple, args.lambda_xent), epsilon_term]
+    engine = Engine(
+        model, optimizer, [smoothing_term(criterion, args.lambda_xent), epsilon_term],
+        use_gpu=use_gpu, train_step=train_step, hooks=[PrintHook(args.print_freq)],
+        use_metric_cuhk03=args.use_metric_cuhk03, eval_block_size=args.eval_block_size,
+        feature_store=FeatureStore(args.feature_cache) if args.feature_cache else None,
+    )
+
     if args.evaluate:
         print("Evaluate only")
         test_dir = args.save_dir
@@ -284,7 +296,14 @@ def main(args):
                 test_dir = os.path.dirname(args.resume)
             else:
                 test_dir = os.path.dirname(args.load_weights)
-        distmat = test(model, queryloader, galleryloader, use_gpu, args,writer=None,epoch=-1, return_distmat=True, use_cosine = args.plot_deltaTheta)
+        feature_key = None
+        if args.feature_cache:
+            feature_key = feature_cache_key([args.load_weights, args.resume], args.arch, transform_test,
+                                            dict(root=args.root, dataset=args.dataset, split_id=args.split_id,
+                                                 cuhk03_labeled=args.cuhk03_labeled, cuhk03_classic_split=args.cuhk03_classic_split))
+        if args.plot_deltaTheta:
+            engine.metric = 'cosine'
+        distmat = engine.test(queryloader, galleryloader, return_distmat=True, feature_key=feature_key)
 
         if args.visualize_ranks:
             visualize_ranked_results(
@@ -298,11 +317,7 @@ def main(args):
 
 
     writer = SummaryWriter(log_dir=osp.join(args.save_dir, 'tensorboard'))
-    start_time = time.time()
-    train_time = 0
-    best_epoch = args.start_epoch
-    print("==> Start training")
-
+    engine.hooks.append(TensorboardHook(writer))
     if args.test_rot:
         print("Training only classifier for rotation")
         model = models.init_model(name='rot_tester',base_model=model,inplanes=2048,num_rot_classes = 8)
@@ -310,131 +325,23 @@ def main(args):
         optimizer_rot = init_optim(args.optim, model.fc_rot.parameters(), args.fixbase_lr, args.weight_decay)
         if use_gpu:
             model = nn.DataParallel(model).cuda()
-        try:
-            best_epoch = 0
-            for epoch in range(0, args.max_epoch):
-                start_train_time = time.time()
-                train_rotTester(epoch, model, criterion_rot, optimizer_rot, trainloader, use_gpu, writer,args)
-                train_time += round(time.time() - start_train_time)
-
-                if args.scheduler != 0:
-                    scheduler.step()
-
-                if (epoch + 1) > args.start_eval and args.eval_step > 0 and (epoch + 1) % args.eval_step == 0 or (epoch + 1) == args.max_epoch:
-                    if (epoch + 1) == args.max_epoch:
-                        if use_gpu:
-                            state_dict = model.module.state_dict()
-                        else:
-                            state_dict = model.state_dict()
-
-                        save_checkpoint({
-                            'state_dict': state_dict,
-                            'rank1': -1,
-                            'epoch': epoch,
-                        }, False, osp.join(args.save_dir, 'beforeTesting_checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-                    print("==> Test")
-                    rank1 = test_rotTester(model,criterion_rot,queryloader, galleryloader, trainloader, use_gpu,args,writer=writer,epoch=epoch)
-                    is_best = rank1 > best_rank1
-
-                    if is_best:
-                        best_rank1 = rank1
-                        best_epoch = epoch + 1
-
-                    if use_gpu:
-                        state_dict = model.module.state_dict()
-                    else:
-                        state_dict = model.state_dict()
-
-                    save_checkpoint({
-                        'state_dict': state_dict,
-                        'rank1': rank1,
-                        'epoch': epoch,
-                    }, is_best, osp.join(args.save_dir, 'checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-
-            print("==> Best Cccuracy {:.1%}, achieved at epoch {}".format(best_rank1, best_epoch))
-
-            elapsed = round(time.time() - start_time)
-            elapsed = str(datetime.timedelta(seconds=elapsed))
-            train_time = str(datetime.timedelta(seconds=train_time))
-            print("Finished. Total elapsed time (h:m:s): {}. Training time (h:m:s): {}.".format(elapsed, train_time))
-            return best_rank1, best_epoch
-        except KeyboardInterrupt:
-            if use_gpu:
-                state_dict = model.module.state_dict()
-            else:
-                state_dict = model.state_dict()
-
-            save_checkpoint({
-                'state_dict': state_dict,
-                'rank1': -1,
-                'epoch': epoch,
-            }, False, osp.join(args.save_dir, 'keyboardInterrupt_checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-
-        return None, None
-
-    if args.fixbase_epoch > 0:
-        print("Train classifier for {} epochs while keeping base network frozen".format(args.fixbase_epoch))
-
-        for epoch in range(args.fixbase_epoch):
-            start_train_time = time.time()
-            train(epoch, model, criterion_simple, optimizer_tmp, trainloader, use_gpu,writer, args, freeze_bn=True)
-            train_time += round(time.time() - start_train_time)
-
-        del optimizer_tmp
-        print("Now open all layers for training")
-    best_epoch = 0
-    for epoch in range(args.start_epoch, args.max_epoch):
-        start_train_time = time.time()
-        if epoch < args.initial_train:
-            train(epoch, model, criterion_simple, optimizer, trainloader, use_gpu,writer, args)
-        else:
-            train(epoch, model, criterion, optimizer, trainloader, use_gpu,writer, args)
-        train_time += round(time.time() - start_train_time)
-
-        if args.scheduler != 0:
-            scheduler.step()
-
-
-        if (epoch + 1) > args.start_eval and args.eval_step > 0 and (epoch + 1) % args.eval_step == 0 or (epoch + 1) == args.max_epoch:
-            if (epoch + 1) == args.max_epoch:
-                if use_gpu:
-                    state_dict = model.module.state_dict()
-                else:
-                    state_dict = model.state_dict()
-
-                save_checkpoint({
-                    'state_dict': state_dict,
-                    'rank1': -1,
-                    'epoch': epoch,
-                }, False, osp.join(args.save_dir, 'beforeTesting_checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-            print("==> Test")
-
-            rank1 = test(model, queryloader, galleryloader, use_gpu, args,writer=writer,epoch=epoch)
-
-            is_best = rank1 > best_rank1
-
-            if is_best:
-                best_rank1 = rank1
-                best_epoch = epoch + 1
-
-            if use_gpu:
-                state_dict = model.module.state_dict()
-            else:
-                state_dict = model.state_dict()
-
-            save_checkpoint({
-                'state_dict': state_dict,
-                'rank1': rank1,
-                'epoch': epoch,
-            }, is_best, osp.join(args.save_dir, 'checkpoint_ep' + str(epoch + 1) + '.pth.tar'))
-
-    print("==> Best Rank-1 {:.1%}, achieved at epoch {}".format(best_rank1, best_epoch))
+        engine.model = model
+        return engine.run(
+            trainloader, lambda epoch: test_rotTester(model, criterion_rot, queryloader, galleryloader, trainloader, use_gpu, args, writer=writer, epoch=epoch),
+            args.max_epoch, args.save_dir, best_rank1=best_rank1,
+            scheduler=scheduler, eval_step=args.eval_step, start_eval=args.start_eval, save_before_test=True,
+            train_fn=lambda epoch: train_rotTester(epoch, model, criterion_rot, optimizer_rot, trainloader, use_gpu, writer, args),
+            save_on_interrupt=True, score_name='Accuracy',
+        )
 
-    elapsed = round(time.time() - start_time)
-    elapsed = str(datetime.timedelta(seconds=elapsed))
-    train_time = str(datetime.timedelta(seconds=train_time))
-    print("Finished. Total elapsed time (h:m:s): {}. Training time (h:m:s): {}.".format(elapsed, train_time))
-    return best_rank1, best_epoch
+    return engine.run(
+        trainloader, lambda epoch: engine.test(queryloader, galleryloader, epoch=epoch),
+        args.max_epoch, args.save_dir, start_epoch=args.start_epoch, best_rank1=best_rank1,
+        fixbase_epoch=args.fixbase_epoch, fixbase_optimizer=fixbase_optimizer, fixbase_loss_terms=simple_terms,
+        scheduler=scheduler, eval_step=args.eval_step, start_eval=args.start_eval, save_before_test=True,
+        train_fn=lambda epoch: engine.train(epoch, trainloader, loss_terms=simple_terms if epoch < args.initial_train else None,
+                                            freeze_bn=args.freeze_bn),
+    )
 
 def train_rotTester(epoch, model, criterion_rot,optimizer,trainloader,use_gpu, writer,args,freeze_bn=True):
 
@@ -490,66 +397,18 @@ def train_rotTester(epoch, model, criterion_rot,optimizer,trainloader,use_gpu, w
            loss=losses.avg),
       epoch + 1)
 
-def train(epoch, model, criterion, optimizer, trainloader, use_gpu,writer, args,freeze_bn=False):
-    losses = AverageMeter()
-    xent_losses = AverageMeter()
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    printed = False
-    model.train()
-
-    if freeze_bn or args.freeze_bn:
-        model.apply(set_bn_to_eval)
-
-    end = time.time()
-    for batch_idx, (imgs, pids, _) in enumerate(trainloader):
-        data_time.update(time.time() - end)
-
-        if use_gpu:
-            imgs, pids = imgs.cuda(), pids.cuda()
-
-        outputs, epsilon = model(imgs)
-        if not (isinstance(criterion, AdaptiveLabelSmooth) or isinstance(criterion, AdaptiveLabelSmooth_sigmoid)):
-            if isinstance(outputs, tuple):
-                xent_loss = DeepSupervision(criterion, outputs, pids)
-            else:
-                xent_loss = criterion(outputs, pids)
-        else:
-            if isinstance(outputs, tuple):
-                xent_loss = DeepSupervisionAdaptive(criterion, outputs, pids,epsilon)
-            else:
-                xent_loss = criterion(outputs, pids,epsilon)
-        loss = args.lambda_xent *xent_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        batch_time.update(time.time() - end)
-
-        losses.update(loss.item(), pids.size(0))
-        xent_losses.update(xent_loss.item(), pids.size(0))
-        if (batch_idx + 1) % args.print_freq == 0:
-            if not printed:
-              printed = True
-            else:
-              # Clean the current line
-              sys.stdout.console.write("\033[F\033[K")
-              #sys.stdout.console.write("\033[K")
-            print('Epoch: [{0}][{1}/{2}]\t'
-                  'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                  'Data {data_time.val:.4f} ({data_time.avg:.4f})\t'
-                  'epsilon {epsilon} \t'
-                  'Xent_Loss {xent_loss.val:.4f} ({xent_loss.avg:.4f})\t'
-                  'Total_Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   epoch + 1, batch_idx + 1, len(trainloader), batch_time=batch_time,
-                   data_time=data_time,epsilon=epsilon.data.cpu().squeeze()[0],xent_loss=xent_losses, loss=losses))
-
-        end = time.time()
-
-    writer.add_scalars(
-      'loss',
-      dict(loss=losses.avg),
-      epoch + 1)
+def smoothing_term(criterion, weight):
+    """Xent LossTerm of the (outputs, epsilon) model outputs, epsilon being passed to
+    the adaptive label smoothing criteria."""
+    adaptive = isinstance(criterion, (AdaptiveLabelSmooth, AdaptiveLabelSmooth_sigmoid))
+    def fn(outputs, pids):
+        outputs, epsilon = outputs
+        if not adaptive:
+            return supervise(criterion, outputs, pids)
+        if isinstance(outputs, tuple):
+            return DeepSupervisionAdaptive(criterion, outputs, pids, epsilon)
+        return criterion(outputs, pids, epsilon)
+    return LossTerm('Xent', fn, weight)
 
 def test_rotTester(model,criterion_rot,queryloader, galleryloader, trainloader, use_gpu,args,writer,epoch, ranks=[1, 5, 10, 20], return_distmat=False):
     batch_time = AverageMeter()
@@ -619,87 +478,6 @@ def test_rotTester(model,criterion_rot,queryloader, galleryloader, trainloader,
         epoch + 1)
     return top1_test.avg.cpu().numpy()[0]
 
-def test(model, queryloader, galleryloader, use_gpu, args,writer,epoch, ranks=[1, 5, 10, 20], return_distmat=False,use_cosine = False):
-
-    batch_time = AverageMeter()
-
-    model.eval()
-
-    with torch.no_grad():
-        qf, q_pids, q_camids = [], [], []
-        for batch_idx, (imgs, pids, camids) in enumerate(queryloader):
-            if use_gpu: imgs = imgs.cuda()
-
-            end = time.time()
-            features = model(imgs)
-            batch_time.update(time.time() - end)
-
-            features = features.data.cpu()
-            qf.append(features)
-            q_pids.extend(pids)
-            q_camids.extend(camids)
-        qf = torch.cat(qf, 0)
-        q_pids = np.asarray(q_pids)
-        q_camids = np.asarray(q_camids)
-
-        print("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
-
-        gf, g_pids, g_camids = [], [], []
-        end = time.time()
-        for batch_idx, (imgs, pids, camids) in enumerate(galleryloader):
-            if use_gpu: imgs = imgs.cuda()
-
-            end = time.time()
-            features = model(imgs)
-            batch_time.update(time.time() - end)
-
-            features = features.data.cpu()
-            gf.append(features)
-            g_pids.extend(pids)
-            g_camids.extend(camids)
-        gf = torch.cat(gf, 0)
-        g_pids = np.asarray(g_pids)
-        g_camids = np.asarray(g_camids)
-
-        print("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
-
-    print("==> BatchTime(s)/BatchSize(img): {:.3f}/{}".format(batch_time.avg, args.test_batch))
-
-    if not use_cosine:
-        m, n = qf.size(0), gf.size(0)
-        distmat = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-                  torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        distmat.addmm_(1, -2, qf, gf.t())
-        distmat = distmat.numpy()
-    else:
-        m, n = qf.size(0), gf.size(0)
-        qf_norm = qf/qf.norm(dim=1)[:,None]
-        gf_norm = gf/gf.norm(dim=1)[:,None]
-        distmat = torch.addmm(1,torch.ones((m,n)),-1,qf_norm,gf_norm.transpose(0,1))
-        distmat = distmat.numpy()
-
-    print("Computing CMC and mAP")
-    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, use_metric_cuhk03=args.use_metric_cuhk03)
-
-    print("Results ----------")
-    print("mAP: {:.1%}".format(mAP))
-    print("CMC curve")
-    for r in ranks:
-        print("Rank-{:<3}: {:.1%}".format(r, cmc[r-1]))
-    print("------------------")
-
-    if return_distmat:
-        return distmat
-
-    if writer != None:
-        writer.add_scalars(
-          'Testing',
-          dict(rank_1=cmc[0],
-               rank_5 = cmc[4],
-               mAP=mAP),
-          epoch + 1)
-    return cmc[0]
-
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
     maxk = max(topk)